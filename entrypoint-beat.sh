@@ -3,13 +3,12 @@ set -e
 
 echo "Starting Django application..."
 
-# Wait for database to be ready
-echo "Waiting for database..."
-until python manage.py shell -c "from django.db import connection; connection.cursor()" 2>/dev/null; do
-    echo 'Database not ready yet...';
-    sleep 2;
-done
-echo 'Database is ready!'
+# Readiness probe: one process retrying with backoff (scheduler/management/commands/wait_for_db.py)
+python manage.py wait_for_db
+
+# The app container runs Django's system checks; skipping them here keeps the URLconf,
+# views and templates off the Celery start-up path
+export CELERY_SKIP_CHECKS=1
 
 # Start Celery beat (with optional debugpy when DEBUG=1)
 if [ "$DEBUG" = "1" ]; then
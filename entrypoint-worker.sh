@@ -11,16 +11,21 @@ set -e
 # The former entrypoint-worker-debug.sh file can now be deleted safely.
 
 echo "Starting Django application..."
+export HERTZ_BOOT_STARTED=$(date +%s.%N)  # the worker logs its start-up time against this
 
-echo "Waiting for database to be ready..."
-until python manage.py shell -c "from django.db import connection; connection.cursor()" 2>/dev/null; do
-    echo 'Database not ready yet...';
-    sleep 2;
-done
-echo 'Database is ready!'
+# Readiness probe: one process retrying with backoff (scheduler/management/commands/wait_for_db.py)
+python manage.py wait_for_db
 
-echo "Collecting static files..."
-python manage.py collectstatic --noinput
+# The app container runs Django's system checks (and serves the static files); skipping the
+# checks here keeps the URLconf, views and templates off the worker's start-up path
+export CELERY_SKIP_CHECKS=1
+
+# Prometheus multiprocess mode: the worker pool writes its metrics below METRICS_DIR/worker,
+# which the app's /metrics endpoint merges in (shared volume, see docker-compose.yml)
+if [ -n "$METRICS_DIR" ]; then
+    export PROMETHEUS_MULTIPROC_DIR="$METRICS_DIR/worker"
+    rm -rf "$PROMETHEUS_MULTIPROC_DIR" && mkdir -p "$PROMETHEUS_MULTIPROC_DIR"
+fi
 
 if [ "$DEBUG" = "1" ]; then
     echo "Starting Celery Worker with debugpy..."
@@ -3,39 +3,16 @@ set -e
 
 echo "Starting Django application..."
 
-# Wait for database to be ready
-echo "Waiting for database..."
-until python manage.py shell -c "from django.db import connection; connection.cursor()" 2>/dev/null; do
-    echo 'Database not ready yet...';
-    sleep 2;
-done
-echo 'Database is ready!'
+# One process: wait for the database (with backoff), then migrate / create the superuser /
+# collect static files - each only when there is something to do (see prepare_app.py).
+# Migrations are committed with the code, they are not generated at boot.
+python manage.py prepare_app
 
-# Create migrations for all apps
-echo "Creating migrations..."
-python manage.py makemigrations
-
-# Apply migrations
-echo "Applying migrations..."
-python manage.py migrate
-
-# Create superuser if it doesn't exist
-echo "Creating superuser if needed..."
-python manage.py shell -c "
-import os
-from django.contrib.auth.models import User
-username = os.environ.get('DJANGO_SUPERUSER_USERNAME', 'admin')
-password = os.environ.get('DJANGO_SUPERUSER_PASSWORD', 'admin123')
-if not User.objects.filter(username=username).exists():
-    User.objects.create_superuser(username, f'{username}@example.com', password)
-    print(f'Superuser created: {username}/{password}')
-else:
-    print('Superuser already exists')
-"
-
-# Collect static files
-echo "Collecting static files..."
-python manage.py collectstatic --noinput
+# Prometheus multiprocess mode: every Gunicorn worker writes its metrics below METRICS_DIR/web
+if [ -n "$METRICS_DIR" ]; then
+    export PROMETHEUS_MULTIPROC_DIR="$METRICS_DIR/web"
+    rm -rf "$PROMETHEUS_MULTIPROC_DIR" && mkdir -p "$PROMETHEUS_MULTIPROC_DIR"
+fi
 
 # Decide how to start based on DEBUG variable
 if [ "$DEBUG" = "1" ]; then
@@ -45,5 +22,6 @@ if [ "$DEBUG" = "1" ]; then
     exec python -m debugpy --listen 0.0.0.0:5678 manage.py runserver 0.0.0.0:8000
 else
     echo "Starting Gunicorn..."
-    exec gunicorn hertz_notifier.wsgi:application --bind 0.0.0.0:8000 --workers 3 --timeout 120
+    # gthread workers: long-lived SSE connections (live updates) each hold a thread, not a whole worker
+    exec gunicorn hertz_notifier.wsgi:application --bind 0.0.0.0:8000 --workers 3 --worker-class gthread --threads 16 --timeout 120
 fi
@@ -1,7 +1,19 @@
-import os
+import os, logging, time
 from celery import Celery
+from celery.signals import worker_ready
+
+IMPORTED_AT = time.time()  # the Celery CLI imports this module first (-A hertz_notifier)
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'hertz_notifier.settings')
 app = Celery('hertz_notifier')
 app.config_from_object('django.conf:settings', namespace='CELERY')
 app.autodiscover_tasks()
+
+
+@worker_ready.connect
+def log_startup_time(**kwargs):
+    # HERTZ_BOOT_STARTED is set by entrypoint-worker.sh, before it waits for the database
+    now = time.time()
+    boot = os.environ.get('HERTZ_BOOT_STARTED')
+    logging.info('Worker ready %.2fs after loading the Celery app%s', now - IMPORTED_AT,
+                 f', {now - float(boot):.2f}s after container start' if boot else '')
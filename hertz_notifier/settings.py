@@ -94,16 +94,107 @@ STATICFILES_STORAGE = 'whitenoise.storage.CompressedManifestStaticFilesStorage'
 DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
 
 CELERY_BROKER_URL = os.getenv('CELERY_BROKER_URL', 'redis://redis:6379/0')
-HERTZ_CHECK_INTERVAL = float(os.getenv('HERTZ_CHECK_INTERVAL', '120'))  # seconds
+# Results are only kept for the match shards of a sharded poll (the chord needs them)
+CELERY_RESULT_BACKEND = os.getenv('CELERY_RESULT_BACKEND', CELERY_BROKER_URL)
+CELERY_TASK_IGNORE_RESULT = True
+CELERY_RESULT_EXPIRES = 3600
+REDIS_URL = os.getenv('REDIS_URL', 'redis://redis:6379/1')
+
+# Shared cache (route snapshot, locks). Lives in Redis so web and worker see the same data.
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+        'LOCATION': REDIS_URL,
+    }
+}
+
+HERTZ_CHECK_INTERVAL = float(os.getenv('HERTZ_CHECK_INTERVAL', '120'))  # seconds, normal poll interval
+# Adaptive scheduling (scheduler.schedule): beat ticks every MIN interval, polls run that often
+# while routes churn or searches start within URGENT_DAYS, and back off up to MAX on errors.
+HERTZ_MIN_CHECK_INTERVAL = float(os.getenv('HERTZ_MIN_CHECK_INTERVAL', str(min(30.0, HERTZ_CHECK_INTERVAL))))  # seconds
+HERTZ_MAX_CHECK_INTERVAL = float(os.getenv('HERTZ_MAX_CHECK_INTERVAL', str(HERTZ_CHECK_INTERVAL * 8)))  # seconds
+HERTZ_URGENT_DAYS = int(os.getenv('HERTZ_URGENT_DAYS', '3'))
+HERTZ_POLL_LOCK_TIMEOUT = float(os.getenv('HERTZ_POLL_LOCK_TIMEOUT', '300'))  # seconds; upper bound for one poll (shards included)
+# Sharded matching: a poll with more searches than HERTZ_MATCH_SHARD_SIZE fans matching out to
+# up to HERTZ_MATCH_MAX_SHARDS match_shard tasks (1 keeps it inside check_hertz)
+HERTZ_MATCH_SHARD_SIZE = max(1, int(os.getenv('HERTZ_MATCH_SHARD_SIZE', '500')))
+HERTZ_MATCH_MAX_SHARDS = max(1, int(os.getenv('HERTZ_MATCH_MAX_SHARDS', '8')))
+# Transport-routes endpoint; polled once per country with ?country=<name> (fetched concurrently)
+HERTZ_API_URL = os.getenv('HERTZ_API_URL', 'https://www.hertzfreerider.se/api/transport-routes/')
+HERTZ_COUNTRIES = [c.strip().upper() for c in os.getenv('HERTZ_COUNTRIES', 'SWEDEN').split(',') if c.strip()]
+# Route snapshot published by check_hertz and read by the dashboard.
+# Older than MAX_AGE -> served stale while a background refresh runs.
+# Older than STALE_TTL -> dropped from the cache (next reader fetches synchronously).
+HERTZ_SNAPSHOT_MAX_AGE = float(os.getenv('HERTZ_SNAPSHOT_MAX_AGE', str(HERTZ_CHECK_INTERVAL * 2)))  # seconds
+HERTZ_SNAPSHOT_STALE_TTL = float(os.getenv('HERTZ_SNAPSHOT_STALE_TTL', '3600'))  # seconds
+# Server-Sent Events stream of snapshot updates; connections are recycled after MAX_AGE
+# (the browser reconnects automatically) so they never pin a web worker thread for long.
+LIVE_STREAM_MAX_AGE = float(os.getenv('LIVE_STREAM_MAX_AGE', '300'))  # seconds
+LIVE_STREAM_KEEPALIVE = float(os.getenv('LIVE_STREAM_KEEPALIVE', '15'))  # seconds
+# Notification history older than this is pruned daily (rides already returned only); 0 keeps all
+HERTZ_HISTORY_RETENTION_DAYS = int(os.getenv('HERTZ_HISTORY_RETENTION_DAYS', '180'))
+# Per-ride route observations removed longer ago are rolled up (deleted; corridor stats keep them)
+HERTZ_OBSERVATION_RETENTION_DAYS = int(os.getenv('HERTZ_OBSERVATION_RETENTION_DAYS', '90'))
+# Directory where every poll records the payloads it fetched (scheduler.recordings), for
+# `manage.py replay_snapshots`; empty disables recording
+HERTZ_RECORD_DIR = os.getenv('HERTZ_RECORD_DIR', '')
+# Directory of the compact snapshot archive every poll appends to (scheduler.archive, read with
+# `manage.py snapshot_archive`); empty disables it. A key frame every KEYFRAME_INTERVAL polls
+# bounds the deltas a reader decodes to reach any poll; day files older than RETENTION_DAYS are
+# deleted daily (0 keeps all)
+HERTZ_ARCHIVE_DIR = os.getenv('HERTZ_ARCHIVE_DIR', '')
+HERTZ_ARCHIVE_KEYFRAME_INTERVAL = int(os.getenv('HERTZ_ARCHIVE_KEYFRAME_INTERVAL', '60'))
+HERTZ_ARCHIVE_RETENTION_DAYS = int(os.getenv('HERTZ_ARCHIVE_RETENTION_DAYS', '0'))
 CELERY_BEAT_SCHEDULE = {
     'check_hertz_freerider': {
         'task': 'scheduler.tasks.check_hertz',
-    'schedule': HERTZ_CHECK_INTERVAL,
+        'schedule': HERTZ_MIN_CHECK_INTERVAL,
+        # A tick nobody picked up before the next one is pointless: drop it instead of piling up
+        'options': {'expires': HERTZ_MIN_CHECK_INTERVAL},
+    },
+    'prune_notification_history': {
+        'task': 'scheduler.tasks.prune_history_task',
+        'schedule': 24 * 60 * 60,
+    },
+    # Outbox retries and messages of crashed senders; new messages are drained right away
+    'drain_notification_outbox': {
+        'task': 'scheduler.tasks.drain_outbox',
+        'schedule': 60,
+    },
+    'prune_route_observations': {
+        'task': 'scheduler.tasks.prune_observations_task',
+        'schedule': 24 * 60 * 60,
     },
 }
 
+# Celery task events (-E): workers also emit task-poll-stats / task-match-stats / task-notify-stats with stage timings
+CELERY_WORKER_SEND_TASK_EVENTS = True
+CELERY_TASK_SEND_SENT_EVENT = True
+
+# Prometheus metrics. With METRICS_DIR set (a volume shared by app and worker) /metrics reports
+# every web and worker process; METRICS_TOKEN, when set, is required as a bearer token.
+METRICS_DIR = os.getenv('METRICS_DIR', '')
+METRICS_TOKEN = os.getenv('METRICS_TOKEN', '')
+
 PUSHOVER_USER = os.getenv('PUSHOVER_USER')
 PUSHOVER_TOKEN = os.getenv('PUSHOVER_TOKEN')
+PUSHOVER_API_URL = os.getenv('PUSHOVER_API_URL', 'https://api.pushover.net/1/messages.json')
+# Delivery tuning for scheduler.dispatch (concurrent sender used by the drain_outbox task)
+PUSHOVER_MAX_CONCURRENCY = int(os.getenv('PUSHOVER_MAX_CONCURRENCY', '4'))
+PUSHOVER_MAX_RETRIES = int(os.getenv('PUSHOVER_MAX_RETRIES', '3'))
+PUSHOVER_RETRY_BACKOFF = float(os.getenv('PUSHOVER_RETRY_BACKOFF', '1'))  # seconds, doubled per attempt
+PUSHOVER_MAX_RATE_LIMIT_WAIT = float(os.getenv('PUSHOVER_MAX_RATE_LIMIT_WAIT', '60'))  # seconds
+# Notification outbox (scheduler.outbox): messages per claimed batch, drain tasks started for a
+# burst, the sender's lease on a batch (a sender starts no message a worst-case send of which,
+# ~5 min with the PUSHOVER_* defaults, would outlast the lease; `manage.py check` rejects a lease
+# shorter than that), attempts before a message is dead-lettered, retry backoff (seconds,
+# doubled per attempt) and how long sent rows are kept
+HERTZ_OUTBOX_BATCH_SIZE = int(os.getenv('HERTZ_OUTBOX_BATCH_SIZE', '50'))
+HERTZ_OUTBOX_SENDERS = int(os.getenv('HERTZ_OUTBOX_SENDERS', '2'))
+HERTZ_OUTBOX_LEASE = int(os.getenv('HERTZ_OUTBOX_LEASE', '900'))
+HERTZ_OUTBOX_MAX_ATTEMPTS = int(os.getenv('HERTZ_OUTBOX_MAX_ATTEMPTS', '6'))
+HERTZ_OUTBOX_RETRY_BACKOFF = float(os.getenv('HERTZ_OUTBOX_RETRY_BACKOFF', '60'))
+HERTZ_OUTBOX_RETENTION_DAYS = int(os.getenv('HERTZ_OUTBOX_RETENTION_DAYS', '7'))
 
 # Auth flow
 LOGOUT_REDIRECT_URL = '/accounts/login/'
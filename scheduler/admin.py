@@ -1,5 +1,6 @@
 from django.contrib import admin
-from .models import SavedSearch, NotifiedRide
+from .models import CorridorStats, NotificationProfile, OutboxMessage, RouteObservation, SavedSearch, NotifiedRide
+from .outbox import hurry_pending, requeue_dead
 
 @admin.register(SavedSearch)
 class SavedSearchAdmin(admin.ModelAdmin):
@@ -7,4 +8,35 @@ class SavedSearchAdmin(admin.ModelAdmin):
 
 @admin.register(NotifiedRide)
 class NotifiedRideAdmin(admin.ModelAdmin):
-    list_display = ('ride_id', 'notified_at')
+    list_display = ('ride_id', 'owner', 'notified_at')
+
+@admin.register(NotificationProfile)
+class NotificationProfileAdmin(admin.ModelAdmin):
+    list_display = ('user', 'pushover_user_key', 'digest')
+
+@admin.register(RouteObservation)
+class RouteObservationAdmin(admin.ModelAdmin):
+    list_display = ('ride_id', 'country', 'pickup_location_name', 'return_location_name', 'first_seen', 'last_seen', 'removed_at', 'times_listed')
+    list_filter = ('country',)
+    search_fields = ('ride_id', 'pickup_location_name', 'return_location_name')
+
+@admin.register(CorridorStats)
+class CorridorStatsAdmin(admin.ModelAdmin):
+    list_display = ('pickup_location_name', 'return_location_name', 'listings', 'closed', 'last_listed_at')
+    search_fields = ('pickup_location_name', 'return_location_name')
+
+@admin.register(OutboxMessage)
+class OutboxMessageAdmin(admin.ModelAdmin):
+    list_display = ('id', 'owner', 'title', 'status', 'attempts', 'next_attempt_at', 'sent_at', 'last_error')
+    list_filter = ('status',)
+    actions = ['retry']
+
+    @admin.action(description='Retry selected messages')
+    def retry(self, request, queryset):
+        # Dead letters start over, pending messages are sent now; sent and sending ones are skipped
+        selected = queryset.count()
+        hurried = hurry_pending(queryset)  # before requeueing, which makes dead letters pending
+        requeued = requeue_dead(queryset)
+        self.message_user(request, f'{requeued} dead letter(s) queued for another delivery, '
+                                   f'{hurried} pending message(s) due now, '
+                                   f'{selected - requeued - hurried} sent or sending message(s) skipped')
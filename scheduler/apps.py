@@ -5,4 +5,4 @@ class SchedulerConfig(AppConfig):
     name = 'scheduler'
 
     def ready(self):
-        from . import signals  # noqa
+        from . import checks, signals  # noqa
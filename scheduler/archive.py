@@ -0,0 +1,421 @@
+"""Compact on-disk archive of every poll's route snapshot.
+
+With HERTZ_ARCHIVE_DIR set, `check_hertz` appends each poll's snapshot here (`archive_poll`).
+Storing the upstream JSON every poll would cost ~700 KB a time; this keeps the parsed routes,
+columnar and delta-encoded, in two files per UTC day:
+
+    <day>.frames   append-only zlib-compressed frames:
+                     key frame   every route of the snapshot, plus the interned strings (ids,
+                                 names, cities, codes, car models) and locations they use
+                     delta frame only the routes added or changed since the previous poll, the
+                                 ids removed, and the strings / locations not interned yet
+                   inside a frame every field is one packed column (all pickup locations, then
+                   all car models, ...), which is what makes the columns compress well
+    <day>.index    fixed-size entries (poll time, frame offset, frame length, entry of the key
+                   frame the delta builds on), one per poll in time order; an unchanged poll
+                   writes an entry without a frame
+
+A day starts with a key frame and a new one is written every HERTZ_ARCHIVE_KEYFRAME_INTERVAL
+polls, so no poll is more than that many small frames away from one. `SnapshotArchive`
+memory-maps the files: `snapshot_at` bisects the index and decodes one key frame plus its
+deltas, and `polls` / `changes` stream a time range decoding each frame once. Nothing reads a
+whole file.
+
+Frames are written before their index entry and readers only follow the index, so a crash
+mid-write leaves unreferenced bytes at worst. One poll runs at a time (scheduler.schedule);
+a process that finds the files changed by another worker rebuilds its writer state from them.
+"""
+
+import bisect, datetime, logging, math, mmap, struct, sys, zlib
+from array import array
+from functools import lru_cache
+from pathlib import Path
+from django.conf import settings
+from django.utils import timezone
+from .routes import Location, Route
+
+FRAMES_MAGIC = b'HFF1'
+INDEX_MAGIC = b'HFI1'
+ENTRY = struct.Struct('<dQII')     # poll time (unix), frame offset, frame length, key frame entry
+HEADER = struct.Struct('<BIIII')   # kind, new strings, new locations, routes, removed ids
+KEY, DELTA = 0, 1
+MISSING_TIME = -2 ** 63
+COMPRESSION_LEVEL = 6
+
+_writer = None  # _WriterState of the day file this process appended to last
+
+
+def _column(typecode, values):
+    column = array(typecode, values)
+    if sys.byteorder == 'big':
+        column.byteswap()  # files are little-endian
+    return column.tobytes()
+
+
+def _read_column(typecode, buffer, offset, count):
+    column = array(typecode)
+    end = offset + count * column.itemsize
+    column.frombytes(buffer[offset:end])
+    if sys.byteorder == 'big':
+        column.byteswap()
+    return column, end
+
+
+def _float(value):
+    return math.nan if value is None else float(value)
+
+
+def _optional(value):
+    return None if math.isnan(value) else value
+
+
+def _timestamp(value):
+    return MISSING_TIME if value is None else int(value.timestamp())
+
+
+@lru_cache(maxsize=65536)
+def _local_time(timestamp):
+    """(aware datetime, local date, display string) as `routes.parse_routes` derives them."""
+    if timestamp == MISSING_TIME:
+        return None, None, ''
+    local = timezone.localtime(datetime.datetime.fromtimestamp(timestamp, datetime.timezone.utc))
+    return local, local.date(), local.strftime('%Y-%m-%d %H:%M')
+
+
+def _encode(kind, strings, locations, rows, removed):
+    blobs = [string.encode() for string in strings]
+    parts = [HEADER.pack(kind, len(strings), len(locations), len(rows), len(removed)),
+             _column('I', map(len, blobs)), b''.join(blobs)]
+    parts += [_column('I', (location[n] for location in locations)) for n in range(3)]
+    parts += [_column('d', (location[n] for location in locations)) for n in (3, 4)]
+    parts += [_column('I', (row[n] for row in rows)) for n in range(4)]
+    parts += [_column('d', (row[n] for row in rows)) for n in (4, 5)]
+    parts += [_column('q', (row[n] for row in rows)) for n in (6, 7)]
+    parts.append(_column('I', removed))
+    return zlib.compress(b''.join(parts), COMPRESSION_LEVEL)
+
+
+def _decode(frame):
+    """(kind, new strings, new location rows, route rows, removed string ids) of a frame."""
+    buffer = zlib.decompress(frame)
+    kind, n_strings, n_locations, n_routes, n_removed = HEADER.unpack_from(buffer)
+    lengths, offset = _read_column('I', buffer, HEADER.size, n_strings)
+    strings = []
+    for length in lengths:
+        strings.append(buffer[offset:offset + length].decode())
+        offset += length
+    columns = []
+    for typecode, count, n in (('I', n_locations, 3), ('d', n_locations, 2), ('I', n_routes, 4),
+                               ('d', n_routes, 2), ('q', n_routes, 2)):
+        for _ in range(n):
+            column, offset = _read_column(typecode, buffer, offset, count)
+            columns.append(column)
+    removed, _ = _read_column('I', buffer, offset, n_removed)
+    return kind, strings, list(zip(*columns[:5])), list(zip(*columns[5:])), removed
+
+
+class _Group:
+    """A key frame and its deltas: interned strings and locations, and the routes at the last
+    frame applied."""
+
+    def __init__(self):
+        self.strings, self.string_ids = [], {}
+        self.locations, self.location_ids, self.location_rows = [], {}, []
+        self.routes = {}  # ride id -> Route
+
+    def string(self, value):
+        sid = self.string_ids.get(value)
+        if sid is None:
+            sid = self.string_ids[value] = len(self.strings)
+            self.strings.append(value)
+        return sid
+
+    def location(self, location):
+        lid = self.location_ids.get(location)
+        if lid is None:
+            lid = self.location_ids[location] = len(self.locations)
+            self.locations.append(location)
+            self.location_rows.append((self.string(location.name), self.string(location.city),
+                                       self.string(location.trac_code), _float(location.lat), _float(location.lon)))
+        return lid
+
+    def row(self, route):
+        return (self.string(route.id), self.location(route.pickup_location), self.location(route.return_location),
+                self.string(route.car_model), _float(route.distance), _float(route.travel_time),
+                _timestamp(route.available_at), _timestamp(route.latest_return))
+
+    def encode(self, kind, routes, removed):
+        """Frame for `routes` (changed) and `removed` ids, interning what they need first."""
+        n_strings, n_locations = len(self.strings), len(self.locations)
+        rows = [self.row(route) for route in routes]
+        removed = [self.string_ids[ride_id] for ride_id in removed]
+        return _encode(kind, self.strings[n_strings:], self.location_rows[n_locations:], rows, removed)
+
+    def apply(self, frame):
+        """Decode a frame on top of this group; returns (changed routes, removed ids)."""
+        kind, strings, locations, rows, removed = _decode(frame)
+        if kind == KEY:
+            self.__init__()
+        for value in strings:
+            self.string_ids[value] = len(self.strings)
+            self.strings.append(value)
+        for name, city, code, lat, lon in locations:
+            location = Location(name=self.strings[name], city=self.strings[city], trac_code=self.strings[code],
+                                lat=_optional(lat), lon=_optional(lon))
+            self.location_ids[location] = len(self.locations)
+            self.locations.append(location)
+            self.location_rows.append((name, city, code, lat, lon))
+        removed = [self.strings[sid] for sid in removed]
+        for ride_id in removed:
+            self.routes.pop(ride_id, None)
+        changed = []
+        for ride_id, pickup, destination, car_model, distance, travel_time, available_at, latest_return in rows:
+            travel_time = _optional(travel_time)
+            if travel_time is not None and travel_time.is_integer():
+                travel_time = int(travel_time)
+            available_at, pickup_date, available_at_display = _local_time(available_at)
+            latest_return, return_date, latest_return_display = _local_time(latest_return)
+            route = Route(
+                id=self.strings[ride_id],
+                pickup_location=self.locations[pickup],
+                return_location=self.locations[destination],
+                car_model=self.strings[car_model],
+                distance=_optional(distance),
+                travel_time=travel_time,
+                available_at=available_at,
+                latest_return=latest_return,
+                pickup_date=pickup_date,
+                return_date=return_date,
+                travel_hours=round(travel_time / 60, 1) if travel_time is not None else None,
+                available_at_display=available_at_display,
+                latest_return_display=latest_return_display,
+            )
+            self.routes[route.id] = route
+            changed.append(route)
+        return changed, removed
+
+
+def _map(path):
+    """Read-only memory map of `path`, or None when it is missing or empty."""
+    try:
+        with open(path, 'rb') as f:
+            return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    except (FileNotFoundError, ValueError):  # ValueError: empty file
+        return None
+
+
+class _DayFile:
+    """One day's frames and index, memory-mapped (entries appended later are not seen)."""
+
+    def __init__(self, directory, day):
+        self.day = day
+        self._index = _map(Path(directory) / f'{day}.index')
+        self._frames = _map(Path(directory) / f'{day}.frames')
+        self.count = (len(self._index) - len(INDEX_MAGIC)) // ENTRY.size if self._index else 0
+
+    def entry(self, i):
+        return ENTRY.unpack_from(self._index, len(INDEX_MAGIC) + i * ENTRY.size)
+
+    def at(self, i):
+        return self.entry(i)[0]
+
+    def frame(self, i):
+        _, offset, length, _ = self.entry(i)
+        return self._frames[offset:offset + length] if length else None
+
+    def close(self):
+        for mapped in (self._index, self._frames):
+            if mapped is not None:
+                mapped.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class _WriterState:
+    def __init__(self, day, group, entries, keyframe, size):
+        self.day, self.group = day, group
+        self.entries, self.keyframe, self.size = entries, keyframe, size  # index entries, key entry, frames bytes
+
+
+def _day_of(at):
+    return at.astimezone(datetime.timezone.utc).date().isoformat()
+
+
+def _writer_state(directory, day):
+    """This process' writer state for `day`, rebuilt from the files when they moved on."""
+    index_path, frames_path = Path(directory) / f'{day}.index', Path(directory) / f'{day}.frames'
+    entries = max(0, (index_path.stat().st_size - len(INDEX_MAGIC)) // ENTRY.size) if index_path.exists() else 0
+    size = frames_path.stat().st_size if frames_path.exists() else 0
+    if _writer and _writer.day == day and _writer.entries == entries and _writer.size == size:
+        return _writer
+    if not entries:
+        return None
+    with _DayFile(directory, day) as day_file:
+        keyframe = day_file.entry(entries - 1)[3]
+        group = _Group()
+        for i in range(keyframe, entries):
+            frame = day_file.frame(i)
+            if frame is not None:
+                group.apply(frame)
+    return _WriterState(day, group, entries, keyframe, size)
+
+
+def archive_poll(routes, at=None, directory=None):
+    """Append one poll's snapshot (all its Route records); returns the frame size in bytes."""
+    global _writer
+    directory = directory or settings.HERTZ_ARCHIVE_DIR
+    if not directory:
+        return None
+    at = at or timezone.now()
+    day = _day_of(at)
+    Path(directory).mkdir(parents=True, exist_ok=True)
+    try:
+        state = _writer_state(directory, day)
+        routes = {route.id: route for route in routes}
+        if state is None or state.entries - state.keyframe >= settings.HERTZ_ARCHIVE_KEYFRAME_INTERVAL:
+            group = _Group()
+            frame = group.encode(KEY, list(routes.values()), [])
+            keyframe = state.entries if state else 0
+        else:
+            group, keyframe = state.group, state.keyframe
+            changed = [route for ride_id, route in routes.items() if group.routes.get(ride_id) != route]
+            removed = [ride_id for ride_id in group.routes if ride_id not in routes]
+            frame = group.encode(DELTA, changed, removed) if changed or removed else b''
+        group.routes = routes
+        entries, size = _append(directory, day, at, frame, keyframe)
+        _writer = _WriterState(day, group, entries, keyframe, size)
+    except BaseException:
+        _writer = None  # the group may hold strings that never reached the file
+        raise
+    return len(frame)
+
+
+def _append(directory, day, at, frame, keyframe):
+    """Write the frame, then its index entry; returns (index entries, frames file size)."""
+    with open(Path(directory) / f'{day}.frames', 'ab') as f:
+        if f.tell() == 0:
+            f.write(FRAMES_MAGIC)
+        offset = f.tell()
+        f.write(frame)
+        size = f.tell()
+    with open(Path(directory) / f'{day}.index', 'ab') as f:
+        if f.tell() == 0:
+            f.write(INDEX_MAGIC)
+        extra = (f.tell() - len(INDEX_MAGIC)) % ENTRY.size
+        if extra:
+            f.truncate(f.tell() - extra)  # a torn entry from a crashed writer
+            f.seek(0, 2)
+        f.write(ENTRY.pack(at.timestamp(), offset, len(frame), keyframe))
+        entries = (f.tell() - len(INDEX_MAGIC)) // ENTRY.size
+    return entries, size
+
+
+def prune_archive(days=None, directory=None):
+    """Delete day files older than HERTZ_ARCHIVE_RETENTION_DAYS (0 keeps everything)."""
+    directory = directory or settings.HERTZ_ARCHIVE_DIR
+    days = settings.HERTZ_ARCHIVE_RETENTION_DAYS if days is None else days
+    if not (directory and days and Path(directory).is_dir()):
+        return 0
+    oldest = (timezone.now() - datetime.timedelta(days=days)).astimezone(datetime.timezone.utc).date().isoformat()
+    deleted = 0
+    for path in Path(directory).glob('*.index'):
+        if path.stem < oldest:
+            path.with_suffix('.frames').unlink(missing_ok=True)
+            path.unlink()
+            deleted += 1
+    if deleted:
+        logging.info('Pruned %s day(s) of the snapshot archive', deleted)
+    return deleted
+
+
+class SnapshotArchive:
+    """Read side of the archive in `directory` (default HERTZ_ARCHIVE_DIR)."""
+
+    def __init__(self, directory=None):
+        self.directory = Path(directory or settings.HERTZ_ARCHIVE_DIR)
+
+    def days(self):
+        return sorted(path.stem for path in self.directory.glob('*.index'))
+
+    def day_stats(self, day):
+        """{'polls', 'frames', 'keyframes', 'bytes'} of one day's files."""
+        with _DayFile(self.directory, day) as day_file:
+            entries = [day_file.entry(i) for i in range(day_file.count)]
+        size = sum(path.stat().st_size for path in self.directory.glob(f'{day}.*'))
+        return {
+            'polls': len(entries),
+            'frames': sum(1 for entry in entries if entry[2]),
+            'keyframes': sum(1 for i, entry in enumerate(entries) if entry[3] == i),
+            'bytes': size,
+        }
+
+    def snapshot_at(self, at):
+        """(poll time, [Route]) of the last poll at or before `at`, or None."""
+        timestamp = at.timestamp()
+        for day in reversed([day for day in self.days() if day <= _day_of(at)]):
+            with _DayFile(self.directory, day) as day_file:
+                i = bisect.bisect_right(range(day_file.count), timestamp, key=day_file.at) - 1
+                if i < 0:
+                    continue
+                group = _Group()
+                for j in range(day_file.entry(i)[3], i + 1):
+                    frame = day_file.frame(j)
+                    if frame is not None:
+                        group.apply(frame)
+                return self._time(day_file.at(i)), list(group.routes.values())
+        return None
+
+    def polls(self, since=None, until=None):
+        """Yield (poll time, {ride id: Route}) for every poll in [since, until].
+
+        The mapping is updated in place from one poll to the next; copy it to keep it.
+        """
+        for at, routes, _, _ in self._scan(since, until):
+            yield at, routes
+
+    def changes(self, since=None, until=None):
+        """Yield (poll time, added or changed Routes, removed ride ids) for every poll in
+        [since, until], relative to the poll before it (everything, for the first one)."""
+        for at, _, changed, removed in self._scan(since, until):
+            yield at, changed, removed
+
+    def _time(self, timestamp):
+        return datetime.datetime.fromtimestamp(timestamp, datetime.timezone.utc)
+
+    def _scan(self, since, until):
+        since_ts = since.timestamp() if since else None
+        until_ts = until.timestamp() if until else None
+        group = _Group()
+        first = True  # no poll yielded yet: nothing to compare a key frame with
+        for day in self.days():
+            if (since and day < _day_of(since)) or (until and day > _day_of(until)):
+                continue
+            with _DayFile(self.directory, day) as day_file:
+                start = 0
+                if since_ts is not None:
+                    start = bisect.bisect_left(range(day_file.count), since_ts, key=day_file.at)
+                    if start < day_file.count and start > 0:
+                        # Catch up silently from the key frame the first poll builds on
+                        for j in range(day_file.entry(start)[3], start):
+                            frame = day_file.frame(j)
+                            if frame is not None:
+                                group.apply(frame)
+                for i in range(start, day_file.count):
+                    timestamp, _, _, keyframe = day_file.entry(i)
+                    if until_ts is not None and timestamp > until_ts:
+                        return
+                    frame = day_file.frame(i)
+                    changed, removed = [], []
+                    if frame is not None:
+                        previous = dict(group.routes) if keyframe == i and not first else None
+                        changed, removed = group.apply(frame)
+                        if previous is not None:
+                            # A key frame restates everything: report only what differs
+                            changed = [route for route in changed if previous.get(route.id) != route]
+                            removed = [ride_id for ride_id in previous if ride_id not in group.routes]
+                    first = False
+                    yield self._time(timestamp), group.routes, changed, removed
@@ -0,0 +1,20 @@
+"""System checks, run by `manage.py check` and before every other management command."""
+
+from django.conf import settings
+from django.core import checks
+
+
+@checks.register()
+def outbox_lease_check(app_configs, **kwargs):
+    # A lease shorter than one worst-case send could expire mid-send, letting another drain
+    # claim and send the same message again
+    from .outbox import minimum_lease
+    minimum = minimum_lease()
+    if settings.HERTZ_OUTBOX_LEASE < minimum:
+        return [checks.Error(
+            f'HERTZ_OUTBOX_LEASE ({settings.HERTZ_OUTBOX_LEASE} s) is shorter than one worst-case Pushover send '
+            f'({minimum:.0f} s with PUSHOVER_MAX_RETRIES, PUSHOVER_RETRY_BACKOFF and PUSHOVER_MAX_RATE_LIMIT_WAIT).',
+            hint=f'Raise HERTZ_OUTBOX_LEASE to at least {minimum:.0f}, or lower the retry settings.',
+            id='scheduler.E001',
+        )]
+    return []
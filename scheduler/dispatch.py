@@ -0,0 +1,124 @@
+"""Concurrent Pushover dispatch.
+
+`check_hertz` does not send inline: new matches go into the notification outbox
+(scheduler.outbox), whose `drain_outbox` task calls `deliver()` here for each claimed batch.
+Delivery uses the pooled session from `utils.pushover_session`, bounded concurrency
+(PUSHOVER_MAX_CONCURRENCY), retries transient failures (network errors, 429, 5xx) with
+exponential backoff and pauses all senders when Pushover reports its application limit as
+exhausted. What still fails is retried later by the outbox.
+
+A sender only owns its batch until the batch's lease runs out (HERTZ_OUTBOX_LEASE), after
+which another drain may claim and send the same rows. `deliver(..., deadline=...)` therefore
+starts a message only while one worst-case send (`worst_case_send_seconds`: every attempt
+timing out after a full rate-limit pause, plus the backoffs) still fits before the deadline;
+the rest are handed back unsent.
+"""
+
+import logging, random, threading, time
+from concurrent.futures import ThreadPoolExecutor
+from django.conf import settings
+from .metrics import NOTIFICATIONS, PUSHOVER_SECONDS
+from .utils import pushover_payload, pushover_session
+
+PUSHOVER_TIMEOUT = 10  # seconds per request
+
+class _RateLimit:
+    """Process-wide pause shared by all sender threads.
+
+    Pushover returns X-Limit-App-Remaining / X-Limit-App-Reset (unix time) on every
+    response and 429 once the monthly application limit is used up.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._paused_until = 0.0  # time.time() value
+
+    def wait(self):
+        with self._lock:
+            delay = self._paused_until - time.time()
+        if delay > 0:
+            time.sleep(min(delay, settings.PUSHOVER_MAX_RATE_LIMIT_WAIT))
+
+    def update(self, response):
+        headers = response.headers
+        until = None
+        if response.status_code == 429:
+            retry_after = headers.get('Retry-After')
+            if retry_after and retry_after.isdigit():
+                until = time.time() + int(retry_after)
+        if until is None and headers.get('X-Limit-App-Remaining') == '0':
+            reset = headers.get('X-Limit-App-Reset')
+            if reset and reset.isdigit():
+                until = float(reset)
+        if until is not None:
+            with self._lock:
+                self._paused_until = max(self._paused_until, until)
+            logging.warning('Pushover rate limit reached, pausing sends until %s', time.ctime(until))
+
+
+_rate_limit = _RateLimit()
+
+
+def worst_case_send_seconds():
+    """Longest one message can take in `_send_with_retry`."""
+    attempts = settings.PUSHOVER_MAX_RETRIES + 1
+    backoffs = sum(1.5 * settings.PUSHOVER_RETRY_BACKOFF * 2 ** attempt for attempt in range(attempts - 1))
+    return attempts * (PUSHOVER_TIMEOUT + settings.PUSHOVER_MAX_RATE_LIMIT_WAIT) + backoffs
+
+
+def _send_with_retry(payload, deadline=None):
+    import requests  # already loaded by pushover_session(); kept off the import path
+    if deadline is not None and time.time() + worst_case_send_seconds() > deadline:
+        return None  # might not finish before the batch's lease ends: leave it to the next claim
+    attempts = settings.PUSHOVER_MAX_RETRIES + 1
+    for attempt in range(attempts):
+        _rate_limit.wait()
+        try:
+            with PUSHOVER_SECONDS.time():
+                r = pushover_session().post(settings.PUSHOVER_API_URL, data=payload, timeout=PUSHOVER_TIMEOUT)
+        except requests.RequestException as e:
+            logging.warning('Pushover send failed (attempt %s/%s): %s', attempt + 1, attempts, e)
+        else:
+            _rate_limit.update(r)
+            if r.ok:
+                return True
+            if r.status_code != 429 and r.status_code < 500:
+                # 4xx other than 429 means the request itself is wrong (bad key, bad payload)
+                logging.error('Pushover rejected message (%s): %s', r.status_code, r.text[:200])
+                return False
+            logging.warning('Pushover send failed (attempt %s/%s): HTTP %s', attempt + 1, attempts, r.status_code)
+        if attempt + 1 < attempts:
+            backoff = settings.PUSHOVER_RETRY_BACKOFF * (2 ** attempt)
+            time.sleep(backoff + random.uniform(0, backoff / 2))
+    return False
+
+
+def deliver(notifications, deadline=None, **kwargs):
+    """Send notifications concurrently; return one result per notification: delivered (True),
+    failed (False) or, with a `deadline` (time.time() value), not attempted (None).
+
+    Each notification is a dict with `message` and optionally `user` (recipient key) and
+    `title`; other keyword arguments are passed to `pushover_payload` for every message.
+    Notifications that cannot be sent because Pushover is not configured (no token, or no
+    recipient key) count as handled, matching the behaviour of `send_pushover`.
+    """
+    if not notifications:
+        return []
+    payloads = []
+    for n in notifications:
+        options = dict(kwargs, title=n['title']) if n.get('title') else kwargs
+        payloads.append(pushover_payload(n['message'], user=n.get('user'), **options))
+    if any(payload is None for payload in payloads):
+        logging.warning('Pushover not configured for %s notification(s)', sum(p is None for p in payloads))
+    results = [True] * len(payloads)
+    pending = [i for i, payload in enumerate(payloads) if payload is not None]
+    if pending:
+        workers = min(settings.PUSHOVER_MAX_CONCURRENCY, len(pending))
+        with ThreadPoolExecutor(max_workers=workers, thread_name_prefix='pushover') as pool:
+            for i, ok in zip(pending, pool.map(lambda payload: _send_with_retry(payload, deadline),
+                                               [payloads[i] for i in pending])):
+                results[i] = ok
+    NOTIFICATIONS.labels('skipped').inc(len(payloads) - len(pending))
+    NOTIFICATIONS.labels('sent').inc(sum(results[i] is True for i in pending))
+    NOTIFICATIONS.labels('failed').inc(sum(results[i] is False for i in pending))
+    return results
@@ -1,13 +1,44 @@
 from django import forms
-from .models import SavedSearch
+from .geo import MAX_RADIUS_KM
+from .models import NotificationProfile, SavedSearch
 
 class SavedSearchForm(forms.ModelForm):
     class Meta:
         model = SavedSearch
-        fields = ['date_from', 'date_to', 'origin', 'destination']
+        fields = ['date_from', 'date_to', 'origin', 'origin_radius_km', 'destination', 'destination_radius_km', 'heading']
         widgets = {
             'date_from': forms.DateInput(attrs={'type': 'date', 'class': 'form-control'}),
             'date_to': forms.DateInput(attrs={'type': 'date', 'class': 'form-control'}),
             'origin': forms.TextInput(attrs={'class': 'form-control'}),
+            'origin_radius_km': forms.NumberInput(attrs={'class': 'form-control', 'min': 1, 'max': MAX_RADIUS_KM}),
             'destination': forms.TextInput(attrs={'class': 'form-control'}),
+            'destination_radius_km': forms.NumberInput(attrs={'class': 'form-control', 'min': 1, 'max': MAX_RADIUS_KM}),
+            'heading': forms.Select(attrs={'class': 'form-select'}),
         }
+        labels = {
+            'origin_radius_km': 'Origin radius (km)',
+            'destination_radius_km': 'Destination radius (km)',
+        }
+        help_texts = {
+            'origin': 'Station, city or station code; * as wildcard. Accents and small typos are ignored.',
+            'origin_radius_km': f'Optional: match every pickup within this distance (up to {MAX_RADIUS_KM} km) of the origin (a place or "lat, lon").',
+            'destination': 'Station, city or station code; * as wildcard. Accents and small typos are ignored.',
+            'destination_radius_km': 'Optional: match every return within this distance of the destination.',
+            'heading': 'Optional: only trips going roughly this way.',
+        }
+
+class NotificationProfileForm(forms.ModelForm):
+    class Meta:
+        model = NotificationProfile
+        fields = ['pushover_user_key', 'digest']
+        widgets = {
+            'pushover_user_key': forms.TextInput(attrs={'class': 'form-control', 'autocomplete': 'off'}),
+            'digest': forms.CheckboxInput(attrs={'class': 'form-check-input'}),
+        }
+
+class HistoryFilterForm(forms.Form):
+    pickup = forms.CharField(required=False, widget=forms.TextInput(attrs={'class': 'form-control', 'placeholder': 'Pickup'}))
+    destination = forms.CharField(required=False, widget=forms.TextInput(attrs={'class': 'form-control', 'placeholder': 'Destination'}))
+    car_type = forms.CharField(required=False, widget=forms.TextInput(attrs={'class': 'form-control', 'placeholder': 'Car type'}))
+    date_from = forms.DateField(required=False, widget=forms.DateInput(attrs={'type': 'date', 'class': 'form-control'}))
+    date_to = forms.DateField(required=False, widget=forms.DateInput(attrs={'type': 'date', 'class': 'form-control'}))
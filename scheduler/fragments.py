@@ -0,0 +1,73 @@
+"""Cached, versioned fragments of the dashboard page.
+
+The live-availability table (plus the per-search match counts computed with it) and the
+notification history list are rendered once and cached under a key made of the versions of
+everything they are built from:
+
+    live     -> snapshot version, the user's search-set version, the user's notified version
+    history  -> the user's notified version, the history epoch
+
+Nothing is deleted on a change; bumping a version makes the next page view miss and render
+afresh, and the old entries simply expire. Versions are bumped explicitly:
+    * a new snapshot carries a new `version` (`snapshot.publish_snapshot`, i.e. every
+      check_hertz poll with changes; a 304 keeps it)
+    * SavedSearch saved / deleted      -> `bump_search_version` (scheduler.signals)
+    * notifications recorded for a user -> `bump_notified_version` (scheduler.outbox)
+    * history pruned                   -> `bump_history_epoch` (scheduler.history)
+A version key that was evicted from the cache is recreated with a new value, which can only
+cause a miss, never a stale fragment.
+"""
+
+import time
+from django.conf import settings
+from django.core.cache import cache
+
+SEARCH_VERSION_KEY = 'hertz:search-version:{}'      # user id
+NOTIFIED_VERSION_KEY = 'hertz:notified-version:{}'  # user id
+HISTORY_EPOCH_KEY = 'hertz:history-epoch'
+FRAGMENT_KEY = 'hertz:fragment:{}:{}:{}'            # name, user id, versions
+
+
+def _version(key):
+    version = cache.get(key)
+    if version is None:
+        version = time.time_ns()
+        if not cache.add(key, version, timeout=None):
+            version = cache.get(key)  # another request created it first
+    return version
+
+
+def _bump(key):
+    cache.set(key, time.time_ns(), timeout=None)
+
+
+def bump_search_version(user_id):
+    _bump(SEARCH_VERSION_KEY.format(user_id))
+
+
+def bump_notified_version(user_ids):
+    cache.set_many({NOTIFIED_VERSION_KEY.format(user_id): time.time_ns() for user_id in user_ids}, timeout=None)
+
+
+def bump_history_epoch():
+    _bump(HISTORY_EPOCH_KEY)
+
+
+def live_fragment_key(user_id, snapshot_version):
+    versions = f'{snapshot_version}-{_version(SEARCH_VERSION_KEY.format(user_id))}-{_version(NOTIFIED_VERSION_KEY.format(user_id))}'
+    return FRAGMENT_KEY.format('live', user_id, versions)
+
+
+def history_fragment_key(user_id):
+    versions = f'{_version(NOTIFIED_VERSION_KEY.format(user_id))}-{_version(HISTORY_EPOCH_KEY)}'
+    return FRAGMENT_KEY.format('history', user_id, versions)
+
+
+def cached_fragment(key, build):
+    """Return the cached value of `key`, calling `build()` and storing its result on a miss."""
+    value = cache.get(key)
+    if value is None:
+        value = build()
+        # Unreachable once any version moves on; the TTL only bounds how long it lingers
+        cache.set(key, value, timeout=settings.HERTZ_SNAPSHOT_STALE_TTL)
+    return value
@@ -0,0 +1,113 @@
+"""Geo helpers for radius searches.
+
+Every upstream location carries its station coordinates (geoLat / geoLon), so a search can
+say "pick up within 50 km of Malmö" instead of naming stations. The centre is geocoded once
+when the search is saved (`locate`: an explicit "lat, lon", or the centroid of the snapshot
+stations the place name resolves to) and stored on the SavedSearch.
+
+Matching goes through `GeoGrid`, a uniform grid over the station coordinates of one snapshot
+(built lazily by its LocationIndex). A radius query only visits the cells overlapping the
+circle's bounding box, and `SearchMatcher` runs one query per distinct (centre, radius) and
+folds the result into its location -> searches map, so matching a route costs the same dict
+lookups however many radius searches there are.
+"""
+
+import math, re
+from collections import namedtuple
+
+EARTH_RADIUS_KM = 6371.0
+KM_PER_DEGREE = 111.2
+CELL_DEGREES = 0.5  # ~55 km north-south; a typical radius touches a handful of cells
+HEADINGS = {'north': 0, 'east': 90, 'south': 180, 'west': 270}
+HEADING_TOLERANCE = 45  # degrees either side, so the four headings cover every direction
+# Largest radius a search may use; `within` visits every cell of the bounding box, so an
+# unbounded radius would scan the whole grid for each such search on every poll
+MAX_RADIUS_KM = 500
+
+# Pattern-like key for LocationIndex.resolve: stations within radius_km of (lat, lon)
+Near = namedtuple('Near', 'lat lon radius_km')
+
+_POINT = re.compile(r'^\s*(-?\d+(?:\.\d+)?)\s*[,;\s]\s*(-?\d+(?:\.\d+)?)\s*$')
+
+
+def distance_km(lat1, lon1, lat2, lon2):
+    """Great-circle (haversine) distance in km."""
+    phi1, phi2 = math.radians(lat1), math.radians(lat2)
+    a = (math.sin((phi2 - phi1) / 2) ** 2
+         + math.cos(phi1) * math.cos(phi2) * math.sin(math.radians(lon2 - lon1) / 2) ** 2)
+    return 2 * EARTH_RADIUS_KM * math.asin(min(1.0, math.sqrt(a)))
+
+
+def bearing(lat1, lon1, lat2, lon2):
+    """Initial compass bearing in degrees (0 = north, 90 = east) from point 1 to point 2."""
+    phi1, phi2 = math.radians(lat1), math.radians(lat2)
+    dlon = math.radians(lon2 - lon1)
+    x = math.sin(dlon) * math.cos(phi2)
+    y = math.cos(phi1) * math.sin(phi2) - math.sin(phi1) * math.cos(phi2) * math.cos(dlon)
+    return math.degrees(math.atan2(x, y)) % 360
+
+
+def heading_matches(origin, destination, heading):
+    """True when a trip from `origin` to `destination` (Locations) goes roughly `heading`."""
+    if not heading:
+        return True
+    coordinates = (getattr(origin, 'lat', None), getattr(origin, 'lon', None),
+                   getattr(destination, 'lat', None), getattr(destination, 'lon', None))
+    if None in coordinates:
+        return False
+    offset = abs(bearing(*coordinates) - HEADINGS[heading]) % 360
+    return min(offset, 360 - offset) <= HEADING_TOLERANCE
+
+
+def parse_point(text):
+    """(lat, lon) from "55.6, 13.0", or None when `text` is not a coordinate pair."""
+    found = _POINT.match(text or '')
+    if not found:
+        return None
+    lat, lon = float(found.group(1)), float(found.group(2))
+    if -90 <= lat <= 90 and -180 <= lon <= 180:
+        return lat, lon
+    return None
+
+
+def locate(text, locations):
+    """Geocode a search's place: a literal "lat, lon", else the centroid of the stations
+    `text` resolves to in `locations` (a LocationIndex). None when it cannot be placed."""
+    point = parse_point(text)
+    if point or locations is None:
+        return point
+    placed = [locations.locations[i] for i in locations.resolve(text)]
+    placed = [location for location in placed if location.lat is not None]
+    if not placed:
+        return None
+    return (sum(location.lat for location in placed) / len(placed),
+            sum(location.lon for location in placed) / len(placed))
+
+
+class GeoGrid:
+    """Uniform lat/lon grid over points; `within` answers radius queries cell by cell."""
+
+    def __init__(self, points):
+        self._points = {}                                  # position -> (lat, lon)
+        self._cells = {}                                   # (row, column) -> [positions]
+        for position, (lat, lon) in points:
+            self._points[position] = (lat, lon)
+            self._cells.setdefault(self._cell(lat, lon), []).append(position)
+
+    @staticmethod
+    def _cell(lat, lon):
+        return math.floor(lat / CELL_DEGREES), math.floor(lon / CELL_DEGREES)
+
+    def within(self, lat, lon, radius_km):
+        """Positions of the points at most `radius_km` from (lat, lon)."""
+        radius_km = min(radius_km, MAX_RADIUS_KM)
+        dlat = radius_km / KM_PER_DEGREE
+        dlon = min(180.0, radius_km / (KM_PER_DEGREE * max(math.cos(math.radians(lat)), 0.01)))
+        (row_min, column_min), (row_max, column_max) = self._cell(lat - dlat, lon - dlon), self._cell(lat + dlat, lon + dlon)
+        hits = set()
+        for row in range(row_min, row_max + 1):
+            for column in range(column_min, column_max + 1):
+                for position in self._cells.get((row, column), ()):
+                    if distance_km(lat, lon, *self._points[position]) <= radius_km:
+                        hits.add(position)
+        return hits
@@ -0,0 +1,133 @@
+"""Notification history: keyset (cursor) pagination, filters and retention.
+
+Pages are ordered newest first by (notified_at, id) and continue from a cursor holding the
+last row's key, so every page is an index range scan of `limit` rows. OFFSET would re-read
+all skipped rows and degrade on deep pages. A user's history is their own rows plus legacy rows
+without owner (see `NotifiedRide.owner`). Both are read as separate scans of
+`notified_owner_time_idx` and merged; an OR across both would lose the index order.
+
+Rides whose outbox message became a dead letter (scheduler.outbox) keep their row - it is
+still their dedup record - but `history_entries` marks them as not delivered.
+
+Retention (`prune_history`) deletes rows older than HERTZ_HISTORY_RETENTION_DAYS in
+batches, but only for rides whose latest return has passed: a row is also the dedup record
+of a ride that may still be listed, and deleting it would notify that ride again. Rows
+without a latest return (older rows, malformed upstream dates) go by their pickup time, or by
+their age alone when that is missing too.
+"""
+
+import base64, datetime, heapq, logging
+from django.conf import settings
+from django.db import connection
+from django.db.models import Q
+from django.utils import timezone
+from .fragments import bump_history_epoch
+from .models import NotifiedRide, undelivered_pairs
+
+PRUNE_BATCH_SIZE = 5000
+
+
+def encode_cursor(ride):
+    key = f'{ride.notified_at.isoformat()}|{ride.pk}'
+    return base64.urlsafe_b64encode(key.encode()).decode().rstrip('=')
+
+
+def decode_cursor(cursor):
+    """Return (notified_at, id) from a cursor; raises ValueError when it is malformed."""
+    try:
+        key = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)).decode()
+        notified_at, pk = key.split('|')
+        return datetime.datetime.fromisoformat(notified_at), int(pk)
+    except (TypeError, ValueError) as e:  # bad base64/UTF-8/format are all ValueErrors
+        raise ValueError(f'Invalid cursor: {cursor!r}') from e
+
+
+def _filtered(queryset, filters):
+    if filters.get('pickup'):
+        queryset = queryset.filter(pickup_location_name__icontains=filters['pickup'])
+    if filters.get('destination'):
+        queryset = queryset.filter(return_location_name__icontains=filters['destination'])
+    if filters.get('car_type'):
+        queryset = queryset.filter(car_type__icontains=filters['car_type'])
+    # Dates are local calendar days; compare against aware bounds so the index can be used
+    if filters.get('date_from'):
+        start = timezone.make_aware(datetime.datetime.combine(filters['date_from'], datetime.time.min))
+        queryset = queryset.filter(notified_at__gte=start)
+    if filters.get('date_to'):
+        end = timezone.make_aware(datetime.datetime.combine(filters['date_to'] + datetime.timedelta(days=1), datetime.time.min))
+        queryset = queryset.filter(notified_at__lt=end)
+    return queryset
+
+
+def history_page(user, filters=None, cursor=None, limit=50):
+    """Return (rides, next_cursor) for one page of `user`'s history, newest first.
+
+    `filters` may hold pickup / destination / car_type (substring, case-insensitive) and
+    date_from / date_to (dates, on notified_at). `next_cursor` is None on the last page.
+    """
+    queryset = _filtered(NotifiedRide.objects.all(), filters or {})
+    if cursor:
+        notified_at, pk = decode_cursor(cursor)
+        # (notified_at, id) < cursor key, written so the leading column is an index range
+        queryset = queryset.filter(notified_at__lte=notified_at).exclude(notified_at=notified_at, id__gte=pk)
+    ordering = ('-notified_at', '-id')
+    own = queryset.filter(owner=user).order_by(*ordering)[:limit + 1]
+    legacy = queryset.filter(owner__isnull=True).order_by(*ordering)[:limit + 1]
+    rides = list(heapq.merge(own, legacy, key=lambda r: (r.notified_at, r.pk), reverse=True))[:limit + 1]
+    next_cursor = encode_cursor(rides[limit - 1]) if len(rides) > limit else None
+    return rides[:limit], next_cursor
+
+
+def history_entry(ride, delivered=True):
+    """Display values of a NotifiedRide for the dashboard/history templates."""
+    return {
+        'notified_at': ride.notified_at,
+        'delivered': delivered,
+        'pickup_location_name': ride.pickup_location_name,
+        'return_location_name': ride.return_location_name,
+        'available_at': ride.available_at,
+        'latest_return': ride.latest_return,
+        'car_type': ride.car_type,
+        'distance': ride.distance,
+        'travel_time_hours': round(ride.travel_time / 60, 1) if ride.travel_time else None,
+    }
+
+
+def history_entries(rides):
+    """`history_entry` of each ride, with dead-lettered ones marked as not delivered (one query)."""
+    undelivered = undelivered_pairs(ride.ride_id for ride in rides)
+    return [history_entry(ride, (ride.owner_id, ride.ride_id) not in undelivered) for ride in rides]
+
+
+def prune_history(days=None, batch_size=PRUNE_BATCH_SIZE, dry_run=False):
+    """Delete history rows older than `days` whose ride can no longer be listed; returns the count."""
+    days = settings.HERTZ_HISTORY_RETENTION_DAYS if days is None else days
+    if not days:
+        return 0
+    now = timezone.now()
+    over = (Q(latest_return__lt=now)
+            | Q(latest_return__isnull=True, available_at__lt=now)
+            | Q(latest_return__isnull=True, available_at__isnull=True))
+    expired = NotifiedRide.objects.filter(over, notified_at__lt=now - datetime.timedelta(days=days))
+    if dry_run:
+        return expired.count()
+    deleted = 0
+    while True:
+        # Small batches keep each DELETE short instead of locking a large range at once
+        ids = list(expired.order_by('notified_at').values_list('id', flat=True)[:batch_size])
+        if not ids:
+            break
+        deleted += NotifiedRide.objects.filter(id__in=ids).delete()[0]
+    if deleted:
+        bump_history_epoch()
+        logging.info('Pruned %s notification history rows older than %s days', deleted, days)
+    return deleted
+
+
+def compact_history():
+    """Reclaim space and refresh planner statistics after a large prune (PostgreSQL only)."""
+    if connection.vendor != 'postgresql':
+        return False
+    with connection.cursor() as cursor:
+        cursor.execute(f'VACUUM ANALYZE {NotifiedRide._meta.db_table}')
+    return True
@@ -0,0 +1,88 @@
+"""Live availability push for open dashboards.
+
+After each poll `check_hertz` publishes a small event (snapshot version + route delta) on a
+Redis pub/sub channel. The dashboard's `live_stream` view relays it to the browser as
+Server-Sent Events, enriched with the connected user's per-search match counts computed
+from the cached snapshot, so an open page stays current without re-rendering, without any
+upstream call and without DB queries after the initial connect.
+"""
+
+import json, logging
+from django.conf import settings
+from .routes import Route
+from .snapshot import snapshot_locations
+
+SNAPSHOT_CHANNEL = 'hertz:snapshot-events'
+
+_redis = None
+
+
+def get_redis():
+    """Shared redis-py client for pub/sub (the Django cache API has no pub/sub)."""
+    global _redis
+    if _redis is None:
+        import redis  # deferred: only publishing and the live stream need it
+        _redis = redis.Redis.from_url(settings.REDIS_URL)
+    return _redis
+
+
+def route_summary(route: Route):
+    return {
+        'id': route.id,
+        'origin': route.pickup_location.name,
+        'destination': route.return_location.name,
+        'available_at': route.available_at_display,
+        'latest_return': route.latest_return_display,
+        'car_model': route.car_model,
+    }
+
+
+def publish_snapshot_event(snapshot):
+    """Announce a newly published snapshot to every open dashboard (best effort)."""
+    delta = snapshot.get('delta') or {}
+    event = {
+        'version': snapshot['version'],
+        'fetched_at': snapshot['fetched_at'].isoformat(),
+        'added': delta.get('added', []),
+        'changed': delta.get('changed', []),
+        'removed': delta.get('removed', []),
+    }
+    from redis import RedisError
+    try:
+        get_redis().publish(SNAPSHOT_CHANNEL, json.dumps(event))
+    except RedisError as e:
+        logging.warning('Could not publish snapshot event: %s', e)
+
+
+def live_state(snapshot, matcher, event=None):
+    """Per-user view of a snapshot: match counts per search plus (optionally) the delta.
+
+    `event` is the pub/sub message that announced the snapshot; its added/changed route ids
+    are expanded into display summaries (`updated`) with this user's match count per route.
+    """
+    routes = snapshot['routes'] if snapshot else []
+    matcher = matcher.for_locations(snapshot_locations(snapshot))
+    search_match_counts = {search.id: 0 for search in matcher.searches}
+    matches_by_route = {}
+    for route in routes:
+        matches = matcher.match(route.pickup_location, route.return_location,
+                                route.pickup_date, route.return_date)
+        if matches:
+            matches_by_route[route.id] = len(matches)
+            for search in matches:
+                search_match_counts[search.id] += 1
+    state = {
+        'version': snapshot['version'] if snapshot else None,
+        'fetched_at': snapshot['fetched_at'].isoformat() if snapshot else None,
+        'total_routes': len(routes),
+        'matching_routes': len(matches_by_route),
+        'search_match_counts': search_match_counts,
+    }
+    if event is not None:
+        wanted = set(event.get('added', [])) | set(event.get('changed', []))
+        state['updated'] = [
+            dict(route_summary(route), matches=matches_by_route.get(route.id, 0))
+            for route in routes if route.id in wanted
+        ]
+        state['removed'] = event.get('removed', [])
+    return state
@@ -0,0 +1,154 @@
+"""Normalised location index for search matching.
+
+Upstream location names are long and inconsistent ("Gävle Bilbolaget / Self Service Kiosk",
+"Göteborg Landvetter Flygplats"), so matching search patterns against the raw name alone
+misses on diacritics, city-vs-station naming and typos. `LocationIndex` is built once per
+route snapshot from every pickup/return location (name, city, tracCode) and resolves a
+search pattern to the set of locations it means:
+
+    * `*` wildcards       -> regex over the accent-folded name / city / code, evaluated once
+                             per distinct location (not per route)
+    * whole name, city or tracCode ("gavle", "SWGVX61") -> hash lookup on the folded key
+    * and / or            -> every word must match a word of the location's name or city,
+                             exactly or, when no location has that word, within a small edit
+                             distance ("Götebrog" finds Göteborg); candidates come from a
+                             trigram index over the word vocabulary, so only a handful of
+                             words are ever compared
+
+A `geo.Near` key instead of a pattern resolves to the stations within a radius, through a
+GeoGrid over the locations' coordinates built on the first such query.
+
+`SearchMatcher` (scheduler.matching) resolves each distinct pattern once and inverts the
+result into location -> searches, so the per-route match stays a dict lookup.
+"""
+
+import re, unicodedata
+from functools import lru_cache
+from .geo import GeoGrid, Near
+
+# Letters NFKD does not decompose into base letter + accent
+_FOLD_EXTRA = str.maketrans({'ø': 'o', 'æ': 'ae', 'đ': 'd', 'ł': 'l', 'þ': 'th'})
+_WORD = re.compile(r'[a-z0-9]+')
+MIN_FUZZY_LENGTH = 4  # shorter words must match exactly
+
+
+@lru_cache(maxsize=8192)
+def fold(text):
+    """Lower-case `text` and strip accents: 'Gävle Bilbolaget' -> 'gavle bilbolaget'."""
+    decomposed = unicodedata.normalize('NFKD', text.casefold().translate(_FOLD_EXTRA))
+    return ''.join(c for c in decomposed if not unicodedata.combining(c))
+
+
+def words(text):
+    return _WORD.findall(fold(text))
+
+
+def max_typos(word):
+    """Edit distance tolerated for a search word: none below 4 letters, 1 up to 7, then 2."""
+    if len(word) < MIN_FUZZY_LENGTH:
+        return 0
+    return 1 if len(word) < 8 else 2
+
+
+def _trigrams(word):
+    padded = f'${word}$'
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+def within_distance(a, b, limit):
+    """True when the Levenshtein distance of `a` and `b` is at most `limit`."""
+    if abs(len(a) - len(b)) > limit:
+        return False
+    previous = list(range(len(b) + 1))
+    for i, ca in enumerate(a, 1):
+        current = [i]
+        for j, cb in enumerate(b, 1):
+            current.append(min(previous[j] + 1, current[j - 1] + 1, previous[j - 1] + (ca != cb)))
+        if min(current) > limit:
+            return False  # every alignment already exceeds the limit
+        previous = current
+    return previous[-1] <= limit
+
+
+class LocationIndex:
+    """Searchable index over a fixed set of `routes.Location` records."""
+
+    def __init__(self, locations):
+        self.locations = list(dict.fromkeys(locations))              # unique, stable order
+        self.positions = {location: i for i, location in enumerate(self.locations)}
+        self._all = frozenset(range(len(self.locations)))
+        self._folded = []                                            # per location: (name, city, code)
+        self._keys = {}                                              # folded name / city / code -> {positions}
+        self._words = {}                                             # word of name or city -> {positions}
+        self._trigrams = {}                                          # trigram -> {words}
+        self._resolved = {}                                          # pattern -> frozenset of positions
+        self._grid = None                                            # GeoGrid, built on first radius query
+        for i, location in enumerate(self.locations):
+            folded = (fold(location.name), fold(location.city), fold(location.trac_code))
+            self._folded.append(folded)
+            for key in folded:
+                if key:
+                    self._keys.setdefault(key, set()).add(i)
+            for word in words(location.name) + words(location.city):
+                if word not in self._words:
+                    self._words[word] = set()
+                    for trigram in _trigrams(word):
+                        self._trigrams.setdefault(trigram, set()).add(word)
+                self._words[word].add(i)
+
+    @classmethod
+    def from_routes(cls, routes):
+        return cls(location for route in routes for location in (route.pickup_location, route.return_location))
+
+    def resolve(self, pattern):
+        """Positions (into `self.locations`) of the locations `pattern` (or a `geo.Near`) matches."""
+        hits = self._resolved.get(pattern)
+        if hits is None:
+            if isinstance(pattern, Near):
+                hits = self._resolved[pattern] = frozenset(self._near(pattern))
+            else:
+                hits = self._resolved[pattern] = frozenset(self._resolve(pattern.strip()))
+        return hits
+
+    def _near(self, near):
+        if self._grid is None:
+            self._grid = GeoGrid((i, (location.lat, location.lon)) for i, location in enumerate(self.locations)
+                                 if location.lat is not None and location.lon is not None)
+        return self._grid.within(near.lat, near.lon, near.radius_km)
+
+    def _resolve(self, pattern):
+        if not pattern.strip('*'):
+            return self._all
+        folded = fold(pattern)
+        if '*' in folded:
+            regex = re.compile(re.escape(folded).replace('\\*', '.*'))
+            return {i for i, keys in enumerate(self._folded) if any(key and regex.fullmatch(key) for key in keys)}
+        # Exact name / city / code, plus locations whose name or city has all the words
+        # ("Göteborg" is the city of some stations and part of the name of others)
+        hits = None
+        for word in words(pattern):
+            positions = self._word_positions(word)
+            hits = positions if hits is None else hits & positions
+            if not hits:
+                break
+        return self._keys.get(folded, set()) | (hits or set())
+
+    def _word_positions(self, word):
+        # A word that exists is taken literally ("Visby" must not also find "Väsby")
+        if word in self._words:
+            return self._words[word]
+        limit = max_typos(word)
+        if not limit:
+            return set()
+        grams = _trigrams(word)
+        # q-gram lemma: each edit destroys at most 3 trigrams, so close words share the rest
+        needed = len(grams) - 3 * limit
+        shared = {}
+        for gram in grams:
+            for candidate in self._trigrams.get(gram, ()):
+                shared[candidate] = shared.get(candidate, 0) + 1
+        positions = set()
+        for candidate, count in shared.items():
+            if count >= needed and within_distance(word, candidate, limit):
+                positions |= self._words[candidate]
+        return positions
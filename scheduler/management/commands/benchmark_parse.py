@@ -0,0 +1,49 @@
+"""Compare full `json.loads` parsing with the streaming Route parser.
+
+Usage:
+    python manage.py benchmark_parse [--file hertz_api_example.json] [--repeat 20]
+
+"before" is what fetch_routes used to do (read the whole body, build every nested dict),
+"after" is `scheduler.routes.parse_routes` reading the same file as a stream.
+"""
+
+import json, pickle, statistics, time, tracemalloc
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from scheduler.routes import parse_routes
+
+
+def _full_parse(path):
+    with open(path, 'rb') as f:
+        return json.loads(f.read())
+
+
+def _stream_parse(path):
+    with open(path, 'rb') as f:
+        return parse_routes(f)
+
+
+class Command(BaseCommand):
+    help = 'Benchmark peak memory and parse time of the transport-routes payload (full vs. streaming)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--file', default=str(settings.BASE_DIR / 'hertz_api_example.json'))
+        parser.add_argument('--repeat', type=int, default=20)
+
+    def handle(self, *args, **options):
+        path, repeat = options['file'], options['repeat']
+        self.stdout.write(f'{path} ({repeat} runs each)')
+        self.stdout.write(f"{'':8}{'median ms':>12}{'peak KiB':>12}{'snapshot KiB':>14}")
+        for label, parse in (('before', _full_parse), ('after', _stream_parse)):
+            timings = []
+            for _ in range(repeat):
+                started = time.perf_counter()
+                parse(path)
+                timings.append((time.perf_counter() - started) * 1000)
+            tracemalloc.start()
+            result = parse(path)
+            _, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            # What a snapshot of this result costs in the shared cache
+            stored = len(pickle.dumps(result, protocol=pickle.HIGHEST_PROTOCOL))
+            self.stdout.write(f'{label:8}{statistics.median(timings):>12.1f}{peak / 1024:>12.0f}{stored / 1024:>14.0f}')
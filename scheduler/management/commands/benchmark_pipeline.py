@@ -0,0 +1,271 @@
+"""Benchmark the poll → match → notify pipeline and the dashboard against local stand-ins.
+
+Usage:
+    python manage.py benchmark_pipeline [--routes 10000] [--users 20] [--searches 5]
+                                        [--churn 0.05] [--digest-ratio 0.5] [--repeat 3]
+                                        [--output results.json]
+
+Everything runs against throwaway resources: a test database (created and destroyed the
+way the test runner does it), a local-memory cache and an in-process HTTP server that plays
+both the Hertz transport-routes API and Pushover. The API serves the routes of
+`hertz_api_example.json`, cycled up to --routes with unique ids.
+
+Scenarios (in this order, the whole sequence --repeat times):
+    cold       first poll: no poll state, every match is new and gets notified
+    unchanged  next poll, upstream answers 304
+    churn      --churn of the routes replaced by new ones
+    dashboard  one seeded user's dashboard render (fragments rendered after the churn poll)
+    dashboard_cached  the same render again, served from the fragment cache
+
+For each scenario the report lists wall time, total queries, per-stage seconds/queries
+(see `scheduler.timing`), Pushover requests and the process' peak RSS. Times are medians over
+the repeats. `--output` writes the same report as JSON (`-` for stdout) for tracking over time.
+"""
+
+import json, os, platform, random, resource, statistics, sys, threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from unittest import mock
+import django
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.cache import cache
+from django.core.management.base import BaseCommand
+from django.db import connection
+from django.test import RequestFactory, override_settings
+from hertz_notifier.celery import app
+from scheduler import tasks
+from scheduler.models import NotificationProfile, NotifiedRide, SavedSearch
+from scheduler.routes import parse_routes
+from scheduler.timing import collect_stages, stage
+from scheduler.views import dashboard
+
+SCENARIOS = ('cold', 'unchanged', 'churn', 'dashboard', 'dashboard_cached')
+
+
+class _Stub(BaseHTTPRequestHandler):
+    """GET /routes -> current payload (honours If-None-Match), POST /pushover -> accepted."""
+
+    protocol_version = 'HTTP/1.1'  # keep-alive, like the real endpoints
+    wbufsize = -1                  # one send per response (flushed after each request) ...
+    disable_nagle_algorithm = True # ... and no delayed-ACK stalls between requests
+
+    def do_GET(self):
+        server = self.server
+        if self.headers.get('If-None-Match') == server.etag:
+            self.send_response(304)
+            self.send_header('ETag', server.etag)
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(server.payload)))
+        self.send_header('ETag', server.etag)
+        self.end_headers()
+        self.wfile.write(server.payload)
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get('Content-Length') or 0))
+        with self.server.lock:
+            self.server.pushover_requests += 1
+        body = b'{"status":1,"request":"benchmark"}'
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header('X-Limit-App-Remaining', '10000')
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+def _payload(template_routes, count, first_id):
+    """Transport-routes JSON with `count` routes cycled from the template, ids from `first_id`.
+
+    Route content depends only on the id, so two payloads overlap exactly in their shared ids.
+    """
+    items = {}
+    for route_id in range(first_id, first_id + count):
+        route = dict(template_routes[(route_id - 1) % len(template_routes)], id=route_id)
+        key = (route['pickupLocation']['name'], route['returnLocation']['name'])
+        item = items.setdefault(key, {'pickupLocationName': key[0], 'returnLocationName': key[1], 'routes': []})
+        item['routes'].append(route)
+    return json.dumps(list(items.values())).encode()
+
+
+def _search_patterns(route, rng):
+    """A mix of the pattern kinds SearchMatcher indexes differently (literal, prefix, infix, *)."""
+    origin, destination = route.pickup_location.name, route.return_location.name
+    word = rng.choice(destination.split() or ['*'])
+    return rng.choice([
+        (origin, '*'),
+        (origin.split()[0] + '*', '*'),
+        ('*', destination),
+        ('*', f'*{word}*'),
+        (origin.split()[0] + '*', destination.split()[0] + '*'),
+    ])
+
+
+def _peak_rss_kib():
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak // 1024 if sys.platform == 'darwin' else peak  # bytes on macOS, KiB on Linux
+
+
+class Command(BaseCommand):
+    help = 'Benchmark check_hertz and the dashboard with seeded users/searches against local API and Pushover stubs'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--file', default=str(settings.BASE_DIR / 'hertz_api_example.json'))
+        parser.add_argument('--routes', type=int, default=0, help='Routes to serve (default: as in --file)')
+        parser.add_argument('--users', type=int, default=20)
+        parser.add_argument('--searches', type=int, default=5, help='Saved searches per user')
+        parser.add_argument('--churn', type=float, default=0.05, help='Fraction of routes replaced in the churn poll')
+        parser.add_argument('--digest-ratio', type=float, default=0.0, help='Fraction of users with digest enabled')
+        parser.add_argument('--repeat', type=int, default=1)
+        parser.add_argument('--seed', type=int, default=1)
+        parser.add_argument('--output', help='Write the JSON report to this path (- for stdout)')
+
+    def handle(self, *args, **options):
+        with open(options['file'], 'rb') as f:
+            template = [route for item in json.load(f) for route in item['routes']]
+        count = options['routes'] or len(template)
+
+        server = ThreadingHTTPServer(('127.0.0.1', 0), _Stub)
+        server.lock = threading.Lock()
+        server.pushover_requests = 0
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        base_url = f'http://127.0.0.1:{server.server_port}'
+
+        old_db_name = connection.settings_dict['NAME']
+        connection.creation.create_test_db(verbosity=0, autoclobber=True, serialize=False)
+        eager = app.conf.task_always_eager
+        app.conf.task_always_eager = True  # drain_outbox runs inline, so its stages are measured too
+        try:
+            with override_settings(
+                # No culling: evicting the snapshot or poll state would skew the next scenario
+                CACHES={'default': {
+                    'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+                    'OPTIONS': {'MAX_ENTRIES': sys.maxsize},
+                }},
+                HERTZ_API_URL=f'{base_url}/routes',
+                PUSHOVER_API_URL=f'{base_url}/pushover',
+            ), mock.patch.dict(os.environ, {'PUSHOVER_USER': 'benchmark', 'PUSHOVER_TOKEN': 'benchmark'}), \
+                    mock.patch.object(tasks, 'publish_snapshot_event'):  # keep real dashboards out of it
+                user = self._seed(options)
+                runs = [self._run_sequence(server, template, count, user, options) for _ in range(options['repeat'])]
+        finally:
+            app.conf.task_always_eager = eager
+            connection.creation.destroy_test_db(old_db_name, verbosity=0)
+            server.shutdown()
+
+        report = {
+            'config': {
+                'routes': count,
+                'users': options['users'],
+                'searches_per_user': options['searches'],
+                'churn': options['churn'],
+                'digest_ratio': options['digest_ratio'],
+                'repeat': options['repeat'],
+            },
+            'environment': {
+                'python': platform.python_version(),
+                'django': django.get_version(),
+                'database': connection.vendor,
+            },
+            'scenarios': {name: self._aggregate([run[name] for run in runs]) for name in SCENARIOS},
+            'peak_rss_kib': _peak_rss_kib(),
+        }
+        if options['output'] == '-':
+            self.stdout.write(json.dumps(report, indent=2))
+            return
+        if options['output']:
+            with open(options['output'], 'w') as f:
+                json.dump(report, f, indent=2)
+        self._print(report)
+
+    def _seed(self, options):
+        """Create --users users with --searches searches each; return the first user."""
+        rng = random.Random(options['seed'])
+        with open(options['file'], 'rb') as f:
+            routes = [route for route in parse_routes(f) if route.pickup_date and route.return_date]
+        User = get_user_model()
+        User.objects.bulk_create(User(username=f'bench-{n}') for n in range(options['users']))
+        users = list(User.objects.filter(username__startswith='bench-').order_by('id'))
+        searches = []
+        for user in users:
+            for _ in range(options['searches']):
+                route = rng.choice(routes)
+                origin, destination = _search_patterns(route, rng)
+                searches.append(SavedSearch(
+                    owner=user, origin=origin, destination=destination,
+                    date_from=route.pickup_date, date_to=route.return_date,
+                ))
+        SavedSearch.objects.bulk_create(searches)
+        digest_users = users[:round(len(users) * options['digest_ratio'])]
+        NotificationProfile.objects.bulk_create(NotificationProfile(user=user, digest=True) for user in digest_users)
+        return users[0]
+
+    def _run_sequence(self, server, template, count, user, options):
+        NotifiedRide.objects.all().delete()
+        cache.clear()
+        server.payload, server.etag = _payload(template, count, 1), '"v1"'
+        poll = lambda: tasks.check_hertz(force=True)  # bypass the adaptive schedule
+        results = {}
+        results['cold'] = self._measure(server, poll)
+        results['unchanged'] = self._measure(server, poll)
+        replaced = int(count * options['churn'])
+        server.payload = _payload(template, count, 1 + replaced)  # first `replaced` ids gone, as many new ones
+        server.etag = '"v2"'
+        results['churn'] = self._measure(server, poll)
+        request = RequestFactory().get('/')
+        request.user = user
+        results['dashboard'] = self._measure(server, lambda: dashboard(request))
+        results['dashboard_cached'] = self._measure(server, lambda: dashboard(request))
+        return results
+
+    def _measure(self, server, func):
+        sent = server.pushover_requests
+        with collect_stages() as stages:
+            with stage('total'):
+                func()
+        total = stages.pop('total')
+        return {
+            'seconds': total['seconds'],
+            'queries': total['queries'],
+            'pushover_requests': server.pushover_requests - sent,
+            'stages': stages,
+            'peak_rss_kib': _peak_rss_kib(),
+        }
+
+    def _aggregate(self, runs):
+        stage_names = {name for run in runs for name in run['stages']}
+        return {
+            'seconds': statistics.median(run['seconds'] for run in runs),
+            'queries': max(run['queries'] for run in runs),
+            'pushover_requests': max(run['pushover_requests'] for run in runs),
+            'stages': {
+                name: {
+                    'seconds': statistics.median(run['stages'].get(name, {}).get('seconds', 0.0) for run in runs),
+                    'queries': max(run['stages'].get(name, {}).get('queries', 0) for run in runs),
+                }
+                for name in sorted(stage_names)
+            },
+            'peak_rss_kib': max(run['peak_rss_kib'] for run in runs),
+        }
+
+    def _print(self, report):
+        config = report['config']
+        self.stdout.write(
+            f"{config['routes']} routes, {config['users']} users × {config['searches_per_user']} searches, "
+            f"{config['repeat']} run(s), {report['environment']['database']}"
+        )
+        self.stdout.write(f"{'':18}{'ms':>10}{'queries':>9}{'pushover':>10}{'peak RSS MiB':>14}  stages (ms/queries)")
+        for name, result in report['scenarios'].items():
+            stages = ', '.join(
+                f"{stage_name} {values['seconds'] * 1000:.1f}/{values['queries']}"
+                for stage_name, values in result['stages'].items()
+            )
+            self.stdout.write(
+                f"{name:18}{result['seconds'] * 1000:>10.1f}{result['queries']:>9}{result['pushover_requests']:>10}"
+                f"{result['peak_rss_kib'] / 1024:>14.1f}  {stages}"
+            )
@@ -0,0 +1,91 @@
+"""One-shot setup run by the app container before it starts serving.
+
+Usage:
+    python manage.py prepare_app [--timeout 120] [--force]
+
+Does in one process what the entrypoint used to do with five `manage.py` runs, and skips
+every step that has nothing to do:
+
+    1. wait for the database (see wait_for_db)
+    2. migrate           - only when there are unapplied migrations (the plan is computed from
+                           the migration table, no DDL is touched otherwise)
+    3. superuser         - DJANGO_SUPERUSER_USERNAME / _PASSWORD, when it does not exist yet
+    4. collectstatic     - only when the static sources changed since the last collection:
+                           a fingerprint of every source file (path, size, mtime) plus the
+                           storage backend is kept in STATIC_ROOT/.collectstatic-fingerprint
+
+Migrations are no longer generated at boot: they are committed with the model changes.
+--force runs migrate and collectstatic regardless.
+"""
+
+import hashlib, os
+from pathlib import Path
+from django.conf import settings
+from django.contrib.staticfiles.finders import get_finders
+from django.core.management import call_command
+from django.core.management.base import BaseCommand
+from django.db import DEFAULT_DB_ALIAS, connections
+from django.db.migrations.executor import MigrationExecutor
+from .wait_for_db import wait_for_db
+
+STATIC_FINGERPRINT_FILE = '.collectstatic-fingerprint'
+
+
+def pending_migrations(alias=DEFAULT_DB_ALIAS):
+    executor = MigrationExecutor(connections[alias])
+    return executor.migration_plan(executor.loader.graph.leaf_nodes())
+
+
+def static_fingerprint():
+    """Digest of every file collectstatic would copy, and of where it would copy them to."""
+    digest = hashlib.sha256(repr((getattr(settings, 'STATICFILES_STORAGE', None),
+                                  settings.STORAGES.get('staticfiles'))).encode())
+    entries = []
+    for finder in get_finders():
+        for path, storage in finder.list(['CVS', '.*', '*~']):
+            stat = os.stat(storage.path(path))
+            entries.append(f'{path}\0{stat.st_size}\0{stat.st_mtime_ns}')
+    for entry in sorted(entries):
+        digest.update(entry.encode() + b'\n')
+    return digest.hexdigest()
+
+
+class Command(BaseCommand):
+    help = 'Wait for the database, then migrate / create the superuser / collect static only when needed'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--timeout', type=float, default=120, help='Seconds to wait for the database')
+        parser.add_argument('--force', action='store_true', help='Run migrate and collectstatic even when unchanged')
+
+    def handle(self, *args, **options):
+        waited = wait_for_db(options['timeout'], log=self.stdout.write)
+        self.stdout.write(f'Database is ready (waited {waited:.1f}s)')
+
+        plan = pending_migrations()
+        if plan or options['force']:
+            self.stdout.write(f'Applying {len(plan)} migrations...')
+            call_command('migrate', interactive=False, verbosity=options['verbosity'])
+        else:
+            self.stdout.write('Migrations up to date, skipping migrate')
+
+        self._ensure_superuser()
+
+        stamp = Path(settings.STATIC_ROOT) / STATIC_FINGERPRINT_FILE
+        fingerprint = static_fingerprint()
+        if options['force'] or not stamp.exists() or stamp.read_text().strip() != fingerprint:
+            self.stdout.write('Collecting static files...')
+            call_command('collectstatic', interactive=False, verbosity=options['verbosity'])
+            stamp.parent.mkdir(parents=True, exist_ok=True)
+            stamp.write_text(fingerprint)
+        else:
+            self.stdout.write('Static files unchanged, skipping collectstatic')
+
+    def _ensure_superuser(self):
+        from django.contrib.auth.models import User
+        username = os.environ.get('DJANGO_SUPERUSER_USERNAME', 'admin')
+        password = os.environ.get('DJANGO_SUPERUSER_PASSWORD', 'admin123')
+        if not User.objects.filter(username=username).exists():
+            User.objects.create_superuser(username, f'{username}@example.com', password)
+            self.stdout.write(f'Superuser created: {username}/{password}')
+        else:
+            self.stdout.write('Superuser already exists')
@@ -0,0 +1,45 @@
+"""Profile the next check_hertz run in whichever worker executes it.
+
+Usage:
+    python manage.py profile_poll [--interval 5] [--timeout 600] [--output poll.folded]
+
+Arms a one-off request in the shared cache (see `scheduler.profiling`), waits for the next
+scheduled poll to finish and writes its sampled stacks in folded format, ready for e.g.
+`flamegraph.pl poll.folded > poll.svg` or https://www.speedscope.app. The hottest
+functions (by samples where they were on top of the stack) are printed as a summary.
+"""
+
+import time
+from collections import Counter
+from django.core.management.base import BaseCommand, CommandError
+from scheduler.profiling import cancel_profile_request, collected_profile, request_profile
+
+
+class Command(BaseCommand):
+    help = 'Capture a sampling profile (folded stacks) of the next check_hertz poll'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--interval', type=float, default=5, help='Sampling interval in milliseconds')
+        parser.add_argument('--timeout', type=float, default=600, help='Seconds to wait for the next poll')
+        parser.add_argument('--output', default=f'poll-{time.strftime("%Y%m%d-%H%M%S")}.folded')
+
+    def handle(self, *args, **options):
+        if not request_profile(options['interval'] / 1000):
+            raise CommandError('A profile request is already pending')
+        self.stdout.write('Waiting for the next poll...')
+        deadline = time.monotonic() + options['timeout']
+        while (profile := collected_profile()) is None:
+            if time.monotonic() > deadline:
+                cancel_profile_request()
+                raise CommandError('No poll ran within the timeout (is the worker running?)')
+            time.sleep(1)
+
+        with open(options['output'], 'w') as f:
+            f.write(profile['folded'])
+        self.stdout.write(f"{profile['samples']} samples over {profile['duration'] * 1000:.0f} ms -> {options['output']}")
+        leaves = Counter()
+        for line in profile['folded'].splitlines():
+            stack, count = line.rsplit(' ', 1)
+            leaves[stack.rsplit(';', 1)[-1]] += int(count)
+        for frame, count in leaves.most_common(10):
+            self.stdout.write(f'{count:>7}  {frame}')
@@ -0,0 +1,30 @@
+"""Delete old notification history now instead of waiting for the daily beat task.
+
+Usage:
+    python manage.py prune_history [--days 180] [--dry-run] [--vacuum]
+
+Only rows older than --days (default HERTZ_HISTORY_RETENTION_DAYS) whose ride has already been
+returned are deleted, see `scheduler.history.prune_history`. --vacuum runs VACUUM ANALYZE
+afterwards on PostgreSQL to give the space back and refresh planner statistics.
+"""
+
+from django.core.management.base import BaseCommand
+from scheduler.history import compact_history, prune_history
+
+
+class Command(BaseCommand):
+    help = 'Delete notification history older than the retention period'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--days', type=int, default=None, help='Retention in days (0 keeps everything)')
+        parser.add_argument('--dry-run', action='store_true', help='Only count the rows that would be deleted')
+        parser.add_argument('--vacuum', action='store_true', help='VACUUM ANALYZE the table afterwards (PostgreSQL)')
+
+    def handle(self, *args, **options):
+        count = prune_history(options['days'], dry_run=options['dry_run'])
+        self.stdout.write(f"{'Would delete' if options['dry_run'] else 'Deleted'} {count} history rows")
+        if options['vacuum'] and not options['dry_run']:
+            if compact_history():
+                self.stdout.write('Vacuumed the history table')
+            else:
+                self.stdout.write('Skipped vacuum (not PostgreSQL)')
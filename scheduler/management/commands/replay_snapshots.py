@@ -0,0 +1,308 @@
+"""Replay recorded upstream payloads through the whole poll pipeline, offline.
+
+Usage:
+    python manage.py replay_snapshots [SOURCE ...] [--since ISO] [--until ISO] [--speed 0]
+                                      [--country SWEDEN] [--start ISO] [--interval 120]
+                                      [--fixture searches.json] [--show-messages]
+                                      [--output report.json]
+
+SOURCE is a recording directory (default HERTZ_RECORD_DIR, see scheduler.recordings;
+--since / --until select a time range of it) or payload files in the `hertz_api_example.json`
+format (.json or .json.gz, or a directory of them), replayed in the order given as --country,
+--interval seconds apart from --start (default: now).
+
+Every recorded poll becomes one `check_hertz` run against throwaway resources, like
+benchmark_pipeline: a test database, a local-memory cache and an in-process server that plays
+the Hertz API (each country's latest recorded payload with its digest as ETag, so an unchanged
+market answers 304 as upstream would) and Pushover (accepts everything). The saved searches,
+their owners and notification settings are copied from the configured database, or loaded from
+--fixture (`manage.py dumpdata auth.user scheduler.savedsearch scheduler.notificationprofile`).
+
+The clock is virtual: each poll runs at its recording time, so a replay matches and sends the
+same whatever its pace. --speed only paces the wall clock (60 plays an hour of recordings in a
+minute; 0, the default, does not wait).
+
+The report lists per poll its routes, churn, matches, queued rides, Pushover requests, wall time
+and per-stage seconds/queries (see `scheduler.timing`); match shards (HERTZ_MATCH_SHARD_SIZE) run
+inline, so sharded polls report their combined matches too; --show-messages adds every message
+that would have been sent. `--output` writes the whole report, messages included, as JSON (- for stdout).
+"""
+
+import datetime, gzip, json, os, sys, threading, time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from unittest import mock
+from urllib.parse import parse_qs, urlsplit
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.management import call_command
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.test import override_settings
+from django.utils import timezone
+from django.utils.html import strip_tags
+from hertz_notifier.celery import app
+from scheduler import tasks, utils
+from scheduler.models import NotificationProfile, NotifiedRide, OutboxMessage, SavedSearch
+from scheduler.recordings import INDEX_FILE, load_payload, payload_digest, read_index
+from scheduler.timing import collect_stages, stage
+
+
+class _Stub(BaseHTTPRequestHandler):
+    """GET /routes?country=X -> that country's current payload (honours If-None-Match; 404
+    before its first recording), POST /pushover -> accepted."""
+
+    protocol_version = 'HTTP/1.1'
+    wbufsize = -1
+    disable_nagle_algorithm = True
+
+    def do_GET(self):
+        country = parse_qs(urlsplit(self.path).query).get('country', [''])[0]
+        current = self.server.payloads.get(country)
+        if current is None:
+            self._respond(404, b'{"error":"not recorded"}')
+        elif self.headers.get('If-None-Match') == current[0]:
+            self._respond(304, b'', etag=current[0])
+        else:
+            self._respond(200, current[1], etag=current[0])
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get('Content-Length') or 0))
+        with self.server.lock:
+            self.server.pushover_requests += 1
+        self._respond(200, b'{"status":1,"request":"replay"}', limit='10000')
+
+    def _respond(self, status, body, etag=None, limit=None):
+        self.send_response(status)
+        if etag:
+            self.send_header('ETag', etag)
+        if limit:
+            self.send_header('X-Limit-App-Remaining', limit)
+        if status != 304:
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+def _read_file(path):
+    with open(path, 'rb') as f:
+        data = f.read()
+    return gzip.decompress(data) if str(path).endswith('.gz') else data
+
+
+def _parse_time(value):
+    if value is None:
+        return None
+    at = datetime.datetime.fromisoformat(value)
+    return at if timezone.is_aware(at) else timezone.make_aware(at)
+
+
+def _message_text(message):
+    return strip_tags(message.replace('<br>', ' / ')).strip(' /')
+
+
+class Command(BaseCommand):
+    help = 'Replay recorded Hertz payloads through check_hertz offline (stubbed API and Pushover, virtual clock)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('source', nargs='*', help='Recording directory (default HERTZ_RECORD_DIR) or payload files')
+        parser.add_argument('--since', help='Only recorded polls at or after this ISO time')
+        parser.add_argument('--until', help='Only recorded polls at or before this ISO time')
+        parser.add_argument('--country', default=None, help='Country of plain payload files (default: first of HERTZ_COUNTRIES)')
+        parser.add_argument('--start', help='Virtual time of the first plain payload file (ISO, default now)')
+        parser.add_argument('--interval', type=float, default=settings.HERTZ_CHECK_INTERVAL,
+                            help='Seconds between plain payload files')
+        parser.add_argument('--speed', type=float, default=0, help='Wall-clock pacing factor (0: as fast as possible)')
+        parser.add_argument('--fixture', help='Load users/searches/profiles from this fixture instead of the database')
+        parser.add_argument('--show-messages', action='store_true', help='List every message that would have been sent')
+        parser.add_argument('--output', help='Write the JSON report to this path (- for stdout)')
+
+    def handle(self, *args, **options):
+        polls = self._polls(options)
+        if not polls:
+            raise CommandError('Nothing to replay')
+        countries = list(dict.fromkeys(country for poll in polls for country in poll['sources']))
+        # Read before switching to the test database
+        searches = None if options['fixture'] else self._live_searches()
+
+        server = ThreadingHTTPServer(('127.0.0.1', 0), _Stub)
+        server.lock = threading.Lock()
+        server.payloads = {}            # country -> (etag, payload bytes)
+        server.pushover_requests = 0
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        base_url = f'http://127.0.0.1:{server.server_port}'
+
+        clock = [polls[0]['at']]
+        old_db_name = connection.settings_dict['NAME']
+        connection.creation.create_test_db(verbosity=0, autoclobber=True, serialize=False)
+        eager = app.conf.task_always_eager
+        app.conf.task_always_eager = True  # match shards and drain_outbox run inline
+        try:
+            with override_settings(
+                CACHES={'default': {
+                    'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+                    'OPTIONS': {'MAX_ENTRIES': sys.maxsize},
+                }},
+                HERTZ_API_URL=f'{base_url}/routes',
+                HERTZ_RECORD_DIR='',  # do not record the replay
+                HERTZ_ARCHIVE_DIR='',
+                PUSHOVER_API_URL=f'{base_url}/pushover',
+            ), mock.patch.dict(os.environ, {'PUSHOVER_USER': 'replay', 'PUSHOVER_TOKEN': 'replay'}), \
+                    mock.patch.object(tasks, 'publish_snapshot_event'), \
+                    mock.patch('django.utils.timezone.now', lambda: clock[0]):
+                utils._api_session = None  # the session pool is sized for HERTZ_COUNTRIES
+                if options['fixture']:
+                    call_command('loaddata', options['fixture'], verbosity=0)
+                else:
+                    self._load_searches(*searches)
+                results, messages = self._replay(server, polls, clock, options['speed'])
+                search_count, owner_count = SavedSearch.objects.count(), SavedSearch.objects.values('owner').distinct().count()
+        finally:
+            app.conf.task_always_eager = eager
+            utils._api_session = None
+            connection.creation.destroy_test_db(old_db_name, verbosity=0)
+            server.shutdown()
+
+        report = {
+            'config': {
+                'source': options['source'] or [settings.HERTZ_RECORD_DIR],
+                'countries': countries,
+                'searches': search_count,
+                'owners': owner_count,
+                'speed': options['speed'],
+            },
+            'polls': results,
+            'totals': {
+                name: sum(result[name] or 0 for result in results)
+                for name in ('matches', 'queued', 'pushover_requests', 'seconds', 'queries')
+            },
+            'messages': messages,
+        }
+        if options['output'] == '-':
+            self.stdout.write(json.dumps(report, indent=2))
+            return
+        if options['output']:
+            with open(options['output'], 'w') as f:
+                json.dump(report, f, indent=2)
+        self._print(report, options['show_messages'])
+
+    def _polls(self, options):
+        """[{'at': virtual time, 'sources': {country: (etag, load)}}] in replay order."""
+        sources = options['source'] or ([settings.HERTZ_RECORD_DIR] if settings.HERTZ_RECORD_DIR else [])
+        if not sources:
+            raise CommandError('Pass a recording directory or payload files (or set HERTZ_RECORD_DIR)')
+        if len(sources) == 1 and (Path(sources[0]) / INDEX_FILE).exists():
+            directory = sources[0]
+            return [
+                {'at': entry['at'], 'sources': {
+                    country: (f'"{digest}"', lambda digest=digest: load_payload(directory, digest))
+                    for country, digest in entry['sources'].items()
+                }}
+                for entry in read_index(directory, _parse_time(options['since']), _parse_time(options['until']))
+            ]
+        files = []
+        for source in sources:
+            path = Path(source)
+            if path.is_dir():
+                files.extend(sorted(p for p in path.iterdir() if p.name.endswith(('.json', '.json.gz'))))
+            elif path.exists():
+                files.append(path)
+            else:
+                raise CommandError(f'No such recording or payload file: {source}')
+        country = options['country'] or settings.HERTZ_COUNTRIES[0]
+        start = _parse_time(options['start']) or timezone.now()
+        polls = []
+        for n, path in enumerate(files):
+            data = _read_file(path)
+            polls.append({
+                'at': start + datetime.timedelta(seconds=n * options['interval']),
+                'sources': {country: (f'"{payload_digest(data)}"', lambda data=data: data)},
+            })
+        return polls
+
+    def _live_searches(self):
+        searches = list(SavedSearch.objects.all())
+        users = list(get_user_model().objects.filter(id__in={search.owner_id for search in searches}))
+        profiles = list(NotificationProfile.objects.filter(user__in=users))
+        return users, searches, profiles
+
+    def _load_searches(self, users, searches, profiles):
+        # Same ids as in the source database; bulk_create skips the reverse-match signal
+        get_user_model().objects.bulk_create(users)
+        SavedSearch.objects.bulk_create(searches)
+        NotificationProfile.objects.bulk_create(profiles)
+
+    def _replay(self, server, polls, clock, speed):
+        results, messages = [], []
+        usernames = dict(get_user_model().objects.values_list('id', 'username'))
+        last_message = 0
+        started = time.monotonic()
+        for n, poll in enumerate(polls):
+            if speed:
+                # Wall time catches up with the virtual time of this poll
+                due = (poll['at'] - polls[0]['at']).total_seconds() / speed
+                time.sleep(max(0.0, due - (time.monotonic() - started)))
+            clock[0] = poll['at']
+            for country, (etag, load) in poll['sources'].items():
+                server.payloads[country] = (etag, load())
+            requests_before, rides_before = server.pushover_requests, NotifiedRide.objects.count()
+            # The markets recorded so far, as HERTZ_COUNTRIES was when they were recorded
+            with override_settings(HERTZ_COUNTRIES=list(server.payloads)), collect_stages() as stages:
+                with stage('total'):
+                    stats = tasks.check_hertz(force=True) or {}
+            total = stages.pop('total')
+            results.append({
+                'at': poll['at'].isoformat(),
+                'countries': sorted(poll['sources']),
+                'routes': stats.get('routes'),
+                'churn': stats.get('churn'),
+                'matches': stats.get('matches'),
+                'queued': NotifiedRide.objects.count() - rides_before,
+                'pushover_requests': server.pushover_requests - requests_before,
+                'error': stats.get('error'),
+                'seconds': total['seconds'],
+                'queries': total['queries'],
+                'stages': stages,
+            })
+            new = list(OutboxMessage.objects.filter(id__gt=last_message))
+            last_message = max((message.id for message in new), default=last_message)
+            # Queue order follows set iteration; sort so two replays give identical reports
+            for message in sorted(new, key=lambda message: (message.owner_id, message.ride_ids)):
+                messages.append({
+                    'poll': n,
+                    'at': poll['at'].isoformat(),
+                    'user': usernames.get(message.owner_id, message.owner_id),
+                    'title': message.title,
+                    'message': message.message,
+                    'rides': message.ride_ids,
+                    'status': message.status,
+                })
+        return results, messages
+
+    def _print(self, report, show_messages):
+        config, totals = report['config'], report['totals']
+        self.stdout.write(
+            f"{len(report['polls'])} poll(s) replayed from {', '.join(map(str, config['source']))} "
+            f"({', '.join(config['countries'])}), {config['searches']} searches of {config['owners']} users"
+        )
+        self.stdout.write(f"{'at':26}{'routes':>8}{'churn':>7}{'matches':>9}{'queued':>8}{'pushover':>10}{'ms':>9}  stages (ms/queries)")
+        for result in report['polls']:
+            stages = ', '.join(f"{name} {values['seconds'] * 1000:.1f}/{values['queries']}"
+                               for name, values in result['stages'].items())
+            # None: the poll failed, or its shards ran on a worker and reported there
+            matches = '-' if result['matches'] is None else result['matches']
+            counts = f"{result['routes'] or 0:>8}{result['churn'] or 0:>7}{matches:>9}"
+            if result['error']:
+                stages = f"error: {result['error']}"
+            self.stdout.write(f"{result['at']:26}{counts}{result['queued']:>8}{result['pushover_requests']:>10}"
+                              f"{result['seconds'] * 1000:>9.1f}  {stages}")
+        self.stdout.write(f"{'total':26}{'':>15}{totals['matches']:>9}{totals['queued']:>8}"
+                          f"{totals['pushover_requests']:>10}{totals['seconds'] * 1000:>9.1f}")
+        if show_messages:
+            for message in report['messages']:
+                self.stdout.write(f"{message['at']}  {message['user']}  [{message['status']}] "
+                                  f"{message['title'] or 'Hertz Freerider'}: {_message_text(message['message'])}")
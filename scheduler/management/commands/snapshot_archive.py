@@ -0,0 +1,107 @@
+"""Inspect, query and backfill the snapshot archive.
+
+Usage:
+    python manage.py snapshot_archive [--dir DIR] [--since ISO] [--until ISO]
+    python manage.py snapshot_archive --at ISO [--limit 20]
+    python manage.py snapshot_archive --import RECORDING_DIR
+
+Without options it lists the archive's days (polls, frames, key frames, bytes on disk) and
+times a scan of every poll in --since / --until, the way an analytics job would read it (see `scheduler.archive.SnapshotArchive.changes`).
+
+--at seeks to the last poll at or before the given time and prints its routes.
+
+--import archives a recording (HERTZ_RECORD_DIR, see scheduler.recordings) poll by poll,
+e.g. to backfill history recorded before the archive was enabled. Each recorded poll only
+holds the countries that changed, so the others carry over from earlier polls.
+"""
+
+import datetime, io, time
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+from scheduler.archive import SnapshotArchive, archive_poll
+from scheduler.recordings import load_payload, read_index
+from scheduler.routes import parse_routes
+
+
+def _parse_time(value):
+    if value is None:
+        return None
+    at = datetime.datetime.fromisoformat(value)
+    return at if timezone.is_aware(at) else timezone.make_aware(at)
+
+
+def _size(value):
+    for unit in ('B', 'KB', 'MB'):
+        if value < 1024:
+            return f'{value:.0f} {unit}'
+        value /= 1024
+    return f'{value:.1f} GB'
+
+
+class Command(BaseCommand):
+    help = 'Inspect, query and backfill the compact snapshot archive'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--dir', default=None, help='Archive directory (default HERTZ_ARCHIVE_DIR)')
+        parser.add_argument('--since', default=None, help='First poll time (ISO 8601)')
+        parser.add_argument('--until', default=None, help='Last poll time (ISO 8601)')
+        parser.add_argument('--at', default=None, help='Print the snapshot of the last poll at or before this time')
+        parser.add_argument('--limit', type=int, default=20, help='Routes printed with --at')
+        parser.add_argument('--import', dest='recording', default=None, help='Archive this recording directory')
+
+    def handle(self, *args, **options):
+        directory = options['dir'] or settings.HERTZ_ARCHIVE_DIR
+        if not directory:
+            raise CommandError('Pass --dir or set HERTZ_ARCHIVE_DIR')
+        since, until = _parse_time(options['since']), _parse_time(options['until'])
+        if options['recording']:
+            self._import(options['recording'], directory, since, until)
+        elif options['at']:
+            self._show(SnapshotArchive(directory), _parse_time(options['at']), options['limit'])
+        else:
+            self._summary(SnapshotArchive(directory), since, until)
+
+    def _import(self, recording, directory, since, until):
+        started = time.perf_counter()
+        sources, frames = {}, 0
+        entries = read_index(recording, since, until)
+        for entry in entries:
+            for country, digest in entry['sources'].items():
+                sources[country] = parse_routes(io.BytesIO(load_payload(recording, digest)))
+            frames += archive_poll([route for routes in sources.values() for route in routes], entry['at'], directory)
+        self.stdout.write(f'Archived {len(entries)} polls ({_size(frames)} of frames) in {time.perf_counter() - started:.1f}s')
+
+    def _show(self, archive, at, limit):
+        found = archive.snapshot_at(at)
+        if found is None:
+            raise CommandError(f'No archived poll at or before {at.isoformat()}')
+        polled_at, routes = found
+        self.stdout.write(f'Poll at {timezone.localtime(polled_at):%Y-%m-%d %H:%M:%S}: {len(routes)} routes')
+        for route in sorted(routes, key=lambda route: (route.available_at is None, route.available_at, route.id))[:limit]:
+            self.stdout.write(f'  {route.id:>10}  {route.pickup_location.name} -> {route.return_location.name}  '
+                              f'{route.available_at_display} .. {route.latest_return_display}  {route.car_model}')
+        if len(routes) > limit:
+            self.stdout.write(f'  ... and {len(routes) - limit} more')
+
+    def _summary(self, archive, since, until):
+        days = archive.days()
+        if not days:
+            raise CommandError(f'No archive in {archive.directory}')
+        self.stdout.write(f"{'Day':<12}{'Polls':>7}{'Frames':>8}{'Keys':>6}{'Size':>10}")
+        total = 0
+        for day in days:
+            stats = archive.day_stats(day)
+            total += stats['bytes']
+            self.stdout.write(f"{day:<12}{stats['polls']:>7}{stats['frames']:>8}{stats['keyframes']:>6}"
+                              f"{_size(stats['bytes']):>10}")
+        self.stdout.write(f'{len(days)} day(s), {_size(total)}')
+
+        started = time.perf_counter()
+        polls = changed = removed = 0
+        for _, added, gone in archive.changes(since, until):
+            polls += 1
+            changed += len(added)
+            removed += len(gone)
+        self.stdout.write(f'Scanned {polls} polls ({changed} routes added or changed, {removed} removed) '
+                          f'in {time.perf_counter() - started:.2f}s')
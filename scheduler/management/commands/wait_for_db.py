@@ -0,0 +1,48 @@
+"""Block until the database accepts connections.
+
+Usage:
+    python manage.py wait_for_db [--timeout 120]
+
+Replaces the entrypoints' shell loop, which cold-started a whole `manage.py shell` every 2 s:
+this stays one process and retries with exponential backoff (0.25 s doubling up to 5 s).
+Exits non-zero when the database is still unreachable after --timeout seconds.
+"""
+
+import time
+from django.core.management.base import BaseCommand, CommandError
+from django.db import OperationalError, connections
+
+INITIAL_DELAY = 0.25
+MAX_DELAY = 5.0
+
+
+def wait_for_db(timeout, log=None, alias='default'):
+    """Retry connecting to `alias` until it works; returns the seconds waited."""
+    started = time.monotonic()
+    delay = INITIAL_DELAY
+    connection = connections[alias]
+    while True:
+        try:
+            connection.ensure_connection()
+            return time.monotonic() - started
+        except OperationalError as e:
+            waited = time.monotonic() - started
+            if waited + delay > timeout:
+                raise CommandError(f'Database not ready after {waited:.0f}s: {e}')
+            if log:
+                log(f'Database not ready yet, retrying in {delay:.2f}s...')
+            connection.close()
+            time.sleep(delay)
+            delay = min(delay * 2, MAX_DELAY)
+
+
+class Command(BaseCommand):
+    help = 'Wait (with backoff) until the database accepts connections'
+    requires_system_checks = []  # a readiness probe; the app container runs the checks
+
+    def add_arguments(self, parser):
+        parser.add_argument('--timeout', type=float, default=120, help='Give up after this many seconds')
+
+    def handle(self, *args, **options):
+        waited = wait_for_db(options['timeout'], log=self.stdout.write)
+        self.stdout.write(f'Database is ready (waited {waited:.1f}s)')
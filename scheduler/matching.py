@@ -0,0 +1,115 @@
+"""Search matching engine shared by `check_hertz` and the dashboard.
+
+`SearchMatcher` takes a set of SavedSearch rows and resolves their origin / destination
+patterns against the snapshot's location index (scheduler.locations): a pattern may be a
+`*` wildcard, a station name, a city or a tracCode, accents and case do not matter and small
+typos are tolerated. Resolution happens once per distinct pattern and location, so matching
+a route only looks up the searches that can match its two locations.
+
+A side with a radius (`origin_radius_km` / `destination_radius_km`) is resolved instead to
+the stations within that distance of its geocoded centre (scheduler.geo); the result goes into
+the same location -> searches map, so radius searches add nothing to the per-route cost. An
+optional `heading` is checked on the route's own coordinates after the date check.
+
+Origin and destination candidates are intersected before the (constant time) date overlap
+check, so a poll costs roughly O(routes + matches) instead of O(routes × searches).
+"""
+
+from .geo import Near, heading_matches
+from .locations import LocationIndex
+from .routes import Location
+
+
+def search_place(search, side):
+    """What a search's `side` ('origin' / 'destination') resolves through: its pattern, or a
+    `Near` when the side has a radius and a geocoded centre."""
+    radius = getattr(search, f'{side}_radius_km', None)
+    lat, lon = getattr(search, f'{side}_lat', None), getattr(search, f'{side}_lon', None)
+    if radius and lat is not None and lon is not None:
+        return Near(lat, lon, radius)
+    return getattr(search, side)
+
+
+class SearchMatcher:
+    """Precompiled, indexed matcher over a fixed list of SavedSearch objects.
+
+    `locations` is the snapshot's LocationIndex (see `snapshot_locations`). Every distinct
+    origin / destination pattern is resolved against it once and the result inverted, so
+    `match` is two dict lookups plus the date check. Locations outside the index (or a
+    matcher built without one) are resolved on first sight and memoised.
+    """
+
+    def __init__(self, searches, locations=None):
+        self.searches = list(searches)
+        self.locations = locations
+        self._origin_patterns = {}       # pattern or geo.Near -> [search positions]
+        self._destination_patterns = {}
+        for position, search in enumerate(self.searches):
+            self._origin_patterns.setdefault(search_place(search, 'origin'), []).append(position)
+            self._destination_patterns.setdefault(search_place(search, 'destination'), []).append(position)
+        self._origin = self._invert(self._origin_patterns)
+        self._destination = self._invert(self._destination_patterns)
+
+    def for_locations(self, locations):
+        """This matcher's searches over another location index (self when it is the same)."""
+        return self if locations is self.locations else SearchMatcher(self.searches, locations)
+
+    def _invert(self, patterns):
+        """{location: set of search positions} for every location in the index."""
+        by_location = {}
+        if self.locations is None:
+            return by_location
+        for location in self.locations.locations:
+            by_location[location] = set()
+        for pattern, positions in patterns.items():
+            for i in self.locations.resolve(pattern):
+                by_location[self.locations.locations[i]].update(positions)
+        return by_location
+
+    def _lookup(self, table, patterns, location):
+        hits = table.get(location)
+        if hits is None:
+            if isinstance(location, str):
+                location = Location(name=location, city='', trac_code='')
+            single = LocationIndex([location])
+            hits = table[location] = {p for pattern, positions in patterns.items() if single.resolve(pattern) for p in positions}
+        return hits
+
+    def match(self, origin, destination, pickup_date, return_date):
+        """Return the searches (in input order) matching a route.
+
+        `origin` / `destination` are the route's `routes.Location` records (a plain name
+        also works, without city / code matching). A route matches when both location
+        patterns (or radii) match, the search interval [date_from, date_to] overlaps the
+        route interval [pickup_date, return_date] and the trip goes the search's heading.
+        """
+        if not self.searches or pickup_date is None or return_date is None:
+            return []
+        candidates = self._lookup(self._origin, self._origin_patterns, origin)
+        if candidates:
+            candidates = candidates & self._lookup(self._destination, self._destination_patterns, destination)
+        matches = []
+        for position in sorted(candidates):
+            search = self.searches[position]
+            if search.date_to < pickup_date or search.date_from > return_date:
+                continue
+            if getattr(search, 'heading', '') and not heading_matches(origin, destination, search.heading):
+                continue
+            matches.append(search)
+        return matches
+
+
+def partition_by_owner(searches, shards):
+    """Split searches into at most `shards` lists of search ids for sharded matching.
+
+    An owner's searches always land in the same shard, so two shards never queue the same
+    (owner, ride) pair; owners are dealt largest first to the emptiest shard to keep the
+    shards about the same size.
+    """
+    by_owner = {}
+    for search in searches:
+        by_owner.setdefault(search.owner_id, []).append(search.id)
+    parts = [[] for _ in range(max(1, shards))]
+    for ids in sorted(by_owner.values(), key=len, reverse=True):
+        min(parts, key=len).extend(ids)
+    return [part for part in parts if part]
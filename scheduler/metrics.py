@@ -0,0 +1,81 @@
+"""Prometheus metrics for the poll worker and the web tier.
+
+Stage timings come from `scheduler.timing.stage` (fetch, parse, match, dedup, notify, ...,
+plus `poll` and `dashboard` for the whole unit of work), so the same names show up in
+`/metrics`, the benchmark and the Celery task events.
+
+Gunicorn and Celery run several processes, so when METRICS_DIR is set the entrypoints point
+prometheus_client's multiprocess mode at `$METRICS_DIR/web` and `$METRICS_DIR/worker` (one
+shared volume). `/metrics` on the web tier merges every subdirectory and therefore reports the
+worker's poll metrics as well. Without METRICS_DIR (runserver, manage.py) each process only
+reports its own metrics.
+"""
+
+import glob, os
+from prometheus_client import CONTENT_TYPE_LATEST, REGISTRY, CollectorRegistry, Counter, Histogram, generate_latest
+from prometheus_client.core import GaugeMetricFamily
+from prometheus_client.multiprocess import MultiProcessCollector
+from django.conf import settings
+
+BUCKETS = (.001, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10, 30, 60)
+
+STAGE_SECONDS = Histogram(
+    'hertz_stage_duration_seconds', 'Duration of pipeline stages and whole polls / dashboard renders',
+    ['stage'], buckets=BUCKETS,
+)
+DB_QUERIES = Counter('hertz_db_queries_total', 'SQL queries executed', ['stage'])
+ROUTES_SEEN = Counter('hertz_routes_seen_total', 'Routes processed by polls')
+MATCHES = Counter('hertz_matches_total', 'Matching (user, ride) pairs found by polls')
+NOTIFICATIONS = Counter('hertz_notifications_total', 'Pushover notifications by outcome', ['result'])
+PUSHOVER_SECONDS = Histogram('hertz_pushover_request_duration_seconds', 'Duration of single Pushover API requests')
+UPSTREAM_RESPONSES = Counter('hertz_upstream_responses_total', 'Transport-routes API responses by country and status', ['country', 'status'])
+UPSTREAM_SECONDS = Histogram('hertz_upstream_duration_seconds', 'Transport-routes fetch + parse time per country', ['country'], buckets=BUCKETS)
+UPSTREAM_ERRORS = Counter('hertz_upstream_errors_total', 'Failed transport-routes fetches per country', ['country'])
+UPSTREAM_BYTES = Counter('hertz_upstream_bytes_total', 'Transport-routes body bytes received (compressed)')
+POLL_ERRORS = Counter('hertz_poll_errors_total', 'Polls aborted because the upstream fetch failed')
+
+
+class _SnapshotCollector:
+    """Snapshot age/size, read from the shared cache at scrape time (no process owns it)."""
+
+    def collect(self):
+        from .snapshot import cached_snapshot, snapshot_age  # local import: snapshot imports utils -> metrics
+        snapshot = cached_snapshot()
+        if snapshot is None:
+            return
+        yield GaugeMetricFamily('hertz_snapshot_age_seconds', 'Age of the published route snapshot',
+                                value=snapshot_age(snapshot))
+        yield GaugeMetricFamily('hertz_snapshot_routes', 'Routes in the published route snapshot',
+                                value=len(snapshot['routes']))
+
+
+class _OutboxCollector:
+    """Dead letters waiting for a retry, counted at scrape time: alerts that never reached a user."""
+
+    def collect(self):
+        from .models import OutboxMessage
+        yield GaugeMetricFamily('hertz_outbox_dead_letters', 'Notifications that exhausted their delivery attempts',
+                                value=OutboxMessage.objects.filter(status=OutboxMessage.DEAD).count())
+
+
+class _SharedDirCollector:
+    """Merge the multiprocess files of every process group below METRICS_DIR."""
+
+    def __init__(self, root):
+        self._root = root
+
+    def collect(self):
+        return MultiProcessCollector.merge(glob.glob(os.path.join(self._root, '*', '*.db')), accumulate=True)
+
+
+def render_metrics():
+    """Return (body, content type) for the /metrics endpoint."""
+    scrape_registry = CollectorRegistry(auto_describe=False)
+    scrape_registry.register(_SnapshotCollector())
+    scrape_registry.register(_OutboxCollector())
+    if settings.METRICS_DIR:
+        registry = CollectorRegistry(auto_describe=False)
+        registry.register(_SharedDirCollector(settings.METRICS_DIR))
+    else:
+        registry = REGISTRY
+    return generate_latest(registry) + generate_latest(scrape_registry), CONTENT_TYPE_LATEST
@@ -0,0 +1,43 @@
+# Generated by Django 5.2.18 on 2026-10-17 20:46
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('scheduler', '0002_notifiedride_available_at_notifiedride_car_type_and_more'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='NotificationProfile',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('pushover_user_key', models.CharField(blank=True, help_text='Your Pushover user (or group) key', max_length=50)),
+                ('digest', models.BooleanField(default=False, help_text='Send one combined message per check instead of one per ride')),
+            ],
+        ),
+        migrations.AddField(
+            model_name='notifiedride',
+            name='owner',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, to=settings.AUTH_USER_MODEL),
+        ),
+        migrations.AlterField(
+            model_name='notifiedride',
+            name='ride_id',
+            field=models.CharField(max_length=100),
+        ),
+        migrations.AddConstraint(
+            model_name='notifiedride',
+            constraint=models.UniqueConstraint(fields=('ride_id', 'owner'), name='unique_notified_ride_per_owner'),
+        ),
+        migrations.AddField(
+            model_name='notificationprofile',
+            name='user',
+            field=models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, related_name='notification_profile', to=settings.AUTH_USER_MODEL),
+        ),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 5.2.18 on 2026-10-17 21:02
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('scheduler', '0003_per_user_notifications'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='notifiedride',
+            index=models.Index(fields=['owner', '-notified_at', '-id'], name='notified_owner_time_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='notifiedride',
+            index=models.Index(fields=['notified_at', 'id'], name='notified_time_idx'),
+        ),
+    ]
@@ -0,0 +1,51 @@
+# Generated by Django 5.2.18 on 2026-10-17 21:14
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('scheduler', '0004_history_indexes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CorridorStats',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('pickup_location_name', models.CharField(max_length=255)),
+                ('return_location_name', models.CharField(max_length=255)),
+                ('listings', models.PositiveIntegerField(default=0)),
+                ('closed', models.PositiveIntegerField(default=0)),
+                ('weekday_counts', models.JSONField(default=list)),
+                ('lifetime_counts', models.JSONField(default=list)),
+                ('lifetime_seconds', models.FloatField(default=0)),
+                ('last_listed_at', models.DateTimeField(blank=True, null=True)),
+            ],
+            options={
+                'constraints': [models.UniqueConstraint(fields=('pickup_location_name', 'return_location_name'), name='unique_corridor')],
+            },
+        ),
+        migrations.CreateModel(
+            name='RouteObservation',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('ride_id', models.CharField(max_length=100, unique=True)),
+                ('country', models.CharField(blank=True, max_length=50)),
+                ('pickup_location_name', models.CharField(max_length=255)),
+                ('return_location_name', models.CharField(max_length=255)),
+                ('car_model', models.CharField(blank=True, max_length=255)),
+                ('available_at', models.DateTimeField(blank=True, null=True)),
+                ('latest_return', models.DateTimeField(blank=True, null=True)),
+                ('first_seen', models.DateTimeField()),
+                ('listed_at', models.DateTimeField()),
+                ('last_seen', models.DateTimeField()),
+                ('removed_at', models.DateTimeField(blank=True, null=True)),
+                ('times_listed', models.PositiveIntegerField(default=1)),
+            ],
+            options={
+                'indexes': [models.Index(fields=['removed_at'], name='observation_removed_idx')],
+            },
+        ),
+    ]
@@ -0,0 +1,48 @@
+# Generated by Django 5.2.18 on 2026-10-17 21:30
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('scheduler', '0005_route_observations'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='savedsearch',
+            name='destination_lat',
+            field=models.FloatField(blank=True, editable=False, null=True),
+        ),
+        migrations.AddField(
+            model_name='savedsearch',
+            name='destination_lon',
+            field=models.FloatField(blank=True, editable=False, null=True),
+        ),
+        migrations.AddField(
+            model_name='savedsearch',
+            name='destination_radius_km',
+            field=models.PositiveIntegerField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='savedsearch',
+            name='heading',
+            field=models.CharField(blank=True, choices=[('north', 'North'), ('east', 'East'), ('south', 'South'), ('west', 'West')], max_length=5),
+        ),
+        migrations.AddField(
+            model_name='savedsearch',
+            name='origin_lat',
+            field=models.FloatField(blank=True, editable=False, null=True),
+        ),
+        migrations.AddField(
+            model_name='savedsearch',
+            name='origin_lon',
+            field=models.FloatField(blank=True, editable=False, null=True),
+        ),
+        migrations.AddField(
+            model_name='savedsearch',
+            name='origin_radius_km',
+            field=models.PositiveIntegerField(blank=True, null=True),
+        ),
+    ]
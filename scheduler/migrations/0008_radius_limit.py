@@ -0,0 +1,24 @@
+# Generated by Django 5.2.18 on 2026-10-17 22:12
+
+import django.core.validators
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('scheduler', '0007_notification_outbox'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='savedsearch',
+            name='destination_radius_km',
+            field=models.PositiveIntegerField(blank=True, null=True, validators=[django.core.validators.MinValueValidator(1), django.core.validators.MaxValueValidator(500)]),
+        ),
+        migrations.AlterField(
+            model_name='savedsearch',
+            name='origin_radius_km',
+            field=models.PositiveIntegerField(blank=True, null=True, validators=[django.core.validators.MinValueValidator(1), django.core.validators.MaxValueValidator(500)]),
+        ),
+    ]
@@ -1,5 +1,11 @@
+from django.core.exceptions import ValidationError
+from django.core.validators import MaxValueValidator, MinValueValidator
 from django.db import models
+from django.utils import timezone
 from django.contrib.auth import get_user_model
+from .geo import MAX_RADIUS_KM, locate
+
+RADIUS_VALIDATORS = [MinValueValidator(1), MaxValueValidator(MAX_RADIUS_KM)]
 
 class SavedSearch(models.Model):
     owner = models.ForeignKey(get_user_model(), on_delete=models.CASCADE)
@@ -8,12 +14,88 @@ class SavedSearch(models.Model):
     origin = models.CharField(max_length=100, help_text='Use * as wildcard')
     destination = models.CharField(max_length=100, help_text='Use * as wildcard')
     created_at = models.DateTimeField(auto_now_add=True)
+    # Radius searches (scheduler.geo): with a radius the side matches every station within that
+    # distance of the centre, geocoded from origin / destination when the search is cleaned or
+    # saved (see `geocode`), so searches made in the admin or the shell get coordinates too
+    origin_radius_km = models.PositiveIntegerField(null=True, blank=True, validators=RADIUS_VALIDATORS)
+    origin_lat = models.FloatField(null=True, blank=True, editable=False)
+    origin_lon = models.FloatField(null=True, blank=True, editable=False)
+    destination_radius_km = models.PositiveIntegerField(null=True, blank=True, validators=RADIUS_VALIDATORS)
+    destination_lat = models.FloatField(null=True, blank=True, editable=False)
+    destination_lon = models.FloatField(null=True, blank=True, editable=False)
+    heading = models.CharField(max_length=5, blank=True, choices=[
+        ('north', 'North'), ('east', 'East'), ('south', 'South'), ('west', 'West'),
+    ])
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        # The stored coordinates belong to the places as loaded: no need to geocode them again
+        loaded = dict(zip(field_names, values))
+        instance._geocoded = {side: loaded.get(side) for side in ('origin', 'destination')}
+        return instance
+
+    def geocode(self, locations=None):
+        """Set the centre coordinates of each radius side from its place (`geo.locate`);
+        returns the sides that cannot be placed. Places geocoded before are skipped."""
+        geocoded = self.__dict__.setdefault('_geocoded', {})
+        unplaced = []
+        for side in ('origin', 'destination'):
+            place, radius = getattr(self, side), getattr(self, f'{side}_radius_km')
+            point = None
+            if place and radius:
+                if geocoded.get(side) == place and getattr(self, f'{side}_lat') is not None:
+                    continue
+                if locations is None:
+                    from .snapshot import cached_snapshot, snapshot_locations
+                    locations = snapshot_locations(cached_snapshot())
+                point = locate(place, locations)
+                if point is None:
+                    unplaced.append(side)
+                else:
+                    geocoded[side] = place
+            setattr(self, f'{side}_lat', point[0] if point else None)
+            setattr(self, f'{side}_lon', point[1] if point else None)
+        return unplaced
+
+    def clean(self):
+        super().clean()
+        unplaced = self.geocode()
+        if unplaced:
+            raise ValidationError({side: 'Cannot place this on the map: use a listed station or city, or "lat, lon".'
+                                   for side in unplaced})
+
+    def save(self, *args, **kwargs):
+        # Without clean() (admin actions, shell, fixtures) a radius side still gets its centre;
+        # one that cannot be placed is saved without and matches nothing until it can
+        self.geocode()
+        super().save(*args, **kwargs)
+
+    @property
+    def origin_label(self):
+        return f"{self.origin} (≤ {self.origin_radius_km} km)" if self.origin_radius_km else self.origin
+
+    @property
+    def destination_label(self):
+        label = f"{self.destination} (≤ {self.destination_radius_km} km)" if self.destination_radius_km else self.destination
+        return f"{label}, heading {self.heading}" if self.heading else label
+
+    def __str__(self):
+        return f"{self.origin_label} → {self.destination_label} ({self.date_from} – {self.date_to})"
+
+class NotificationProfile(models.Model):
+    """Per-user delivery settings. Users without a key fall back to the global PUSHOVER_USER."""
+    user = models.OneToOneField(get_user_model(), on_delete=models.CASCADE, related_name='notification_profile')
+    pushover_user_key = models.CharField(max_length=50, blank=True, help_text='Your Pushover user (or group) key')
+    digest = models.BooleanField(default=False, help_text='Send one combined message per check instead of one per ride')
 
     def __str__(self):
-        return f"{self.origin} → {self.destination} ({self.date_from} – {self.date_to})"
+        return f"Notification settings for {self.user}"
 
 class NotifiedRide(models.Model):
-    ride_id = models.CharField(max_length=100, unique=True)
+    # NULL owner: recorded before per-user delivery existed; counts as notified for everyone
+    owner = models.ForeignKey(get_user_model(), on_delete=models.CASCADE, null=True, blank=True)
+    ride_id = models.CharField(max_length=100)
     notified_at = models.DateTimeField(auto_now_add=True)
     pickup_location_name = models.CharField(max_length=255, null=True, blank=True)
     return_location_name = models.CharField(max_length=255, null=True, blank=True)
@@ -22,3 +104,154 @@ class NotifiedRide(models.Model):
     latest_return = models.DateTimeField(null=True, blank=True)
     travel_time = models.IntegerField(null=True, blank=True)
     car_type = models.CharField(max_length=255, null=True, blank=True)
+
+    class Meta:
+        constraints = [
+            # ride_id first: the index also serves the batched ride_id__in dedup lookups
+            models.UniqueConstraint(fields=['ride_id', 'owner'], name='unique_notified_ride_per_owner'),
+        ]
+        indexes = [
+            # Keyset pagination of a user's history (scheduler.history), newest first
+            models.Index(fields=['owner', '-notified_at', '-id'], name='notified_owner_time_idx'),
+            # Global time range scans: retention pruning, admin listing
+            models.Index(fields=['notified_at', 'id'], name='notified_time_idx'),
+        ]
+
+class RouteObservation(models.Model):
+    """One row per ride id ever listed upstream, maintained by check_hertz (scheduler.observations).
+
+    A ride that disappears gets `removed_at`; if it is listed again later it starts a new
+    listing (`listed_at`, `times_listed`) on the same row.
+    """
+    ride_id = models.CharField(max_length=100, unique=True)
+    country = models.CharField(max_length=50, blank=True)
+    pickup_location_name = models.CharField(max_length=255)
+    return_location_name = models.CharField(max_length=255)
+    car_model = models.CharField(max_length=255, blank=True)
+    available_at = models.DateTimeField(null=True, blank=True)
+    latest_return = models.DateTimeField(null=True, blank=True)
+    first_seen = models.DateTimeField()
+    listed_at = models.DateTimeField()            # start of the current (or last) listing
+    last_seen = models.DateTimeField()            # last poll that listed it (set on removal)
+    removed_at = models.DateTimeField(null=True, blank=True)
+    times_listed = models.PositiveIntegerField(default=1)
+
+    class Meta:
+        indexes = [
+            # Retention roll-up scans closed listings by age
+            models.Index(fields=['removed_at'], name='observation_removed_idx'),
+        ]
+
+    def __str__(self):
+        return f"{self.ride_id}: {self.pickup_location_name} → {self.return_location_name}"
+
+class CorridorStats(models.Model):
+    """Running availability statistics of one pickup → return corridor.
+
+    Updated incrementally from each poll's delta, so reading them never touches the raw
+    observations. Lifetimes are kept as a histogram over LIFETIME_BUCKETS (hours).
+    """
+    LIFETIME_BUCKETS = (1, 2, 4, 8, 12, 24, 48, 72, 120, 168)  # upper bounds; one more bucket for longer
+
+    pickup_location_name = models.CharField(max_length=255)
+    return_location_name = models.CharField(max_length=255)
+    listings = models.PositiveIntegerField(default=0)     # listings started (a relisting counts again)
+    closed = models.PositiveIntegerField(default=0)       # listings that ended (have a lifetime)
+    weekday_counts = models.JSONField(default=list)       # listings started per local weekday, Monday first
+    lifetime_counts = models.JSONField(default=list)      # closed listings per LIFETIME_BUCKETS bucket
+    lifetime_seconds = models.FloatField(default=0)       # sum over closed listings
+    last_listed_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['pickup_location_name', 'return_location_name'], name='unique_corridor'),
+        ]
+
+    def __str__(self):
+        return f"{self.pickup_location_name} → {self.return_location_name}"
+
+    @property
+    def mean_lifetime_hours(self):
+        return self.lifetime_seconds / self.closed / 3600 if self.closed else None
+
+    @property
+    def median_lifetime_hours(self):
+        """Median listing lifetime, interpolated within its histogram bucket (None without data)."""
+        if not self.closed:
+            return None
+        half, seen, lower = self.closed / 2, 0, 0
+        for upper, count in zip(self.LIFETIME_BUCKETS + (None,), self.lifetime_counts):
+            if count and seen + count >= half:
+                if upper is None:
+                    return float(lower)  # open-ended last bucket: at least its lower bound
+                return lower + (upper - lower) * (half - seen) / count
+            seen += count
+            lower = upper
+        return None
+
+
+class OutboxMessage(models.Model):
+    """One Pushover message waiting for (or done with) delivery - the notification outbox.
+
+    Written in the same transaction as the NotifiedRide rows of its rides and drained by the
+    `drain_outbox` task (scheduler.outbox), which claims due rows with SKIP LOCKED, so several
+    workers can send in parallel. Failed sends are retried with backoff until they go to `dead`.
+    """
+    PENDING, SENDING, SENT, DEAD = 'pending', 'sending', 'sent', 'dead'
+    STATUS_CHOICES = [(PENDING, 'Pending'), (SENDING, 'Sending'), (SENT, 'Sent'), (DEAD, 'Dead letter')]
+
+    idempotency_key = models.CharField(max_length=64, unique=True)  # owner + ride ids; enqueueing twice is a no-op
+    owner = models.ForeignKey(get_user_model(), on_delete=models.CASCADE, null=True, blank=True)
+    user_key = models.CharField(max_length=50, blank=True)          # recipient; empty: PUSHOVER_USER
+    title = models.CharField(max_length=255, blank=True)
+    message = models.TextField()
+    ride_ids = models.JSONField(default=list)
+    status = models.CharField(max_length=8, choices=STATUS_CHOICES, default=PENDING)
+    attempts = models.PositiveIntegerField(default=0)
+    next_attempt_at = models.DateTimeField(default=timezone.now)
+    locked_until = models.DateTimeField(null=True, blank=True)      # lease of the sender working on it
+    last_error = models.CharField(max_length=255, blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    sent_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        indexes = [
+            # The sender's claim query: due rows by status and time
+            models.Index(fields=['status', 'next_attempt_at'], name='outbox_due_idx'),
+        ]
+
+    def __str__(self):
+        return f"{self.title or 'Notification'} for {self.owner or 'default recipient'} ({self.status})"
+
+def notified_pairs(ride_ids):
+    """Return {(owner_id, ride_id)} already recorded for `ride_ids` (one query).
+
+    Legacy rows appear as (None, ride_id); see `is_notified`.
+    """
+    ride_ids = list(ride_ids)
+    if not ride_ids:
+        return set()
+    return set(NotifiedRide.objects.filter(ride_id__in=ride_ids).values_list('owner_id', 'ride_id'))
+
+
+def is_notified(pairs, owner_id, ride_id):
+    return (owner_id, ride_id) in pairs or (None, ride_id) in pairs
+
+
+def notified_ride_ids(ride_ids, owner):
+    """Return the subset of `ride_ids` already notified to `owner` (one query)."""
+    pairs = notified_pairs(ride_ids)
+    return {ride_id for owner_id, ride_id in pairs if owner_id is None or owner_id == owner.pk}
+
+
+def undelivered_pairs(ride_ids):
+    """Return the {(owner_id, ride_id)} among `ride_ids` whose message is a dead letter (one query).
+
+    Their NotifiedRide rows still dedup the ride, but nothing reached the user: history and the
+    dashboard mark them until the message is retried (admin -> Outbox messages).
+    """
+    ride_ids = set(ride_ids)
+    if not ride_ids:
+        return set()
+    dead = OutboxMessage.objects.filter(status=OutboxMessage.DEAD).values_list('owner_id', 'ride_ids')
+    return {(owner_id, ride_id) for owner_id, rides in dead for ride_id in rides if ride_id in ride_ids}
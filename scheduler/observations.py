@@ -0,0 +1,148 @@
+"""Route observation store and incrementally materialised corridor statistics.
+
+`check_hertz` calls `record_observations` with each poll's delta (scheduler.snapshot
+`diff_fingerprints`), so the work scales with churn, not with the catalogue:
+
+    added    -> new RouteObservation rows (one bulk INSERT); a ride that had been removed
+                and is listed again starts a new listing on its existing row
+    removed  -> removed_at / last_seen set on their rows (one bulk UPDATE)
+
+In the same transaction the affected `CorridorStats` rows are updated: a started listing
+counts towards `listings` and its weekday, and an ended one adds its lifetime to the
+histogram. The dashboard's statistics page reads those rows only.
+
+Roll-up: closed observations older than HERTZ_OBSERVATION_RETENTION_DAYS are deleted daily
+(`prune_observations`). Their counts and lifetimes already live in the corridor statistics,
+so only the per-ride detail goes.
+"""
+
+import bisect, datetime, logging
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+from django.utils import timezone
+from .models import CorridorStats, RouteObservation
+
+OBSERVED_AT_KEY = 'hertz:observed-at'  # time of the last poll that saw the catalogue
+PRUNE_BATCH_SIZE = 5000
+
+
+def mark_observed(now):
+    """Record that a poll saw the catalogue at `now`; returns the previous such time (or None)."""
+    previous = cache.get(OBSERVED_AT_KEY)
+    cache.set(OBSERVED_AT_KEY, now, timeout=None)
+    return previous
+
+
+def _corridor(stats, key):
+    corridor = stats.get(key)
+    if corridor is None:
+        corridor = stats[key] = CorridorStats(pickup_location_name=key[0], return_location_name=key[1])
+    if not corridor.weekday_counts:
+        corridor.weekday_counts = [0] * 7
+    if not corridor.lifetime_counts:
+        corridor.lifetime_counts = [0] * (len(CorridorStats.LIFETIME_BUCKETS) + 1)
+    return corridor
+
+
+def record_observations(routes, delta, now, countries=None, last_seen=None):
+    """Apply one poll's `delta` (route ids) to the observation store and corridor statistics.
+
+    `routes` maps route id -> Route for everything currently listed, `countries` route id ->
+    market. `last_seen` is when the previous poll saw the catalogue (the last time a route
+    now removed was still listed); it defaults to `now`. Returns (started, ended) listing counts.
+    """
+    countries = countries or {}
+    last_seen = last_seen or now
+    added, removed = delta['added'], delta['removed']
+    if not (added or removed):
+        return 0, 0
+    with transaction.atomic():
+        existing = {o.ride_id: o for o in RouteObservation.objects.filter(ride_id__in=added + removed)}
+        started, relisted, ended = [], [], []
+        for route_id in added:
+            route = routes[route_id]
+            observation = existing.get(route_id)
+            if observation is None:
+                started.append(RouteObservation(
+                    ride_id=route_id,
+                    country=countries.get(route_id, ''),
+                    pickup_location_name=route.pickup_location.name,
+                    return_location_name=route.return_location.name,
+                    car_model=route.car_model or '',
+                    available_at=route.available_at,
+                    latest_return=route.latest_return,
+                    first_seen=now, listed_at=now, last_seen=now,
+                ))
+            elif observation.removed_at is not None:
+                # Listed again after it had gone: a new listing on the same row
+                observation.listed_at = observation.last_seen = now
+                observation.removed_at = None
+                observation.times_listed += 1
+                observation.available_at, observation.latest_return = route.available_at, route.latest_return
+                relisted.append(observation)
+            # else: still open (e.g. the poll state was lost) - nothing started
+        for route_id in removed:
+            observation = existing.get(route_id)
+            if observation is not None and observation.removed_at is None:
+                observation.last_seen = max(last_seen, observation.listed_at)
+                observation.removed_at = now
+                ended.append(observation)
+
+        corridors = {(o.pickup_location_name, o.return_location_name) for o in started + relisted + ended}
+        stats = {(c.pickup_location_name, c.return_location_name): c
+                 for c in CorridorStats.objects.filter(pickup_location_name__in={k[0] for k in corridors},
+                                                       return_location_name__in={k[1] for k in corridors})}
+        known = set(stats)
+        weekday = timezone.localtime(now).weekday()
+        for observation in started + relisted:
+            corridor = _corridor(stats, (observation.pickup_location_name, observation.return_location_name))
+            corridor.listings += 1
+            corridor.weekday_counts[weekday] += 1
+            corridor.last_listed_at = now
+        for observation in ended:
+            corridor = _corridor(stats, (observation.pickup_location_name, observation.return_location_name))
+            lifetime = (observation.last_seen - observation.listed_at).total_seconds()
+            corridor.closed += 1
+            corridor.lifetime_seconds += lifetime
+            corridor.lifetime_counts[bisect.bisect_left(CorridorStats.LIFETIME_BUCKETS, lifetime / 3600)] += 1
+
+        RouteObservation.objects.bulk_create(started, ignore_conflicts=True)
+        RouteObservation.objects.bulk_update(relisted, ['listed_at', 'last_seen', 'removed_at', 'times_listed',
+                                                        'available_at', 'latest_return'])
+        RouteObservation.objects.bulk_update(ended, ['last_seen', 'removed_at'])
+        CorridorStats.objects.bulk_create([c for key, c in stats.items() if key not in known])
+        CorridorStats.objects.bulk_update([c for key, c in stats.items() if key in known and key in corridors],
+                                          ['listings', 'closed', 'weekday_counts', 'lifetime_counts',
+                                           'lifetime_seconds', 'last_listed_at'])
+    return len(started) + len(relisted), len(ended)
+
+
+def corridor_stats(pickup=None, destination=None, limit=50):
+    """Busiest corridors (by listings), optionally filtered by substring of either end."""
+    queryset = CorridorStats.objects.all()
+    if pickup:
+        queryset = queryset.filter(pickup_location_name__icontains=pickup)
+    if destination:
+        queryset = queryset.filter(return_location_name__icontains=destination)
+    return list(queryset.order_by('-listings', 'pickup_location_name', 'return_location_name')[:limit])
+
+
+def prune_observations(days=None, batch_size=PRUNE_BATCH_SIZE):
+    """Delete closed observations removed more than `days` ago; returns the count.
+
+    Their listings and lifetimes are already counted in CorridorStats.
+    """
+    days = settings.HERTZ_OBSERVATION_RETENTION_DAYS if days is None else days
+    if not days:
+        return 0
+    expired = RouteObservation.objects.filter(removed_at__lt=timezone.now() - datetime.timedelta(days=days))
+    deleted = 0
+    while True:
+        ids = list(expired.values_list('id', flat=True)[:batch_size])
+        if not ids:
+            break
+        deleted += RouteObservation.objects.filter(id__in=ids).delete()[0]
+    if deleted:
+        logging.info('Rolled up %s route observations older than %s days', deleted, days)
+    return deleted
@@ -0,0 +1,249 @@
+"""Durable notification outbox.
+
+Matching (`check_hertz`, `match_search`) never talks to Pushover. `enqueue` writes, in one
+transaction:
+
+    NotifiedRide rows    -> the dedup record, unique per (ride, owner)
+    OutboxMessage rows   -> the messages to send, unique per idempotency key (owner + rides);
+                            queueing a message that exists already is a no-op
+
+so a ride is either recorded *and* queued for an owner or neither. Two writers racing for the
+same (owner, ride) - a poll and a reverse match - cannot both queue it: the loser's insert
+hits the unique constraint, its transaction rolls back and it retries without the pairs the
+winner now holds.
+
+`drain` (the `drain_outbox` task: up to HERTZ_OUTBOX_SENDERS of them are queued after an
+enqueue, each re-queues itself while there is more to send, and beat runs one every minute)
+sends what is due, batch by batch:
+
+    1. claim   SELECT ... FOR UPDATE SKIP LOCKED the oldest due rows, mark them `sending`
+               with a lease (HERTZ_OUTBOX_LEASE) and commit - parallel workers get disjoint
+               batches
+    2. send    scheduler.dispatch.deliver (pooled, concurrent, rate-limit aware); a message
+               is only started while a worst-case send still ends within the lease, so no
+               other sender can claim a row this one is still sending
+    3. settle  `sent`, or back to `pending` with exponential backoff, or `dead` after
+               HERTZ_OUTBOX_MAX_ATTEMPTS; messages never started go back to `pending` as they
+               were (the attempt is not counted); only rows still holding this sender's lease
+
+A dead letter keeps its NotifiedRide rows, so the ride is not queued again by the next poll;
+history and the dashboard show it as not delivered and `hertz_outbox_dead_letters` (see
+scheduler.metrics) counts them. The admin "Retry" action (`requeue_dead`) is the way back.
+
+A worker that dies mid-batch leaves `sending` rows whose lease expires; the next drain picks
+them up. Pushover has no idempotency key of its own, so the one remaining duplicate is a
+message Pushover accepted just before its sender died, before step 3.
+"""
+
+import datetime, hashlib, logging, time
+from django.conf import settings
+from django.db import IntegrityError, transaction
+from django.db.models import F
+from django.utils import timezone
+from .dispatch import deliver, worst_case_send_seconds
+from .fragments import bump_notified_version
+from .metrics import NOTIFICATIONS
+from .models import NotifiedRide, OutboxMessage, is_notified, notified_pairs
+
+PRUNE_BATCH_SIZE = 5000
+SETTLE_MARGIN = 5  # seconds of the lease kept for settling a batch
+
+
+def idempotency_key(owner_id, ride_ids):
+    return hashlib.sha256(f"{owner_id}|{','.join(sorted(ride_ids))}".encode()).hexdigest()
+
+
+def _notified_ride(owner_id, route):
+    return NotifiedRide(
+        owner_id=owner_id,
+        ride_id=route.id,
+        pickup_location_name=route.pickup_location.name,
+        return_location_name=route.return_location.name,
+        distance=route.distance or 0,
+        available_at=route.available_at,
+        latest_return=route.latest_return,
+        travel_time=route.travel_time,
+        car_type=route.car_model or 'Unknown car',
+    )
+
+
+def _insert(rides_by_owner, build):
+    now = timezone.now()
+    rides, messages = [], []
+    for owner_id, routes in rides_by_owner.items():
+        rides.extend(_notified_ride(owner_id, route) for route in routes)
+        for message in build(owner_id, routes):
+            ride_ids = [route.id for route in message['routes']]
+            messages.append(OutboxMessage(
+                idempotency_key=idempotency_key(owner_id, ride_ids),
+                owner_id=owner_id,
+                user_key=message['user'] or '',
+                title=message['title'] or '',
+                message=message['message'],
+                ride_ids=ride_ids,
+                next_attempt_at=now,
+            ))
+    with transaction.atomic():
+        NotifiedRide.objects.bulk_create(rides)       # no ignore_conflicts: a lost race must roll back
+        # A message with the same key was queued before (e.g. its history rows were deleted
+        # since): it is not sent a second time
+        OutboxMessage.objects.bulk_create(messages, ignore_conflicts=True)
+    return len(rides)
+
+
+def enqueue(rides_by_owner, build):
+    """Record and queue new rides: {owner id: [Route]} -> NotifiedRide + OutboxMessage rows.
+
+    `build(owner_id, routes)` returns that owner's messages as {'user', 'title', 'message',
+    'routes'} dicts. Returns the number of (owner, ride) pairs queued.
+    """
+    rides_by_owner = {owner_id: routes for owner_id, routes in rides_by_owner.items() if routes}
+    if not rides_by_owner:
+        return 0
+    try:
+        queued = _insert(rides_by_owner, build)
+    except IntegrityError:
+        # Someone queued some of these pairs first: redo owner by owner without them
+        queued = 0
+        taken = notified_pairs({route.id for routes in rides_by_owner.values() for route in routes})
+        for owner_id, routes in rides_by_owner.items():
+            routes = [route for route in routes if not is_notified(taken, owner_id, route.id)]
+            if not routes:
+                continue
+            try:
+                queued += _insert({owner_id: routes}, build)
+            except IntegrityError:
+                logging.info('Rides for user %s were queued concurrently, skipping', owner_id)
+    if queued:
+        bump_notified_version(rides_by_owner)
+    return queued
+
+
+def claim_batch(limit=None, now=None):
+    """Lease up to `limit` due messages to this sender; returns them (attempts already counted)."""
+    limit = limit or settings.HERTZ_OUTBOX_BATCH_SIZE
+    now = now or timezone.now()
+    lease = now + datetime.timedelta(seconds=settings.HERTZ_OUTBOX_LEASE)
+    claimable = OutboxMessage.objects.select_for_update(skip_locked=True)
+    with transaction.atomic():
+        # Batches of a dead sender first (lease expired), then due messages in outbox_due_idx order
+        batch = list(claimable.filter(status=OutboxMessage.SENDING, locked_until__lt=now)[:limit])
+        if len(batch) < limit:
+            batch += claimable.filter(status=OutboxMessage.PENDING, next_attempt_at__lte=now).order_by(
+                'next_attempt_at', 'id')[:limit - len(batch)]
+        if batch:
+            OutboxMessage.objects.filter(id__in=[m.id for m in batch]).update(
+                status=OutboxMessage.SENDING, locked_until=lease, attempts=F('attempts') + 1)
+        for message in batch:
+            message.status, message.locked_until = OutboxMessage.SENDING, lease
+            message.attempts += 1
+    return batch
+
+
+def minimum_lease():
+    """Shortest HERTZ_OUTBOX_LEASE that fits one worst-case send (and settling it)."""
+    return worst_case_send_seconds() + SETTLE_MARGIN
+
+
+def retry_delay(attempts):
+    return settings.HERTZ_OUTBOX_RETRY_BACKOFF * 2 ** (attempts - 1)
+
+
+def settle(batch, results, now=None):
+    """Record the outcome of a sent batch (`deliver` results); returns (sent, retried, dead,
+    released) counts."""
+    now = now or timezone.now()
+    sent = [m.id for m, ok in zip(batch, results) if ok]
+    released = [m.id for m, ok in zip(batch, results) if ok is None]
+    retried, dead = {}, []
+    for message, ok in zip(batch, results):
+        if ok or ok is None:
+            continue
+        if message.attempts >= settings.HERTZ_OUTBOX_MAX_ATTEMPTS:
+            dead.append(message.id)
+        else:
+            retried.setdefault(message.attempts, []).append(message.id)
+    lease = batch[0].locked_until if batch else None
+    # Only rows still under this sender's lease; an expired lease may have moved on
+    mine = OutboxMessage.objects.filter(status=OutboxMessage.SENDING, locked_until=lease)
+    settled_sent = settled_retried = settled_dead = settled_released = 0
+    with transaction.atomic():
+        if released:
+            settled_released = mine.filter(id__in=released).update(
+                status=OutboxMessage.PENDING, locked_until=None, attempts=F('attempts') - 1, next_attempt_at=now)
+        if sent:
+            settled_sent = mine.filter(id__in=sent).update(status=OutboxMessage.SENT, sent_at=now,
+                                                           locked_until=None, last_error='')
+        for attempts, ids in retried.items():
+            settled_retried += mine.filter(id__in=ids).update(
+                status=OutboxMessage.PENDING, locked_until=None, last_error='Delivery failed',
+                next_attempt_at=now + datetime.timedelta(seconds=retry_delay(attempts)))
+        if dead:
+            settled_dead = mine.filter(id__in=dead).update(
+                status=OutboxMessage.DEAD, locked_until=None,
+                last_error=f'Delivery failed {settings.HERTZ_OUTBOX_MAX_ATTEMPTS} times')
+    if settled_dead:
+        # The dashboard and history mark dead-lettered rides as not delivered
+        bump_notified_version({m.owner_id for m in batch if m.id in dead and m.owner_id})
+        NOTIFICATIONS.labels('dead').inc(settled_dead)
+        logging.error('%s notification(s) moved to the dead-letter state after %s attempts',
+                      settled_dead, settings.HERTZ_OUTBOX_MAX_ATTEMPTS)
+    return settled_sent, settled_retried, settled_dead, settled_released
+
+
+def drain(max_batches=20):
+    """Send due messages until none are left or `max_batches` were sent; returns totals, with
+    `more` set when it stopped at the budget (the caller queues another drain)."""
+    totals = {'sent': 0, 'retried': 0, 'dead': 0, 'released': 0, 'more': False}
+    for _ in range(max_batches):
+        # The lease runs HERTZ_OUTBOX_LEASE from the claim; deliver() measures it in wall time
+        deadline = time.time() + settings.HERTZ_OUTBOX_LEASE - SETTLE_MARGIN
+        batch = claim_batch()
+        if not batch:
+            break
+        results = deliver([{'user': m.user_key, 'title': m.title, 'message': m.message} for m in batch],
+                          deadline=deadline, html=True)
+        for name, count in zip(('sent', 'retried', 'dead', 'released'), settle(batch, results)):
+            totals[name] += count
+        if all(ok is None for ok in results):
+            break  # nothing could be started in time; claiming again would not change that
+    else:
+        totals['more'] = True
+    if totals['retried']:
+        logging.warning('%s notification(s) failed and will be retried', totals['retried'])
+    return totals
+
+
+def requeue_dead(queryset=None):
+    """Give dead letters (all, or those in `queryset`) a fresh set of attempts; returns the count.
+
+    Messages in any other state are left alone: a sent one must not be delivered again.
+    """
+    dead = (OutboxMessage.objects.all() if queryset is None else queryset).filter(status=OutboxMessage.DEAD)
+    owners = set(dead.exclude(owner=None).values_list('owner_id', flat=True))
+    requeued = dead.update(status=OutboxMessage.PENDING, attempts=0, next_attempt_at=timezone.now(),
+                           locked_until=None, last_error='')
+    if requeued:
+        bump_notified_version(owners)
+    return requeued
+
+
+def hurry_pending(queryset):
+    """Make the pending messages in `queryset` due now (attempts are kept); returns the count."""
+    return queryset.filter(status=OutboxMessage.PENDING).update(next_attempt_at=timezone.now())
+
+
+def prune_outbox(days=None, batch_size=PRUNE_BATCH_SIZE):
+    """Delete sent messages older than HERTZ_OUTBOX_RETENTION_DAYS; dead letters are kept."""
+    days = settings.HERTZ_OUTBOX_RETENTION_DAYS if days is None else days
+    if not days:
+        return 0
+    expired = OutboxMessage.objects.filter(status=OutboxMessage.SENT,
+                                           sent_at__lt=timezone.now() - datetime.timedelta(days=days))
+    deleted = 0
+    while True:
+        ids = list(expired.values_list('id', flat=True)[:batch_size])
+        if not ids:
+            break
+        deleted += OutboxMessage.objects.filter(id__in=ids).delete()[0]
+    return deleted
@@ -0,0 +1,89 @@
+"""Opt-in sampling profiler for a single poll.
+
+`python manage.py profile_poll` arms a flag in the shared cache; the next `check_hertz` run
+(in whichever worker picks it up) executes under `SamplingProfiler` and stores the result in
+the cache, where the command collects it. No debugger, restart or code change is needed, and
+polls that are not armed pay one cache read.
+
+The profiler samples the polling thread's stack every few milliseconds from a helper thread
+(`sys._current_frames`) and aggregates identical stacks. The output is the "folded stacks"
+text format (`frame;frame;frame count` per line), which flamegraph.pl, speedscope and
+inferno render directly.
+"""
+
+import os, sys, threading, time
+from collections import Counter
+from django.core.cache import cache
+
+PROFILE_REQUEST_KEY = 'hertz:profile-request'
+PROFILE_RESULT_KEY = 'hertz:profile-result'
+PROFILE_TTL = 60 * 60  # seconds an armed request / an uncollected result is kept
+
+
+class SamplingProfiler:
+    """Context manager sampling the stack of the thread that enters it."""
+
+    def __init__(self, interval=0.005):
+        self.interval = interval
+        self.samples = Counter()
+        self.duration = 0.0
+        self._stop = threading.Event()
+
+    def __enter__(self):
+        self._target = threading.get_ident()
+        self._started = time.perf_counter()
+        self._thread = threading.Thread(target=self._run, name='poll-profiler', daemon=True)
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._stop.set()
+        self._thread.join()
+        self.duration = time.perf_counter() - self._started
+        return False
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self._target)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f'{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})')
+                frame = frame.f_back
+            if stack:
+                self.samples[';'.join(reversed(stack))] += 1
+
+    def folded(self):
+        """The samples in folded-stacks format, hottest stack first."""
+        return ''.join(f'{stack} {count}\n' for stack, count in self.samples.most_common())
+
+
+def request_profile(interval):
+    """Arm profiling of the next poll; returns False if a request is already pending."""
+    cache.delete(PROFILE_RESULT_KEY)
+    return cache.add(PROFILE_REQUEST_KEY, {'interval': interval}, timeout=PROFILE_TTL)
+
+
+def cancel_profile_request():
+    cache.delete(PROFILE_REQUEST_KEY)
+
+
+def claim_profile_request():
+    """The pending request (dict) if this poll should be profiled, else None."""
+    request = cache.get(PROFILE_REQUEST_KEY)
+    # delete() reports whether this process removed the key, so only one poll claims it
+    if request is not None and cache.delete(PROFILE_REQUEST_KEY):
+        return request
+    return None
+
+
+def store_profile(profiler):
+    cache.set(PROFILE_RESULT_KEY, {
+        'folded': profiler.folded(),
+        'samples': sum(profiler.samples.values()),
+        'duration': profiler.duration,
+    }, timeout=PROFILE_TTL)
+
+
+def collected_profile():
+    return cache.get(PROFILE_RESULT_KEY)
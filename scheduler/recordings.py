@@ -0,0 +1,100 @@
+"""Recorded upstream payloads, for replaying polls offline.
+
+With HERTZ_RECORD_DIR set, every poll stores the transport-routes payloads it fetched (the raw
+JSON, in the `hertz_api_example.json` format) so `manage.py replay_snapshots` can later run the
+same sequence through the whole pipeline without network. The directory holds:
+
+    index.jsonl                  one line per recorded poll:
+                                 {"at": "<ISO time>", "sources": {"SWEDEN": "<sha256>", ...}}
+                                 (only the countries that returned a new payload; a 304 poll
+                                 records nothing)
+    payloads/ab/<sha256>.json.gz the payloads, gzip-compressed and content-addressed: a payload
+                                 seen before (an upstream without validators, a market that
+                                 flips back) is stored once however often it is recorded
+
+The payload is captured while it is parsed (`Tee` copies what the streaming parser reads), so
+recording costs a copy of the body and one compressed write per new payload, not a second
+download or parse. Writes are atomic (temp file + rename); the index is appended by the single
+running poll (see scheduler.schedule).
+"""
+
+import datetime, gzip, hashlib, io, json, os, tempfile
+from pathlib import Path
+from django.conf import settings
+from django.utils import timezone
+
+INDEX_FILE = 'index.jsonl'
+PAYLOAD_DIR = 'payloads'
+COMPRESSION_LEVEL = 6  # ~10x on the transport-routes JSON; higher levels gain little
+
+
+class Tee:
+    """Readable wrapper that keeps a copy of every byte read from `stream`."""
+
+    def __init__(self, stream):
+        self._stream = stream
+        self._copy = io.BytesIO()
+
+    def read(self, size=-1):
+        data = self._stream.read(size)
+        self._copy.write(data)
+        return data
+
+    def getvalue(self):
+        self._copy.write(self._stream.read())  # whatever the parser left (trailing whitespace)
+        return self._copy.getvalue()
+
+
+def payload_digest(data):
+    return hashlib.sha256(data).hexdigest()
+
+
+def payload_path(directory, digest):
+    return Path(directory) / PAYLOAD_DIR / digest[:2] / f'{digest}.json.gz'
+
+
+def store_payload(directory, data):
+    """Store `data` (raw payload bytes) once; returns its digest."""
+    digest = payload_digest(data)
+    path = payload_path(directory, digest)
+    if not path.exists():
+        path.parent.mkdir(parents=True, exist_ok=True)
+        with tempfile.NamedTemporaryFile(dir=path.parent, suffix='.tmp', delete=False) as f:
+            f.write(gzip.compress(data, compresslevel=COMPRESSION_LEVEL, mtime=0))
+        os.replace(f.name, path)
+    return digest
+
+
+def load_payload(directory, digest):
+    with open(payload_path(directory, digest), 'rb') as f:
+        return gzip.decompress(f.read())
+
+
+def record_poll(payloads, at=None, directory=None):
+    """Record one poll's new payloads ({country: bytes}); returns the index entry or None."""
+    directory = directory or settings.HERTZ_RECORD_DIR
+    if not (directory and payloads):
+        return None
+    entry = {
+        'at': (at or timezone.now()).isoformat(),
+        'sources': {country: store_payload(directory, data) for country, data in payloads.items()},
+    }
+    with open(Path(directory) / INDEX_FILE, 'a', encoding='utf-8') as f:
+        f.write(json.dumps(entry) + '\n')
+    return entry
+
+
+def read_index(directory, since=None, until=None):
+    """Recorded polls in time order as [{'at': aware datetime, 'sources': {country: digest}}]."""
+    entries = []
+    with open(Path(directory) / INDEX_FILE, encoding='utf-8') as f:
+        for line in f:
+            if not line.strip():
+                continue
+            entry = json.loads(line)
+            at = datetime.datetime.fromisoformat(entry['at'])
+            if (since and at < since) or (until and at > until):
+                continue
+            entries.append({'at': at, 'sources': entry['sources']})
+    entries.sort(key=lambda entry: entry['at'])
+    return entries
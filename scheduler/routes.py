@@ -0,0 +1,134 @@
+"""Route domain model: compact records parsed straight from the transport-routes stream.
+
+The upstream payload is ~700 KB for ~100 routes, most of it per-location detail (opening
+hours, addresses, info texts) that nothing here uses. `parse_routes` walks the JSON
+incrementally with ijson, materialises one route object at a time, keeps only the fields we
+consume and interns each pickup/return location once, so a snapshot is a flat list of small
+slotted records instead of a tree of nested dicts.
+
+This is the single normalisation stage: dates, timezone-aware datetimes, travel hours and
+display strings are computed here once per snapshot, and `check_hertz` and the dashboard
+only read the resulting immutable `Route` objects.
+"""
+
+from dataclasses import dataclass
+from datetime import date, datetime
+from django.utils import timezone
+import ijson
+
+
+@dataclass(frozen=True, slots=True)
+class Location:
+    name: str
+    city: str
+    trac_code: str
+    lat: float | None = None        # station coordinates (geoLat / geoLon), used by radius searches
+    lon: float | None = None
+
+
+@dataclass(frozen=True, slots=True)
+class Route:
+    id: str
+    pickup_location: Location
+    return_location: Location
+    car_model: str
+    distance: float | None          # km
+    travel_time: int | None         # minutes
+    # Upstream sends naive local times (2025-08-06T08:15:00); None when missing or malformed
+    available_at: datetime | None   # aware, in settings.TIME_ZONE
+    latest_return: datetime | None
+    pickup_date: date | None        # local calendar date of available_at
+    return_date: date | None
+    travel_hours: float | None      # travel_time rounded to 0.1 h
+    available_at_display: str       # 'YYYY-MM-DD HH:MM' or ''
+    latest_return_display: str
+
+
+def parse_routes(stream):
+    """Parse a transport-routes payload from a binary file-like object into Route records.
+
+    Routes without an id are skipped; the same route id listed twice is kept once.
+    Raises ValueError when the payload is not a JSON array (e.g. an upstream error object),
+    so callers never mistake it for an empty catalogue.
+    """
+    head = stream.read(64).lstrip()
+    while not head:
+        chunk = stream.read(64)
+        if not chunk:
+            break
+        head = chunk.lstrip()
+    if not head.startswith(b'['):
+        raise ValueError('Unexpected API response format, expected list')
+    stream = _Prefixed(head, stream)
+
+    locations = {}  # (name, tracCode) -> Location, shared by every route using it
+    strings = {}    # car model strings, shared the same way
+    seen = set()
+    routes = []
+    for raw in ijson.items(stream, 'item.routes.item', use_float=True):
+        route_id = str(raw.get('id') or '')
+        if not route_id or route_id in seen:
+            continue
+        seen.add(route_id)
+        car_model = raw.get('carModel') or ''
+        available_at, pickup_date, available_at_display = _local_time(raw.get('availableAt'))
+        latest_return, return_date, latest_return_display = _local_time(raw.get('latestReturn'))
+        travel_time = raw.get('travelTime')
+        routes.append(Route(
+            id=route_id,
+            pickup_location=_location(locations, raw.get('pickupLocation')),
+            return_location=_location(locations, raw.get('returnLocation')),
+            car_model=strings.setdefault(car_model, car_model),
+            distance=raw.get('distance'),
+            travel_time=travel_time,
+            available_at=available_at,
+            latest_return=latest_return,
+            pickup_date=pickup_date,
+            return_date=return_date,
+            travel_hours=round(travel_time / 60, 1) if isinstance(travel_time, (int, float)) else None,
+            available_at_display=available_at_display,
+            latest_return_display=latest_return_display,
+        ))
+    return routes
+
+
+def _local_time(value):
+    """Return (aware datetime, local date, display string) for an upstream timestamp."""
+    try:
+        naive = datetime.fromisoformat(value)
+    except (TypeError, ValueError):
+        return None, None, ''
+    if timezone.is_aware(naive):
+        naive = timezone.make_naive(naive)
+    return timezone.make_aware(naive), naive.date(), naive.strftime('%Y-%m-%d %H:%M')
+
+
+def _location(locations, raw):
+    raw = raw or {}
+    name = raw.get('name') or ''
+    trac_code = raw.get('tracCode') or ''
+    key = (name, trac_code)
+    location = locations.get(key)
+    if location is None:
+        location = locations[key] = Location(name=name, city=raw.get('city') or '', trac_code=trac_code,
+                                             lat=_coordinate(raw.get('geoLat')), lon=_coordinate(raw.get('geoLon')))
+    return location
+
+
+def _coordinate(value):
+    # Missing stations come as null or 0
+    return float(value) if isinstance(value, (int, float)) and value else None
+
+
+class _Prefixed:
+    """Re-attach the bytes already read by the format check in front of a stream."""
+
+    def __init__(self, head, stream):
+        self._head = head
+        self._stream = stream
+
+    def read(self, size=-1):
+        if self._head and size != 0:  # ijson probes read(0) to detect bytes vs. text
+            head, self._head = self._head, b''
+            return head
+        return self._stream.read(size)
@@ -0,0 +1,71 @@
+"""Overlap-safe, adaptive scheduling of `check_hertz`.
+
+Celery beat only ticks (every HERTZ_MIN_CHECK_INTERVAL); each tick asks `poll_due()` whether
+the adaptive schedule wants a poll now, and a poll only runs while holding the single-flight
+lock, so a slow run (upstream timeout, large delta) is never overlapped by the next tick.
+
+After every poll `schedule_next()` picks the next interval:
+    * upstream error / 429   -> exponential backoff from HERTZ_CHECK_INTERVAL up to
+                                HERTZ_MAX_CHECK_INTERVAL (at least Retry-After when sent)
+    * routes churning, or a search whose date window starts within HERTZ_URGENT_DAYS
+                             -> HERTZ_MIN_CHECK_INTERVAL (new rides appear / go fast)
+    * otherwise              -> HERTZ_CHECK_INTERVAL
+"""
+
+import logging, time, uuid
+from django.conf import settings
+from django.core.cache import cache
+
+SCHEDULE_KEY = 'hertz:poll-schedule'  # {'next_at': unix time, 'interval': s, 'errors': n}
+POLL_LOCK_KEY = 'hertz:poll-lock'
+
+
+def acquire_poll_lock():
+    """Return a token when this process may poll now, None while another poll is running."""
+    token = uuid.uuid4().hex
+    if cache.add(POLL_LOCK_KEY, token, timeout=settings.HERTZ_POLL_LOCK_TIMEOUT):
+        return token
+    return None
+
+
+def release_poll_lock(token):
+    # Only release our own lock (it may have expired and been taken by another poll meanwhile)
+    if cache.get(POLL_LOCK_KEY) == token:
+        cache.delete(POLL_LOCK_KEY)
+
+
+def poll_due():
+    schedule = cache.get(SCHEDULE_KEY)
+    # Half a tick of slack: ticks arrive slightly before the poll they started last time
+    return schedule is None or time.time() >= schedule['next_at'] - settings.HERTZ_MIN_CHECK_INTERVAL / 2
+
+
+def upstream_retry_after(exc):
+    """Seconds from a 429/503 Retry-After header on a failed fetch, else None."""
+    import requests  # loaded by the fetch that raised `exc`; kept off the worker's import path
+    response = getattr(exc, 'response', None) if isinstance(exc, requests.HTTPError) else None
+    if response is None or response.status_code not in (429, 503):
+        return None
+    value = response.headers.get('Retry-After', '')
+    return float(value) if value.isdigit() else None
+
+
+def schedule_next(stats, started):
+    """Store when the next poll is due, given the finished poll's stats (None: it crashed).
+
+    The interval counts from `started` (time.time() at the start of the poll).
+    """
+    previous = cache.get(SCHEDULE_KEY) or {}
+    errors = 0
+    if stats is None or 'error' in stats:
+        errors = previous.get('errors', 0) + 1
+        interval = min(settings.HERTZ_CHECK_INTERVAL * 2 ** errors, settings.HERTZ_MAX_CHECK_INTERVAL)
+        interval = max(interval, (stats or {}).get('retry_after') or 0)
+        logging.warning('Poll failed (%s in a row), next poll in %.0f s', errors, interval)
+    elif stats.get('churn') or stats.get('urgent_searches'):
+        interval = settings.HERTZ_MIN_CHECK_INTERVAL
+    else:
+        interval = settings.HERTZ_CHECK_INTERVAL
+    schedule = {'next_at': started + interval, 'interval': interval, 'errors': errors}
+    cache.set(SCHEDULE_KEY, schedule, timeout=None)
+    return schedule
@@ -1 +1,26 @@
+import logging
+from django.db import transaction
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+from .fragments import bump_search_version
+from .models import SavedSearch
 
+@receiver(post_save, sender=SavedSearch)
+@receiver(post_delete, sender=SavedSearch)
+def saved_search_changed(sender, instance, **kwargs):
+    # The user's cached dashboard fragments were matched against the old search set
+    bump_search_version(instance.owner_id)
+
+@receiver(post_save, sender=SavedSearch)
+def saved_search_saved(sender, instance, **kwargs):
+    # Reverse match the new / edited search against the current snapshot right away instead of
+    # waiting for the next poll (after commit, so the worker sees the row)
+    transaction.on_commit(lambda: _queue_reverse_match(instance.pk))
+
+def _queue_reverse_match(search_id):
+    from .tasks import match_search
+    try:
+        match_search.delay(search_id)
+    except Exception as e:
+        # Broker unavailable: saving still succeeds, the next poll matches the search
+        logging.warning('Could not queue reverse match of search %s: %s', search_id, e)
@@ -0,0 +1,205 @@
+"""Shared route snapshot cache.
+
+`check_hertz` fetches the upstream payload once per poll and publishes it here; the
+dashboard reads the published snapshot (and its age) instead of calling the API on
+every page load.
+
+Read path (`get_snapshot`):
+    * fresh snapshot            -> returned as-is
+    * older than MAX_AGE        -> returned as-is (stale-while-revalidate) and a single
+                                   background refresh is queued
+    * missing (cold cache)      -> one caller fetches synchronously while holding a lock,
+                                   concurrent callers wait for that result (single-flight)
+
+Change tracking: `check_hertz` keeps a compact fingerprint of the previous poll
+(route id -> short hash of the fields we use, plus one hash per SavedSearch) so each poll
+only matches the routes and searches that changed (`diff_fingerprints`, `load_poll_state`).
+A poll whose matching is sharded over several tasks parks its new state (`stage_poll_state`)
+and its last shard to finish commits it, so a failed shard leaves the previous state in place.
+"""
+
+import hashlib, logging, time
+from django.conf import settings
+from django.core.cache import cache
+from django.utils import timezone
+from .locations import LocationIndex
+from .utils import fetch_routes
+
+SNAPSHOT_KEY = 'hertz:snapshot:v2'  # bump when routes.Route / Location change shape (pickled)
+POLL_STATE_KEY = 'hertz:poll-state'
+REFRESH_LOCK_KEY = 'hertz:snapshot:refresh-lock'
+REFRESH_LOCK_TIMEOUT = 30  # seconds; upper bound for one upstream fetch (10 s timeout + slack)
+WAIT_INTERVAL = 0.1        # seconds between cache polls while another process refreshes
+
+_locations = (None, None)  # (snapshot version, LocationIndex) of the last snapshot matched here
+
+
+def publish_snapshot(routes, delta=None, validators=None, sources=None):
+    """Store freshly fetched routes (list of `routes.Route`) as the current snapshot and return it.
+
+    `delta` (added/changed/removed route ids vs. the previous poll) is attached when the
+    publisher is check_hertz; background refreshes publish without one. `validators`
+    (ETag / Last-Modified per country) let the next fetch be conditional, and `sources`
+    ({country: routes}) stand in for countries that answer 304 or fail next time.
+    """
+    snapshot = {
+        'routes': routes,
+        'version': time.time_ns() // 1_000_000,  # ms timestamp; changes only when content may have
+        'fetched_at': timezone.now(),
+        'delta': delta,
+        'validators': validators,
+        'sources': sources,
+    }
+    cache.set(SNAPSHOT_KEY, snapshot, timeout=settings.HERTZ_SNAPSHOT_STALE_TTL)
+    return snapshot
+
+
+def touch_snapshot(snapshot):
+    """Upstream confirmed (304) that `snapshot` is still current: reset its age, nothing changed."""
+    snapshot = dict(snapshot, fetched_at=timezone.now(), delta=None)
+    cache.set(SNAPSHOT_KEY, snapshot, timeout=settings.HERTZ_SNAPSHOT_STALE_TTL)
+    return snapshot
+
+
+def cached_snapshot():
+    """The published snapshot as-is (no refresh, may be None)."""
+    return cache.get(SNAPSHOT_KEY)
+
+
+def snapshot_locations(snapshot):
+    """LocationIndex over a snapshot's routes, built once per snapshot version in this process."""
+    global _locations
+    if snapshot is None:
+        return None
+    version, index = _locations
+    if version != snapshot['version']:
+        index = LocationIndex.from_routes(snapshot['routes'])
+        _locations = (snapshot['version'], index)
+    return index
+
+
+def refresh_snapshot():
+    """Fetch upstream (conditionally) and publish the result. Raises on fetch errors."""
+    current = cached_snapshot()
+    result = fetch_routes(current)
+    if result.not_modified:
+        return touch_snapshot(current)
+    return publish_snapshot(result.data, validators=result.validators, sources=result.sources)
+
+
+def release_refresh_lock():
+    cache.delete(REFRESH_LOCK_KEY)
+
+
+def snapshot_age(snapshot):
+    """Age of a snapshot in seconds (None when there is no snapshot)."""
+    if not snapshot:
+        return None
+    return (timezone.now() - snapshot['fetched_at']).total_seconds()
+
+
+def get_snapshot():
+    """Return the current snapshot dict (`routes`, `version`, `fetched_at`, ...) or None.
+
+    Never triggers more than one upstream fetch at a time across all web workers.
+    Fetch errors from a synchronous (cold cache) refresh propagate to the caller.
+    """
+    snapshot = cached_snapshot()
+    if snapshot is None:
+        return _refresh_single_flight()
+    if snapshot_age(snapshot) > settings.HERTZ_SNAPSHOT_MAX_AGE:
+        _schedule_revalidation()
+    return snapshot
+
+
+def _refresh_single_flight():
+    if cache.add(REFRESH_LOCK_KEY, 1, timeout=REFRESH_LOCK_TIMEOUT):
+        try:
+            return refresh_snapshot()
+        finally:
+            release_refresh_lock()
+    # Someone else is fetching: wait for their result instead of hitting upstream too
+    deadline = time.monotonic() + REFRESH_LOCK_TIMEOUT
+    while time.monotonic() < deadline:
+        time.sleep(WAIT_INTERVAL)
+        snapshot = cached_snapshot()
+        if snapshot is not None:
+            return snapshot
+        if cache.get(REFRESH_LOCK_KEY) is None:
+            break  # the other refresh failed; don't wait for the full timeout
+    logging.warning('Route snapshot unavailable after waiting for concurrent refresh')
+    return None
+
+
+def _schedule_revalidation():
+    # The lock is released by the refresh task once it has published (or failed)
+    if cache.add(REFRESH_LOCK_KEY, 1, timeout=REFRESH_LOCK_TIMEOUT):
+        from .tasks import refresh_snapshot_task  # local import: tasks imports this module
+        try:
+            refresh_snapshot_task.delay()
+        except Exception as e:
+            logging.exception('Could not queue snapshot refresh: %s', e)
+            release_refresh_lock()
+
+
+def _digest(*values):
+    return hashlib.blake2b(repr(values).encode(), digest_size=8).hexdigest()
+
+
+def route_fingerprint(route):
+    """Short, process-independent hash of the route fields matching and notifying depend on."""
+    return _digest(
+        route.pickup_location.name,
+        route.return_location.name,
+        route.available_at,
+        route.latest_return,
+        route.car_model,
+        route.distance,
+        route.travel_time,
+    )
+
+
+def search_fingerprint(search):
+    parts = [search.origin, search.destination, search.date_from, search.date_to]
+    geo = [search.origin_radius_km, search.origin_lat, search.origin_lon, search.destination_radius_km,
+           search.destination_lat, search.destination_lon, search.heading]
+    if any(geo):
+        parts += geo  # plain searches keep their fingerprints from before radius searches
+    return _digest(*parts)
+
+
+def diff_fingerprints(previous, current):
+    """Compare two {id: hash} maps; `previous=None` (no state yet) treats everything as added."""
+    previous = previous or {}
+    added = [key for key in current if key not in previous]
+    changed = [key for key, digest in current.items() if key in previous and previous[key] != digest]
+    removed = [key for key in previous if key not in current]
+    return {'added': added, 'changed': changed, 'removed': removed}
+
+
+def load_poll_state():
+    """State persisted by the previous check_hertz run, or None on the first run.
+
+    Keys: `routes` ({route id: fingerprint}), `searches` ({search id: fingerprint}) and
+    `validators` (the conditional-request validators of the matched payload).
+    """
+    return cache.get(POLL_STATE_KEY)
+
+
+def save_poll_state(state):
+    cache.set(POLL_STATE_KEY, state, timeout=None)
+
+
+def stage_poll_state(token, state):
+    """Park the state of a sharded poll (by its lock token) until its shards are done."""
+    cache.set(f'{POLL_STATE_KEY}:{token}', state, timeout=settings.HERTZ_POLL_LOCK_TIMEOUT)
+
+
+def commit_poll_state(token):
+    """Make a staged state the current one; False when it expired meanwhile."""
+    state = cache.get(f'{POLL_STATE_KEY}:{token}')
+    if state is None:
+        return False
+    save_poll_state(state)
+    cache.delete(f'{POLL_STATE_KEY}:{token}')
+    return True
@@ -1,96 +1,411 @@
-import datetime, logging
-from celery import shared_task
-from .models import SavedSearch, NotifiedRide
-from .utils import fetch_routes, wildcard_match, send_pushover
+import datetime, logging, math, time
+from contextlib import nullcontext
+from celery import chord, shared_task
+from django.conf import settings
+from django.utils import timezone
+from .models import NotificationProfile, SavedSearch, is_notified, notified_pairs
+from .archive import archive_poll, prune_archive
+from .history import prune_history
+from .observations import mark_observed, prune_observations, record_observations
+from .outbox import drain, enqueue, prune_outbox
+from .live import publish_snapshot_event
+from .matching import SearchMatcher, partition_by_owner
+from .metrics import MATCHES, POLL_ERRORS, ROUTES_SEEN
+from .profiling import SamplingProfiler, claim_profile_request, store_profile
+from .recordings import record_poll
+from .schedule import acquire_poll_lock, poll_due, release_poll_lock, schedule_next, upstream_retry_after
+from .snapshot import (
+    cached_snapshot, commit_poll_state, diff_fingerprints, load_poll_state, publish_snapshot, refresh_snapshot,
+    release_refresh_lock, route_fingerprint, save_poll_state, search_fingerprint, snapshot_locations,
+    stage_poll_state, touch_snapshot,
+)
+from .timing import collect_stages, stage
+from .utils import fetch_routes
+
+BOOKING_URL = 'https://www.hertzfreerider.se/sv-se/'
+PUSHOVER_MESSAGE_LIMIT = 1024  # characters, enforced by Pushover
 
 @shared_task
-def check_hertz():
+def refresh_snapshot_task():
+    """Background revalidation of a stale route snapshot (queued by the dashboard)."""
     try:
-        data = fetch_routes()
+        refresh_snapshot()
     except Exception as e:
-        logging.exception('Fetching error: %s', e)
+        logging.exception('Snapshot refresh error: %s', e)
+    finally:
+        release_refresh_lock()
+
+@shared_task
+def prune_history_task():
+    """Daily retention of the notification history (HERTZ_HISTORY_RETENTION_DAYS) and of
+    delivered outbox messages (HERTZ_OUTBOX_RETENTION_DAYS)."""
+    prune_outbox()
+    return prune_history()
+
+@shared_task
+def prune_observations_task():
+    """Daily roll-up of the route observation store (HERTZ_OBSERVATION_RETENTION_DAYS) and
+    retention of the snapshot archive (HERTZ_ARCHIVE_RETENTION_DAYS)."""
+    prune_archive()
+    return prune_observations()
+
+def _emit_stats(task, event_type, stages, **fields):
+    """Publish a Celery event with the run's stage timings (only when running in a worker)."""
+    if task.request.called_directly or task.request.is_eager:
         return
+    stages = {name: dict(entry, seconds=round(entry['seconds'], 6)) for name, entry in stages.items()}
+    task.send_event(event_type, stages=stages, **fields)
+
+@shared_task(bind=True)
+def check_hertz(self, force=False):
+    """Poll upstream, match what changed against all saved searches and queue notifications.
+
+    Beat calls this every HERTZ_MIN_CHECK_INTERVAL; it only polls when the adaptive schedule
+    says a poll is due (`force=True` skips that check) and never while another poll runs.
 
-    # Handle the actual API structure: array of location pairs with routes
-    if not isinstance(data, list):
-        logging.warning('Unexpected API response format, expected list')
+    With more than HERTZ_MATCH_SHARD_SIZE searches, matching is handed to a chord of
+    `match_shard` tasks (see `_poll`); the poll lock then stays held until its body,
+    `finish_poll`, has run.
+    """
+    if not force and not poll_due():
         return
+    token = acquire_poll_lock()
+    if token is None:
+        logging.info('Previous poll still running, skipping')
+        return
+    started = time.time()
+    stats = None
+    sharded = False
+    try:
+        # `manage.py profile_poll` arms a one-off sampling profile of the next poll
+        profile_request = claim_profile_request()
+        profiler = SamplingProfiler(profile_request['interval']) if profile_request else nullcontext()
+        with profiler, collect_stages() as stages:
+            with stage('poll'):
+                stats = _poll(token, started)
+        sharded = 'shards' in stats
+        if profile_request:
+            store_profile(profiler)
+        _emit_stats(self, 'task-poll-stats', stages, **stats)
+    finally:
+        if not sharded:  # otherwise finish_poll / abort_poll release and reschedule
+            release_poll_lock(token)
+            schedule_next(stats, started)
+    return stats
+
+def _poll(token, started):
+    """One poll; returns its counts (routes, churn, matches, queued, urgent_searches, source_errors) or the fetch error.
+
+    A sharded poll returns once its match shards are queued: the counts then have `shards`
+    instead of `matches` / `queued`, which `finish_poll` adds up (and logs). When the chord
+    ran inline (eager), they are `finish_poll`'s combined counts plus `shards`.
+    """
+    state = load_poll_state() or {}
+    current = cached_snapshot()
+    # Conditional request: an unchanged catalogue costs a 304 instead of ~700 KB + parsing.
+    # Only safe when the cached snapshot is exactly the payload this task processed last time
+    # (a dashboard-triggered refresh may have published a newer one we have not matched yet).
+    # Without validators every country is fetched in full; the snapshot's per-country routes
+    # still stand in for countries that fail.
+    previous = current
+    if current and not (state.get('validators') and current.get('validators') == state['validators']):
+        previous = {'sources': current.get('sources')}
+    try:
+        result = fetch_routes(previous)
+    except Exception as e:
+        logging.exception('Fetching error: %s', e)
+        POLL_ERRORS.inc()
+        return {'error': str(e) or type(e).__name__, 'retry_after': upstream_retry_after(e)}
+    observed_at = timezone.now()
+    previously_observed_at = mark_observed(observed_at)
+    if result.payloads:
+        with stage('record'):
+            # HERTZ_RECORD_DIR: keep the payloads for `manage.py replay_snapshots`; never blocks the poll
+            try:
+                record_poll(result.payloads, observed_at)
+            except Exception as e:
+                logging.exception('Recording the fetched payloads failed: %s', e)
+    if settings.HERTZ_ARCHIVE_DIR:
+        with stage('archive'):
+            # Every poll's routes, delta-encoded (scheduler.archive); never blocks the poll
+            try:
+                archive_poll(current['routes'] if result.not_modified else result.data, observed_at)
+            except Exception as e:
+                logging.exception('Archiving the snapshot failed: %s', e)
+
+    with stage('load_searches'):
+        searches = list(SavedSearch.objects.select_related('owner'))
+        search_fingerprints = {s.id: search_fingerprint(s) for s in searches}
+    previous_searches = state.get('searches', {})
+    # Searches whose window starts within HERTZ_URGENT_DAYS: rides for them go fast, poll more often
+    today = timezone.localdate()
+    urgent_until = today + datetime.timedelta(days=settings.HERTZ_URGENT_DAYS)
+    urgent_searches = sum(1 for s in searches if s.date_to >= today and s.date_from <= urgent_until)
+
+    if result.not_modified:
+        touch_snapshot(current)
+        # Nothing upstream changed: only continue if there are searches to catch up on
+        # (created/edited since the last poll)
+        if search_fingerprints == previous_searches:
+            return {'routes': len(current['routes']), 'churn': 0, 'matches': 0, 'queued': 0,
+                    'urgent_searches': urgent_searches,
+                    'source_errors': len(result.errors)}
+        data = current['routes']
+    else:
+        data = result.data
+
+    # Parsed Route records (see scheduler.routes), keyed by ride id
+    routes = {route.id: route for route in data}
+    ROUTES_SEEN.inc(len(routes))
+
+    # Diff against the previous poll so matching and DB work scale with churn, not catalogue size
+    with stage('diff'):
+        route_fingerprints = {route_id: route_fingerprint(route) for route_id, route in routes.items()}
+        delta = diff_fingerprints(state.get('routes'), route_fingerprints)
+    if delta['removed']:
+        logging.info('Routes no longer listed: %s', ', '.join(delta['removed']))
+    logging.info('Snapshot delta: %s added, %s changed, %s removed',
+                 len(delta['added']), len(delta['changed']), len(delta['removed']))
+    if delta['added'] or delta['removed']:
+        with stage('observe'):
+            # Route history / corridor statistics (scheduler.observations); never blocks notifying
+            try:
+                countries = {route.id: country for country, listed in result.sources.items() for route in listed}
+                record_observations(routes, delta, observed_at, countries, previously_observed_at)
+            except Exception as e:
+                logging.exception('Recording route observations failed: %s', e)
+    snapshot = current
+    if not result.not_modified:
+        with stage('publish'):
+            # Share the snapshot (and what changed) with the dashboard via the snapshot cache
+            snapshot = publish_snapshot(data, delta=delta, validators=result.validators, sources=result.sources)
+            # Push the delta to open dashboards (Redis pub/sub -> SSE)
+            publish_snapshot_event(snapshot)
+
+    # Routes that must be checked against every search: new and changed ones. Earlier
+    # matches need no recheck: they were recorded and queued together (scheduler.outbox)
+    recheck = set(delta['added']) | set(delta['changed'])
+    # Searches created or edited since the last poll have never seen the unchanged routes
+    new_searches = {s.id for s in searches if previous_searches.get(s.id) != search_fingerprints[s.id]}
+    poll_state = {
+        'routes': route_fingerprints,
+        'searches': search_fingerprints,
+        'validators': result.validators,
+    }
+    stats = {
+        'routes': len(routes),
+        'churn': len(delta['added']) + len(delta['changed']) + len(delta['removed']),
+        'urgent_searches': urgent_searches,
+        'source_errors': len(result.errors),  # countries that failed and kept their last routes
+    }
+
+    shard_count = min(settings.HERTZ_MATCH_MAX_SHARDS, math.ceil(len(searches) / settings.HERTZ_MATCH_SHARD_SIZE))
+    shards = partition_by_owner(searches, shard_count)
+    if len(shards) > 1 and (recheck or new_searches):
+        # Fan out: each shard (any worker) matches its owners' searches against the published
+        # snapshot and queues their notifications; the state only advances once all succeeded
+        stage_poll_state(token, poll_state)
+        header = [match_shard.s(ids, sorted(recheck), [i for i in ids if i in new_searches], snapshot['version'])
+                  for ids in shards]
+        finished = chord(header)(finish_poll.s(token, started, stats).on_error(abort_poll.si(token, started)))
+        if finished.ready() and finished.successful():
+            # Run inline (eager: tests, replay_snapshots): the shards' counts are in already
+            return dict(finished.get(), shards=len(shards))
+        return dict(stats, shards=len(shards))
+
+    with stage('match'):
+        # Patterns are resolved against the snapshot's location index (names, cities, codes)
+        candidates = _match(routes, recheck, searches, new_searches, snapshot_locations(snapshot))
+    matches = sum(len(owner_ids) for _, owner_ids in candidates)
+    MATCHES.inc(matches)
+    queued = _queue_notifications(candidates)
+
+    save_poll_state(poll_state)
+    return dict(stats, matches=matches, queued=queued)
+
+def _match(routes, recheck, searches, new_searches, locations):
+    """Pass 1: match routes against the search index (no DB access).
+
+    Routes in `recheck` are checked against every search, all others only against the
+    searches in `new_searches` (ids). Returns [(Route, owner ids of the matching searches)].
+    """
+    matcher = SearchMatcher(searches, locations)
+    new_matcher = SearchMatcher((s for s in searches if s.id in new_searches), locations)
+    candidates = []
+    for route_id in (routes if new_matcher.searches else recheck):
+        active_matcher = matcher if route_id in recheck else new_matcher
+        route = routes.get(route_id)
+        if route is None or not active_matcher.searches:
+            continue
+        # Date overlap + origin/destination patterns, only against searches that can match
+        matches = active_matcher.match(route.pickup_location, route.return_location,
+                                       route.pickup_date, route.return_date)
+        if matches:
+            candidates.append((route, {search.owner_id for search in matches}))
+    return candidates
+
+@shared_task(bind=True, ignore_result=False)
+def match_shard(self, search_ids, recheck, new_searches, version):
+    """One shard of a sharded poll: the searches `search_ids` (a set of whole owners, see
+    `partition_by_owner`) against the snapshot the poll published. Returns its counts for
+    `finish_poll`.
+
+    Raising fails the chord: the poll state is not advanced and the next poll matches the
+    same delta again (the outbox drops what this or another shard queued already).
+    """
+    snapshot = cached_snapshot()
+    if snapshot is None:
+        raise RuntimeError('Route snapshot missing, cannot match shard')
+    if snapshot['version'] != version:
+        # A dashboard refresh published a newer payload; the next poll diffs against it
+        logging.info('Shard matches snapshot %s instead of %s', snapshot['version'], version)
+    with collect_stages() as stages:
+        with stage('load_searches'):
+            searches = list(SavedSearch.objects.select_related('owner').filter(id__in=search_ids))
+        with stage('match'):
+            routes = {route.id: route for route in snapshot['routes']}
+            candidates = _match(routes, set(recheck), searches, set(new_searches), snapshot_locations(snapshot))
+        matches = sum(len(owner_ids) for _, owner_ids in candidates)
+        MATCHES.inc(matches)
+        queued = _queue_notifications(candidates)
+    _emit_stats(self, 'task-match-stats', stages, searches=len(searches), matches=matches, queued=queued)
+    return {'searches': len(searches), 'matches': matches, 'queued': queued}
+
+@shared_task
+def finish_poll(results, token, started, stats):
+    """Chord body of a sharded poll: add up the shards' counts, commit the staged poll
+    state, release the poll lock and schedule the next poll."""
+    stats = dict(stats, matches=sum(r['matches'] for r in results), queued=sum(r['queued'] for r in results))
+    try:
+        if not commit_poll_state(token):
+            logging.warning('Sharded poll outlived HERTZ_POLL_LOCK_TIMEOUT, its delta will be matched again')
+    finally:
+        release_poll_lock(token)
+        schedule_next(stats, started)
+    logging.info('Sharded poll done: %s shards, %s matches, %s queued in %.1f s',
+                 len(results), stats['matches'], stats['queued'], time.time() - started)
+    return stats
+
+@shared_task
+def abort_poll(token, started):
+    """Error callback of a sharded poll: a shard failed, so keep the previous poll state
+    (the staged one expires) and back off like any failed poll."""
+    release_poll_lock(token)
+    schedule_next(None, started)
+
+@shared_task(bind=True)
+def match_search(self, search_id):
+    """Reverse match: one just-saved search against the cached snapshot (queued by the signal
+    in scheduler.signals), so its first alerts do not wait for the next poll.
+
+    Never fetches upstream and never touches the other searches; notifications go through
+    the poll's dedup / claim / queue step, so a ride is not alerted twice if the next poll
+    (which also catches up on new and edited searches) matches it again.
+    """
+    search = SavedSearch.objects.select_related('owner').filter(pk=search_id).first()
+    snapshot = cached_snapshot()
+    if search is None or snapshot is None:
+        return  # deleted meanwhile / no snapshot yet: the next poll covers it
+    with collect_stages() as stages:
+        with stage('reverse_match'):
+            matcher = SearchMatcher([search], snapshot_locations(snapshot))
+            candidates = [(route, {search.owner_id}) for route in snapshot['routes']
+                          if matcher.match(route.pickup_location, route.return_location, route.pickup_date, route.return_date)]
+        MATCHES.inc(len(candidates))
+        queued = _queue_notifications(candidates)
+    logging.info('Reverse match of search %s: %s of %s routes match, %s queued in %.1f ms', search_id,
+                 len(candidates), len(snapshot['routes']), queued, stages['reverse_match']['seconds'] * 1000)
+    _emit_stats(self, 'task-reverse-match-stats', stages, search=search_id, matches=len(candidates), queued=queued)
+    return {'matches': len(candidates), 'queued': queued}
+
+def _queue_notifications(candidates):
+    """Dedup (Route, owner ids) candidates and put the new ones in the notification outbox.
+
+    Shared by the poll, its `match_shard` tasks and `match_search`. Returns the number of
+    (owner, ride) pairs queued.
+    """
+    # Pass 2: dedup every (owner, ride) pair with a single query and group new rides per owner
+    with stage('dedup'):
+        already_notified = notified_pairs(route.id for route, _ in candidates)
+        rides_by_owner = {}
+        for route, owner_ids in candidates:
+            for owner_id in owner_ids:
+                if not is_notified(already_notified, owner_id, route.id):
+                    rides_by_owner.setdefault(owner_id, []).append(route)
+
+    # Pass 3: record + queue in one transaction (scheduler.outbox) and hand delivery to
+    # drain_outbox, so poll latency does not depend on how many rides are new
+    with stage('queue'):
+        # One query for every recipient's delivery settings
+        profiles = {p.user_id: p for p in NotificationProfile.objects.filter(user_id__in=rides_by_owner)} if rides_by_owner else {}
+        queued = enqueue(rides_by_owner, lambda owner_id, routes: _owner_messages(routes, profiles.get(owner_id)))
+    # Large bursts get several senders (on any workers); each claims its own batches
+    for _ in range(min(settings.HERTZ_OUTBOX_SENDERS, math.ceil(queued / settings.HERTZ_OUTBOX_BATCH_SIZE))):
+        drain_outbox.delay()
+    return queued
+
+def _owner_messages(routes, profile):
+    """One owner's new rides as outbox messages: one per ride, or digests."""
+    user_key = profile.pushover_user_key if profile else ''
+    if profile and profile.digest:
+        messages = _digest_messages(routes)
+    else:
+        messages = [(_ride_message(route), None, [route]) for route in routes]
+    return [{'user': user_key, 'title': title, 'message': message, 'routes': message_routes}
+            for message, title, message_routes in messages]
+
+@shared_task(bind=True)
+def drain_outbox(self):
+    """Send due notifications from the outbox (scheduler.outbox): queued after every enqueue
+    and by beat every minute for retries and messages of crashed senders.
+
+    Any number of these may run at once, on any number of workers; each claims its own
+    batches with SKIP LOCKED.
+    """
+    with collect_stages() as stages:
+        with stage('notify'):
+            totals = drain()
+    if totals.pop('more'):
+        drain_outbox.delay()  # bounded runs: continue in a new task instead of hogging this one
+    _emit_stats(self, 'task-notify-stats', stages, **totals)
+    return totals
+
+
+def _ride_message(route):
+    # Notification with additional useful info
+    car_model = route.car_model or 'Unknown car'
+    # Format dates in European style with weekday names
+    pickup_str = route.pickup_date.strftime('%a %d/%m/%Y')
+    return_str = route.return_date.strftime('%a %d/%m/%Y')
+    # HTML message (limited tags supported by Pushover when html=1)
+    # Provide a direct clickable link.
+    return (
+        f"🚗 <b>{route.pickup_location.name}</b> → <b>{route.return_location.name}</b><br><br>"
+        f"📅 {pickup_str} - {return_str}<br>"
+        f"🚙 {car_model}<br>"
+        f"📍 {route.distance or 0:.0f} km<br><br>"
+        f"Book ride <a href=\"{BOOKING_URL}\">here</a>"
+    )
+
+def _digest_messages(routes):
+    """Combine rides into as few messages as fit Pushover's length limit.
 
-    for search in SavedSearch.objects.select_related('owner'):
-        for location_pair in data:
-            # Each location pair has pickupLocationName, returnLocationName, and routes array
-            routes = location_pair.get('routes', [])
-            
-            for route in routes:
-                # Extract route data using correct API field names
-                route_id = str(route.get('id', ''))
-                if not route_id:
-                    continue
-                
-                # Get pickup and return location details
-                pickup_location = route.get('pickupLocation', {})
-                return_location = route.get('returnLocation', {})
-                
-                origin = pickup_location.get('name', '')
-                destination = return_location.get('name', '')
-                
-                # Get datetime strings and convert to dates
-                pickup_datetime_str = route.get('availableAt', '')
-                return_datetime_str = route.get('latestReturn', '')
-                
-                try:
-                    pickup_date = datetime.datetime.fromisoformat(pickup_datetime_str[:10]).date()
-                    return_date = datetime.datetime.fromisoformat(return_datetime_str[:10]).date()
-                except (ValueError, IndexError):
-                    continue
-
-                # Check if date ranges overlap (any overlap between search interval and route interval)
-                # Overlap condition: not (search ends before route starts OR search starts after route ends)
-                if (search.date_to < pickup_date) or (search.date_from > return_date):
-                    continue
-                    
-                # Check if locations match search criteria
-                if not wildcard_match(search.origin, origin):
-                    continue
-                if not wildcard_match(search.destination, destination):
-                    continue
-
-                # Skip if already notified
-                if NotifiedRide.objects.filter(ride_id=route_id).exists():
-                    continue
-
-                # Send notification with additional useful info
-                car_model = route.get('carModel', 'Unknown car')
-                distance = route.get('distance', 0)
-                travel_time = route.get('travelTime', None)
-                # Parse datetimes for DB fields
-                available_at = None
-                latest_return = None
-                available_at = datetime.datetime.fromisoformat(route.get('availableAt', ''))
-                latest_return = datetime.datetime.fromisoformat(route.get('latestReturn', ''))
-                
-                # Format dates in European style with weekday names
-                pickup_str = pickup_date.strftime('%a %d/%m/%Y')
-                return_str = return_date.strftime('%a %d/%m/%Y')
-
-                # HTML message (limited tags supported by Pushover when html=1)
-                # Provide a direct clickable link.
-                msg = (
-                    f"🚗 <b>{origin}</b> → <b>{destination}</b><br><br>"
-                    f"📅 {pickup_str} - {return_str}<br>"
-                    f"🚙 {car_model}<br>"
-                    f"📍 {distance:.0f} km<br><br>"
-                    f"Book ride <a href=\"https://www.hertzfreerider.se/sv-se/\">here</a>"
-                )
-
-                send_pushover(msg, html=True)
-                NotifiedRide.objects.create(
-                    ride_id=route_id,
-                    pickup_location_name=origin,
-                    return_location_name=destination,
-                    distance=distance,
-                    available_at=available_at,
-                    latest_return=latest_return,
-                    travel_time=travel_time,
-                    car_type=car_model
-                )
+    Returns [(message, title, routes in that message)].
+    """
+    footer = f"<br>Book rides <a href=\"{BOOKING_URL}\">here</a>"
+    chunks = [[]]
+    length = len(footer)
+    for route in routes:
+        line = (
+            f"🚗 <b>{route.pickup_location.name}</b> → <b>{route.return_location.name}</b><br>"
+            f"📅 {route.pickup_date.strftime('%d/%m')} - {route.return_date.strftime('%d/%m')} · "
+            f"{route.car_model or 'Unknown car'}<br>"
+        )
+        if chunks[-1] and length + len(line) > PUSHOVER_MESSAGE_LIMIT:
+            chunks.append([])
+            length = len(footer)
+        chunks[-1].append((route, line))
+        length += len(line)
+    total = len(routes)
+    title = f"Hertz Freerider – {total} new ride{'s' if total != 1 else ''}"
+    return [(''.join(line for _, line in chunk) + footer, title, [route for route, _ in chunk]) for chunk in chunks]
@@ -4,13 +4,6 @@ from django import template
 
 register = template.Library()
 
-@register.filter
-def get_item(d, key):
-    try:
-        return d.get(key, 0)
-    except Exception:
-        return ''
-
 @register.filter(name='add_class')
 def add_class(field, css):
     """Add CSS class(es) to a Django form field widget in templates.
@@ -0,0 +1,730 @@
+import dataclasses, datetime, io, json, os, shutil, tempfile, time
+from pathlib import Path
+from unittest import mock
+import requests
+from django.conf import settings
+from django.contrib.admin import AdminSite
+from django.contrib.auth import get_user_model
+from django.core.exceptions import ValidationError
+from django.core.cache import cache
+from django.core.management import call_command
+from django.db import connection
+from django.test import SimpleTestCase, TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from hertz_notifier.celery import app as celery_app
+from . import archive, dispatch, outbox, recordings, tasks
+from .admin import OutboxMessageAdmin
+from .checks import outbox_lease_check
+from .forms import SavedSearchForm
+from .geo import MAX_RADIUS_KM, GeoGrid
+from .history import history_entries, history_page, prune_history
+from .metrics import render_metrics
+from .observations import record_observations
+from .locations import LocationIndex
+from .matching import SearchMatcher
+from .models import CorridorStats, NotificationProfile, NotifiedRide, OutboxMessage, RouteObservation, SavedSearch
+from .routes import Location, Route
+from .snapshot import diff_fingerprints, publish_snapshot, route_fingerprint
+from .tasks import check_hertz
+from .utils import FetchResult, fetch_routes, pushover_payload
+
+LOCMEM_CACHE = {'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}}
+PICKUP_AT = timezone.make_aware(datetime.datetime(2025, 8, 6, 8, 15))
+
+
+def make_route(n, pickup_at=PICKUP_AT):
+    """Route number `n`: from station `Origin <n>` to `Destination <n>`, a day long."""
+    latest_return = pickup_at + datetime.timedelta(days=1)
+    return Route(
+        id=str(1000000 + n),
+        pickup_location=Location(name=f'Origin {n}', city=f'City {n}', trac_code=f'O{n}'),
+        return_location=Location(name=f'Destination {n}', city=f'Town {n}', trac_code=f'D{n}'),
+        car_model='VOLVO V60',
+        distance=300.0,
+        travel_time=240,
+        available_at=pickup_at,
+        latest_return=latest_return,
+        pickup_date=timezone.localtime(pickup_at).date(),
+        return_date=timezone.localtime(latest_return).date(),
+        travel_hours=4.0,
+        available_at_display=timezone.localtime(pickup_at).strftime('%Y-%m-%d %H:%M'),
+        latest_return_display=timezone.localtime(latest_return).strftime('%Y-%m-%d %H:%M'),
+    )
+
+
+@override_settings(CACHES=LOCMEM_CACHE, HERTZ_COUNTRIES=['SWEDEN'], HERTZ_RECORD_DIR='', HERTZ_ARCHIVE_DIR='')
+class PollQueryCountTests(TestCase):
+    """check_hertz must cost the same number of queries however many routes and searches match."""
+
+    def setUp(self):
+        cache.clear()
+
+    def poll(self, size):
+        """Poll `size` new routes against `size` searches (one owner each, one route each)."""
+        User = get_user_model()
+        offset = SavedSearch.objects.count()
+        for n in range(offset, offset + size):
+            SavedSearch.objects.create(
+                owner=User.objects.create(username=f'user{n}'), origin=f'Origin {n}', destination=f'Destination {n}',
+                date_from=datetime.date(2025, 8, 1), date_to=datetime.date(2025, 8, 30))
+        routes = [make_route(n) for n in range(offset, offset + size)]
+        result = FetchResult(data=routes, sources={'SWEDEN': routes}, validators={'SWEDEN': {}})
+        with mock.patch('scheduler.tasks.fetch_routes', return_value=result), \
+                mock.patch('scheduler.tasks.publish_snapshot_event'), \
+                mock.patch('scheduler.tasks.drain_outbox'), \
+                CaptureQueriesContext(connection) as queries:
+            stats = check_hertz(force=True)
+        self.assertEqual(stats['queued'], size)
+        self.assertEqual(stats['matches'], size)
+        return len(queries)
+
+    @override_settings(HERTZ_MATCH_SHARD_SIZE=5)
+    def test_sharded_poll_reports_the_combined_counts(self):
+        # Shards run inline, as in replay_snapshots
+        self.addCleanup(setattr, celery_app.conf, 'task_always_eager', celery_app.conf.task_always_eager)
+        celery_app.conf.task_always_eager = True
+        self.poll(12)  # asserts matches == queued == 12, added up over the shards
+        self.assertEqual(NotifiedRide.objects.count(), 12)
+
+    def test_queries_do_not_grow_with_routes_and_searches(self):
+        small = self.poll(10)
+        cache.clear()  # a fresh poll state: every route is new again
+        self.assertEqual(self.poll(20), small)
+        self.assertEqual(NotifiedRide.objects.count(), 10 + 20)
+
+
+class DiffFingerprintsTests(SimpleTestCase):
+    def test_added_changed_and_removed(self):
+        delta = diff_fingerprints({'1': 'a', '2': 'b', '3': 'c'}, {'1': 'a', '2': 'B', '4': 'd'})
+        self.assertEqual(delta, {'added': ['4'], 'changed': ['2'], 'removed': ['3']})
+
+    def test_everything_is_new_without_a_previous_state(self):
+        self.assertEqual(diff_fingerprints(None, {'1': 'a'}), {'added': ['1'], 'changed': [], 'removed': []})
+
+    def test_route_fingerprint_covers_the_notified_fields(self):
+        route = make_route(1)
+        self.assertEqual(route_fingerprint(route), route_fingerprint(dataclasses.replace(route)))
+        self.assertNotEqual(route_fingerprint(route), route_fingerprint(dataclasses.replace(route, distance=301.0)))
+
+
+class _Response:
+    """The parts of a streamed `requests` response that `fetch_source` reads."""
+
+    def __init__(self, status_code, body=b'', headers=None):
+        self.status_code, self.headers = status_code, headers or {}
+        self.raw = io.BytesIO(body)
+        self.elapsed = datetime.timedelta(milliseconds=5)
+
+    def raise_for_status(self):
+        pass
+
+    def close(self):
+        pass
+
+
+@override_settings(HERTZ_COUNTRIES=['SWEDEN', 'NORWAY', 'DENMARK'], HERTZ_RECORD_DIR='',
+                   HERTZ_API_URL='https://api.example.com/transport-routes')
+class FetchRoutesTests(SimpleTestCase):
+    def test_a_failing_country_keeps_its_last_routes(self):
+        with open(os.path.join(settings.BASE_DIR, 'hertz_api_example.json'), 'rb') as f:
+            payload = f.read()
+        norway, denmark = [make_route(1)], [make_route(2)]
+        previous = {'sources': {'NORWAY': norway, 'DENMARK': denmark},
+                    'validators': {'NORWAY': {'etag': '"no"'}, 'DENMARK': {'etag': '"dk"'}}}
+        requests = {}
+
+        def get(url, headers=None, **kwargs):
+            country = url.rsplit('=', 1)[1]
+            requests[country] = headers
+            if country == 'NORWAY':
+                raise ConnectionError('connection reset')
+            if country == 'DENMARK':
+                return _Response(304)
+            return _Response(200, payload, {'ETag': '"se"'})
+
+        with mock.patch('scheduler.utils.api_session', return_value=mock.Mock(get=get)):
+            result = fetch_routes(previous)
+        self.assertEqual(requests['DENMARK'], {'If-None-Match': '"dk"'})
+        self.assertEqual(requests['SWEDEN'], {})
+        self.assertFalse(result.not_modified)
+        self.assertEqual(list(result.errors), ['NORWAY'])
+        self.assertEqual(len(result.sources['SWEDEN']), 95)                        # fresh
+        self.assertIs(result.sources['NORWAY'], norway)                             # failed: last routes
+        self.assertIs(result.sources['DENMARK'], denmark)                           # 304: last routes
+        self.assertEqual(result.validators['NORWAY'], {'etag': '"no"'})
+        self.assertEqual(result.validators['SWEDEN']['etag'], '"se"')
+        self.assertEqual(len(result.data), 95 + 2)
+
+    def test_only_a_failure_everywhere_fails_the_fetch(self):
+        with mock.patch('scheduler.utils.api_session', return_value=mock.Mock(get=mock.Mock(side_effect=OSError('down')))), \
+                self.assertRaises(OSError):
+            fetch_routes({'sources': {'NORWAY': [make_route(1)]}})
+
+
+@override_settings(CACHES=LOCMEM_CACHE, HERTZ_COUNTRIES=['SWEDEN'], HERTZ_RECORD_DIR='', HERTZ_ARCHIVE_DIR='',
+                   HERTZ_MATCH_SHARD_SIZE=100)
+class PollDeltaTests(TestCase):
+    """Polls only match routes that are new or changed, plus everything for new or edited searches."""
+
+    def setUp(self):
+        cache.clear()
+        User = get_user_model()
+        self.searches = [
+            SavedSearch.objects.create(owner=User.objects.create(username=f'delta{n}'), origin=origin,
+                                       destination=destination, date_from=datetime.date(2025, 8, 1),
+                                       date_to=datetime.date(2025, 8, 30))
+            for n, (origin, destination) in enumerate([('Origin 1', 'Destination 1'), ('Origin 2', 'Destination 2'),
+                                                       ('Nowhere', 'Nowhere')])]
+
+    def poll(self, routes):
+        """Poll `routes`; returns (stats, the recheck and new-search sets handed to matching)."""
+        result = FetchResult(data=routes, sources={'SWEDEN': routes}, validators={'SWEDEN': {'etag': '"1"'}})
+        with mock.patch('scheduler.tasks.fetch_routes', return_value=result), \
+                mock.patch('scheduler.tasks.publish_snapshot_event'), \
+                mock.patch('scheduler.tasks.drain_outbox'), \
+                mock.patch('scheduler.tasks._match', wraps=tasks._match) as match:
+            stats = check_hertz(force=True)
+        _, recheck, _, new_searches, _ = match.call_args.args
+        return stats, recheck, new_searches
+
+    def test_only_the_delta_is_matched(self):
+        stats, recheck, new_searches = self.poll([make_route(1), make_route(2), make_route(3)])
+        self.assertEqual(recheck, {'1000001', '1000002', '1000003'})
+        self.assertEqual(new_searches, {search.id for search in self.searches})
+        self.assertEqual((stats['routes'], stats['churn'], stats['queued']), (3, 3, 2))
+
+        # Route 2 changed, 3 is gone, 4 is new
+        stats, recheck, new_searches = self.poll([make_route(1), dataclasses.replace(make_route(2), distance=310.0),
+                                                  make_route(4)])
+        self.assertEqual((recheck, new_searches), ({'1000002', '1000004'}, set()))
+        self.assertEqual((stats['routes'], stats['churn'], stats['matches'], stats['queued']), (3, 3, 1, 0))
+
+    def test_an_unchanged_catalogue_still_reports_its_routes(self):
+        routes = [make_route(1), make_route(2), make_route(3)]
+        self.poll(routes)
+        unchanged = FetchResult(not_modified=True, sources={'SWEDEN': routes}, validators={'SWEDEN': {'etag': '"1"'}})
+        with mock.patch('scheduler.tasks.fetch_routes', return_value=unchanged) as fetch:
+            stats = check_hertz(force=True)
+        self.assertEqual(fetch.call_args.args[0]['validators'], {'SWEDEN': {'etag': '"1"'}})  # conditional
+        self.assertEqual((stats['routes'], stats['churn'], stats['queued']), (3, 0, 0))
+
+    def test_an_edited_search_catches_up_on_unchanged_routes(self):
+        routes = [make_route(1), make_route(2)]
+        self.poll(routes)
+        edited = self.searches[2]
+        edited.origin, edited.destination = 'Origin 1', 'Destination 1'
+        edited.save()
+        stats, recheck, new_searches = self.poll(routes)
+        self.assertEqual((recheck, new_searches), (set(), {edited.id}))
+        self.assertEqual((stats['churn'], stats['matches'], stats['queued']), (0, 1, 1))
+        self.assertTrue(NotifiedRide.objects.filter(owner=edited.owner, ride_id='1000001').exists())
+
+
+class HistoryTests(TestCase):
+    def setUp(self):
+        User = get_user_model()
+        self.user, self.other = User.objects.create(username='history'), User.objects.create(username='other')
+        self.now = timezone.now()
+
+    def ride(self, ride_id, owner, days_ago, **fields):
+        ride = NotifiedRide.objects.create(ride_id=ride_id, owner=owner, **fields)
+        # notified_at is auto_now_add: backdate it afterwards
+        NotifiedRide.objects.filter(pk=ride.pk).update(notified_at=self.now - datetime.timedelta(days=days_ago))
+        return ride
+
+    def test_pages_follow_the_cursor_newest_first(self):
+        for n in range(7):
+            self.ride(f'own{n}', self.user, days_ago=n)
+        self.ride('legacy', None, days_ago=2.5)
+        self.ride('foreign', self.other, days_ago=1.5)
+        seen, cursor = [], None
+        while True:
+            rides, cursor = history_page(self.user, cursor=cursor, limit=3)
+            seen += [ride.ride_id for ride in rides]
+            if cursor is None:
+                break
+        self.assertEqual(seen, ['own0', 'own1', 'own2', 'legacy', 'own3', 'own4', 'own5', 'own6'])
+
+    def test_filters_apply_across_pages(self):
+        for n in range(4):
+            self.ride(f'own{n}', self.user, days_ago=n, pickup_location_name='Göteborg' if n % 2 else 'Malmö')
+        rides, cursor = history_page(self.user, {'pickup': 'göteborg'}, limit=1)
+        self.assertEqual([ride.ride_id for ride in rides], ['own1'])
+        rides, cursor = history_page(self.user, {'pickup': 'göteborg'}, cursor=cursor, limit=1)
+        self.assertEqual([ride.ride_id for ride in rides], ['own3'])
+        self.assertIsNone(cursor)
+
+    def test_prune_keeps_rides_that_may_still_be_listed(self):
+        past, future = self.now - datetime.timedelta(days=1), self.now + datetime.timedelta(days=1)
+        self.ride('returned', self.user, days_ago=200, latest_return=past)
+        self.ride('listed', self.user, days_ago=200, latest_return=future)
+        self.ride('recent', self.user, days_ago=10, latest_return=past)
+        self.ride('no-return-picked-up', self.user, days_ago=200, available_at=past)
+        self.ride('no-return-upcoming', self.user, days_ago=200, available_at=future)
+        self.ride('no-dates', self.user, days_ago=200)
+        self.assertEqual(prune_history(180), 3)
+        self.assertEqual(set(NotifiedRide.objects.values_list('ride_id', flat=True)),
+                         {'listed', 'recent', 'no-return-upcoming'})
+
+
+class RouteObservationTests(TestCase):
+    MONDAY = timezone.make_aware(datetime.datetime(2025, 8, 4, 10, 0))
+
+    def observe(self, routes, delta, hours, last_seen_hours=None):
+        now = self.MONDAY + datetime.timedelta(hours=hours)
+        last_seen = self.MONDAY + datetime.timedelta(hours=last_seen_hours) if last_seen_hours is not None else None
+        return record_observations({route.id: route for route in routes}, delta, now, {}, last_seen)
+
+    def test_a_listing_is_counted_closed_and_relisted(self):
+        route = make_route(1)
+        self.assertEqual(self.observe([route], {'added': [route.id], 'removed': []}, 0), (1, 0))
+        # Gone at the poll 5 h later; the poll before it (3 h) was the last to list it
+        self.assertEqual(self.observe([], {'added': [], 'removed': [route.id]}, 5, last_seen_hours=3), (0, 1))
+        observation = RouteObservation.objects.get()
+        self.assertEqual((observation.last_seen, observation.removed_at),
+                         (self.MONDAY + datetime.timedelta(hours=3), self.MONDAY + datetime.timedelta(hours=5)))
+        corridor = CorridorStats.objects.get()
+        self.assertEqual((corridor.listings, corridor.closed, corridor.lifetime_seconds), (1, 1, 3 * 3600))
+        self.assertEqual(corridor.lifetime_counts, [0, 0, 1] + [0] * 8)  # the (2, 4] h bucket
+        self.assertEqual(corridor.weekday_counts, [1, 0, 0, 0, 0, 0, 0])
+
+        self.assertEqual(self.observe([route], {'added': [route.id], 'removed': []}, 24), (1, 0))  # Tuesday
+        observation.refresh_from_db()
+        self.assertEqual((observation.times_listed, observation.removed_at), (2, None))
+        self.assertEqual(observation.listed_at, self.MONDAY + datetime.timedelta(hours=24))
+        self.assertEqual(observation.first_seen, self.MONDAY)
+        corridor.refresh_from_db()
+        self.assertEqual((corridor.listings, corridor.closed), (2, 1))
+        self.assertEqual(corridor.weekday_counts, [1, 1, 0, 0, 0, 0, 0])
+
+    def test_a_route_still_listed_is_not_started_again(self):
+        route = make_route(1)
+        self.observe([route], {'added': [route.id], 'removed': []}, 0)
+        self.assertEqual(self.observe([route], {'added': [route.id], 'removed': []}, 1), (0, 0))  # lost poll state
+        self.assertEqual(RouteObservation.objects.get().times_listed, 1)
+        self.assertEqual(CorridorStats.objects.get().listings, 1)
+
+
+class MedianLifetimeTests(SimpleTestCase):
+    def corridor(self, counts):
+        counts = counts + [0] * (len(CorridorStats.LIFETIME_BUCKETS) + 1 - len(counts))
+        return CorridorStats(closed=sum(counts), lifetime_counts=counts)
+
+    def test_no_closed_listings(self):
+        self.assertIsNone(self.corridor([]).median_lifetime_hours)
+
+    def test_interpolated_within_the_median_bucket(self):
+        self.assertEqual(self.corridor([0, 0, 2]).median_lifetime_hours, 3.0)              # middle of (2, 4]
+        self.assertAlmostEqual(self.corridor([1, 3]).median_lifetime_hours, 1 + 1 / 3)    # 2nd of 4 in (1, 2]
+        self.assertEqual(self.corridor([2, 0, 0, 2]).median_lifetime_hours, 1.0)           # top of the first bucket
+
+    def test_open_ended_last_bucket_gives_its_lower_bound(self):
+        self.assertEqual(self.corridor([1] + [0] * 9 + [3]).median_lifetime_hours,
+                         float(CorridorStats.LIFETIME_BUCKETS[-1]))
+
+
+class LocationMatchingTests(SimpleTestCase):
+    GAVLE = Location(name='Gävle Bilbolaget / Self Service Kiosk', city='Gävle', trac_code='SWGVX61')
+    GOTEBORG = Location(name='Göteborg Landvetter Flygplats', city='Härryda', trac_code='SWGOT50')
+    VISBY = Location(name='Visby Flygplats', city='Visby', trac_code='SWVBY01')
+    VASBY = Location(name='Upplands Väsby', city='Upplands Väsby', trac_code='SWUVB01')
+
+    def setUp(self):
+        self.index = LocationIndex([self.GAVLE, self.GOTEBORG, self.VISBY, self.VASBY])
+
+    def resolve(self, pattern):
+        return {self.index.locations[i] for i in self.index.resolve(pattern)}
+
+    def test_patterns_ignore_case_and_accents(self):
+        self.assertEqual(self.resolve('gavle*'), {self.GAVLE})
+        self.assertEqual(self.resolve('GÄVLE'), {self.GAVLE})
+        self.assertEqual(self.resolve('*flygplats'), {self.GOTEBORG, self.VISBY})
+        self.assertEqual(self.resolve('*'), set(self.index.locations))
+
+    def test_city_code_and_words(self):
+        self.assertEqual(self.resolve('Härryda'), {self.GOTEBORG})
+        self.assertEqual(self.resolve('swgvx61'), {self.GAVLE})
+        self.assertEqual(self.resolve('Landvetter Göteborg'), {self.GOTEBORG})
+
+    def test_typos_only_when_no_word_matches_exactly(self):
+        self.assertEqual(self.resolve('Götebrog'), {self.GOTEBORG})
+        self.assertEqual(self.resolve('Visby'), {self.VISBY})     # not Väsby, one edit away
+        self.assertEqual(self.resolve('Gvl'), set())              # too short to be fuzzy
+
+    def test_search_matcher_checks_both_sides_and_dates(self):
+        search = SavedSearch(id=1, owner_id=1, origin='gavle', destination='Göteborg*',
+                             date_from=datetime.date(2025, 8, 5), date_to=datetime.date(2025, 8, 10))
+        matcher = SearchMatcher([search], self.index)
+        self.assertEqual(matcher.match(self.GAVLE, self.GOTEBORG, datetime.date(2025, 8, 9), datetime.date(2025, 8, 12)),
+                         [search])
+        self.assertEqual(matcher.match(self.GOTEBORG, self.GAVLE, datetime.date(2025, 8, 9), datetime.date(2025, 8, 12)), [])
+        self.assertEqual(matcher.match(self.GAVLE, self.GOTEBORG, datetime.date(2025, 8, 11), datetime.date(2025, 8, 12)), [])
+
+
+class RadiusSearchTests(TestCase):
+    def setUp(self):
+        self.owner = get_user_model().objects.create(username='radius')
+
+    def search(self, **fields):
+        fields = dict(owner=self.owner, origin='55.6, 13.0', destination='*',
+                      date_from=datetime.date(2025, 8, 1), date_to=datetime.date(2025, 8, 30), **fields)
+        return SavedSearch(**fields)
+
+    def test_radius_is_bounded(self):
+        with self.assertRaises(ValidationError) as raised:
+            self.search(origin_radius_km=MAX_RADIUS_KM + 1).full_clean()
+        self.assertIn('origin_radius_km', raised.exception.message_dict)
+        self.search(origin_radius_km=MAX_RADIUS_KM).full_clean()
+
+    def test_grid_clamps_the_radius(self):
+        grid = GeoGrid([(0, (55.6, 13.0)), (1, (59.3, 18.1)), (2, (-33.9, 151.2))])
+        self.assertEqual(grid.within(55.6, 13.0, 20000), {0})
+        self.assertEqual(grid.within(57.0, 15.0, MAX_RADIUS_KM), {0, 1})
+
+    def test_saving_outside_a_form_geocodes_the_centre(self):
+        search = self.search(origin_radius_km=50)
+        search.save()  # e.g. the admin or the shell
+        search.refresh_from_db()
+        self.assertEqual((search.origin_lat, search.origin_lon), (55.6, 13.0))
+
+    def test_unplaceable_centre_is_a_form_error(self):
+        form = SavedSearchForm(data={'origin': 'Nowhere', 'origin_radius_km': 50, 'destination': '*',
+                                     'date_from': '2025-08-01', 'date_to': '2025-08-30'})
+        with override_settings(CACHES=LOCMEM_CACHE):
+            self.assertFalse(form.is_valid())
+        self.assertIn('origin', form.errors)
+
+    def test_moving_the_centre_geocodes_again(self):
+        search = self.search(origin_radius_km=50)
+        search.save()
+        search = SavedSearch.objects.get(pk=search.pk)
+        search.origin = '59.3, 18.1'
+        search.full_clean()
+        self.assertEqual((search.origin_lat, search.origin_lon), (59.3, 18.1))
+
+
+class OutboxTests(TestCase):
+    def setUp(self):
+        self.owner = get_user_model().objects.create(username='outbox')
+
+    def enqueue(self, *numbers):
+        routes = [make_route(n) for n in numbers]
+        return outbox.enqueue({self.owner.pk: routes}, lambda owner_id, routes: [
+            {'user': 'key', 'title': None, 'message': route.id, 'routes': [route]} for route in routes])
+
+    def test_a_ride_is_queued_once(self):
+        self.assertEqual(self.enqueue(1, 2), 2)
+        self.assertEqual(self.enqueue(2, 3), 1)  # ride 2 is already recorded for this owner
+        self.assertEqual(OutboxMessage.objects.count(), 3)
+        self.assertEqual(NotifiedRide.objects.count(), 3)
+
+    def test_messages_not_started_go_back_unchanged(self):
+        self.enqueue(1, 2)
+        with mock.patch('scheduler.outbox.deliver', return_value=[True, None]):
+            totals = outbox.drain(max_batches=1)
+        self.assertEqual((totals['sent'], totals['released']), (1, 1))
+        released = OutboxMessage.objects.get(status=OutboxMessage.PENDING)
+        self.assertEqual((released.attempts, released.locked_until), (0, None))
+
+    def test_drain_stops_when_nothing_can_be_started(self):
+        self.enqueue(1)
+        with mock.patch('scheduler.outbox.deliver', return_value=[None]) as deliver:
+            totals = outbox.drain()
+        self.assertEqual((deliver.call_count, totals['released'], totals['more']), (1, 1, False))
+
+    def test_the_deadline_does_not_follow_a_shifted_clock(self):
+        # replay_snapshots runs the outbox on a virtual clock: the lease is still wall time
+        past = timezone.now() - datetime.timedelta(days=400)
+        with mock.patch('django.utils.timezone.now', return_value=past), \
+                mock.patch('scheduler.outbox.deliver', return_value=[True]) as deliver:
+            self.enqueue(1)
+            outbox.drain(max_batches=1)
+        self.assertGreater(deliver.call_args.kwargs['deadline'], time.time())
+
+    def test_drain_passes_the_lease_as_deadline(self):
+        self.enqueue(1)
+        with mock.patch('scheduler.outbox.deliver', return_value=[True]) as deliver:
+            before = time.time()
+            outbox.drain(max_batches=1)
+        deadline = deliver.call_args.kwargs['deadline']
+        self.assertAlmostEqual(deadline, before + settings.HERTZ_OUTBOX_LEASE - outbox.SETTLE_MARGIN, delta=5)
+
+    def test_no_send_starts_too_close_to_the_deadline(self):
+        session = mock.Mock()
+        with mock.patch('scheduler.dispatch.pushover_session', return_value=session), \
+                mock.patch.dict(os.environ, {'PUSHOVER_TOKEN': 'token'}):
+            late = time.time() + dispatch.worst_case_send_seconds() - 1
+            self.assertEqual(dispatch.deliver([{'user': 'key', 'message': 'hi'}], deadline=late), [None])
+        session.post.assert_not_called()
+
+    def test_an_expired_lease_moves_the_batch_to_another_sender(self):
+        self.enqueue(1)
+        now = timezone.now()
+        stale = outbox.claim_batch(now=now)
+        later = now + datetime.timedelta(seconds=settings.HERTZ_OUTBOX_LEASE + 1)
+        fresh = outbox.claim_batch(now=later)
+        self.assertEqual([m.pk for m in fresh], [m.pk for m in stale])
+        self.assertEqual(outbox.settle(stale, [False]), (0, 0, 0, 0))  # no longer this sender's rows
+        self.assertEqual(outbox.settle(fresh, [True], now=later), (1, 0, 0, 0))
+
+    def test_retry_only_restarts_dead_letters(self):
+        self.enqueue(1, 2, 3)
+        sent, dead, pending = OutboxMessage.objects.order_by('id')
+        OutboxMessage.objects.filter(pk=sent.pk).update(status=OutboxMessage.SENT, attempts=1, sent_at=timezone.now())
+        OutboxMessage.objects.filter(pk=dead.pk).update(status=OutboxMessage.DEAD, attempts=6)
+        later = timezone.now() + datetime.timedelta(hours=1)
+        OutboxMessage.objects.filter(pk=pending.pk).update(attempts=2, next_attempt_at=later)
+        admin = OutboxMessageAdmin(OutboxMessage, AdminSite())
+        with mock.patch.object(admin, 'message_user') as message_user:
+            admin.retry(None, OutboxMessage.objects.all())
+        self.assertIn('1 sent or sending message(s) skipped', message_user.call_args.args[1])
+        sent.refresh_from_db(), dead.refresh_from_db(), pending.refresh_from_db()
+        self.assertEqual((sent.status, sent.attempts), (OutboxMessage.SENT, 1))
+        self.assertEqual((dead.status, dead.attempts), (OutboxMessage.PENDING, 0))
+        self.assertEqual((pending.status, pending.attempts), (OutboxMessage.PENDING, 2))
+        self.assertLess(pending.next_attempt_at, later)
+
+    def test_retrying_a_sent_message_leaves_it_alone(self):
+        self.enqueue(1)
+        OutboxMessage.objects.update(status=OutboxMessage.SENT, attempts=1)
+        self.assertEqual(outbox.requeue_dead(OutboxMessage.objects.all()), 0)
+        self.assertEqual(OutboxMessage.objects.get().status, OutboxMessage.SENT)
+
+    def test_a_dead_letter_shows_as_not_delivered_until_retried(self):
+        self.enqueue(1, 2)
+        with override_settings(HERTZ_OUTBOX_MAX_ATTEMPTS=1), \
+                mock.patch('scheduler.outbox.deliver', return_value=[False, True]):
+            self.assertEqual(outbox.drain()['dead'], 1)
+        dead = OutboxMessage.objects.get(status=OutboxMessage.DEAD)
+        entries = history_entries(history_page(self.owner)[0])
+        self.assertEqual({entry['delivered'] for entry in entries}, {False, True})
+        self.assertIn('hertz_outbox_dead_letters 1.0', render_metrics()[0].decode())
+        self.assertEqual(self.enqueue(*[int(ride_id) - 1000000 for ride_id in dead.ride_ids]), 0)  # still deduped
+
+        self.assertEqual(outbox.requeue_dead(), 1)
+        self.assertTrue(all(entry['delivered'] for entry in history_entries(history_page(self.owner)[0])))
+        self.assertIn('hertz_outbox_dead_letters 0.0', render_metrics()[0].decode())
+
+    def test_lease_must_fit_one_worst_case_send(self):
+        self.assertEqual(outbox_lease_check(None), [])
+        with override_settings(HERTZ_OUTBOX_LEASE=int(outbox.minimum_lease()) - 1):
+            self.assertEqual([error.id for error in outbox_lease_check(None)], ['scheduler.E001'])
+
+
+@override_settings(CACHES=LOCMEM_CACHE)
+class NotificationMessageTests(TestCase):
+    """What `_queue_notifications` writes to the outbox for each owner's new rides."""
+
+    def setUp(self):
+        User = get_user_model()
+        self.own_key, self.default, self.digest = (User.objects.create(username=name)
+                                                   for name in ('own-key', 'default', 'digest'))
+        NotificationProfile.objects.create(user=self.own_key, pushover_user_key='ukey-own')
+        NotificationProfile.objects.create(user=self.digest, pushover_user_key='ukey-digest', digest=True)
+
+    def queue(self, candidates):
+        with mock.patch('scheduler.tasks.drain_outbox'):
+            return tasks._queue_notifications(candidates)
+
+    def test_each_owner_gets_their_own_messages(self):
+        routes = [make_route(1), make_route(2)]
+        self.assertEqual(self.queue([(route, {self.own_key.pk, self.default.pk}) for route in routes]), 4)
+        for owner, user_key in ((self.own_key, 'ukey-own'), (self.default, '')):
+            messages = OutboxMessage.objects.filter(owner=owner).order_by('id')
+            self.assertEqual([(m.user_key, m.ride_ids) for m in messages],
+                             [(user_key, [route.id]) for route in routes])
+
+    def test_owners_without_a_key_go_to_the_global_recipient(self):
+        self.queue([(make_route(1), {self.default.pk})])
+        message = OutboxMessage.objects.get()
+        with mock.patch.dict(os.environ, {'PUSHOVER_USER': 'ukey-global', 'PUSHOVER_TOKEN': 'token'}):
+            self.assertEqual(pushover_payload(message.message, user=message.user_key)['user'], 'ukey-global')
+            self.assertEqual(pushover_payload(message.message, user='ukey-own')['user'], 'ukey-own')
+
+    def test_a_digest_is_split_at_the_message_limit(self):
+        routes = [make_route(n) for n in range(30)]
+        self.assertEqual(self.queue([(route, {self.digest.pk}) for route in routes]), 30)
+        messages = list(OutboxMessage.objects.filter(owner=self.digest).order_by('id'))
+        self.assertGreater(len(messages), 1)
+        self.assertTrue(all(len(m.message) <= tasks.PUSHOVER_MESSAGE_LIMIT for m in messages))
+        self.assertTrue(all(m.user_key == 'ukey-digest' and m.title == 'Hertz Freerider – 30 new rides'
+                            for m in messages))
+        self.assertEqual([ride_id for m in messages for ride_id in m.ride_ids], [route.id for route in routes])
+
+
+@override_settings(CACHES=LOCMEM_CACHE, HERTZ_COUNTRIES=['SWEDEN'], HERTZ_RECORD_DIR='', HERTZ_ARCHIVE_DIR='')
+class ReverseMatchTests(TestCase):
+    """A saved search is matched against the snapshot at once; racing a poll queues nothing twice."""
+
+    def setUp(self):
+        cache.clear()
+        self.owner = get_user_model().objects.create(username='reverse')
+        self.routes = [make_route(1), make_route(2)]
+        publish_snapshot(self.routes)
+        drain = mock.patch('scheduler.tasks.drain_outbox')
+        drain.start()
+        self.addCleanup(drain.stop)
+
+    def save_search(self):
+        """Save a search matching every route; returns what its reverse match returned."""
+        results = []
+        with mock.patch('scheduler.tasks.match_search.delay',
+                        side_effect=lambda pk: results.append(tasks.match_search.apply(args=(pk,)).get())) as delay, \
+                self.captureOnCommitCallbacks(execute=True):
+            search = SavedSearch.objects.create(owner=self.owner, origin='*', destination='*',
+                                                date_from=datetime.date(2025, 8, 1), date_to=datetime.date(2025, 8, 30))
+        delay.assert_called_once_with(search.pk)
+        return results[0]
+
+    def test_saving_queues_the_current_matches_once(self):
+        self.assertEqual(self.save_search(), {'matches': 2, 'queued': 2})
+        self.assertEqual(sorted(NotifiedRide.objects.values_list('ride_id', flat=True)), ['1000001', '1000002'])
+        result = FetchResult(data=self.routes, sources={'SWEDEN': self.routes}, validators={'SWEDEN': {}})
+        with mock.patch('scheduler.tasks.fetch_routes', return_value=result), \
+                mock.patch('scheduler.tasks.publish_snapshot_event'):
+            stats = check_hertz(force=True)  # the poll catches up on the new search too
+        self.assertEqual((stats['matches'], stats['queued']), (2, 0))
+        self.assertEqual(OutboxMessage.objects.count(), 2)
+
+    def test_a_poll_queueing_the_same_ride_first_wins(self):
+        read_pairs = tasks.notified_pairs
+
+        def poll_commits_after_the_dedup_read(ride_ids):
+            pairs = read_pairs(ride_ids)
+            if not NotifiedRide.objects.exists():
+                # The poll matched the new search too and commits ride 1 between our read and insert
+                with mock.patch('scheduler.tasks.notified_pairs', read_pairs):
+                    self.assertEqual(tasks._queue_notifications([(self.routes[0], {self.owner.pk})]), 1)
+            return pairs
+
+        with mock.patch('scheduler.tasks.notified_pairs', side_effect=poll_commits_after_the_dedup_read), \
+                mock.patch('scheduler.outbox.notified_pairs', wraps=outbox.notified_pairs) as retry_read:
+            self.assertEqual(self.save_search(), {'matches': 2, 'queued': 1})
+        retry_read.assert_called_once()  # the insert hit the unique constraint and was redone
+        rides = NotifiedRide.objects.filter(owner=self.owner)
+        self.assertEqual(sorted(rides.values_list('ride_id', flat=True)), ['1000001', '1000002'])
+        queued = sorted(ride_id for message in OutboxMessage.objects.all() for ride_id in message.ride_ids)
+        self.assertEqual(queued, ['1000001', '1000002'])  # each ride in exactly one message
+
+
+class SnapshotArchiveTests(SimpleTestCase):
+    START = datetime.datetime(2025, 8, 1, 23, 50, tzinfo=datetime.timezone.utc)
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.addCleanup(setattr, archive, '_writer', None)
+
+    def write(self, polls, keyframe_interval=60):
+        """Archive `polls` ([[Route]]) five minutes apart; returns their times."""
+        times = [self.START + datetime.timedelta(minutes=5 * n) for n in range(len(polls))]
+        with override_settings(HERTZ_ARCHIVE_KEYFRAME_INTERVAL=keyframe_interval):
+            for at, routes in zip(times, polls):
+                archive.archive_poll(routes, at, self.directory)
+        return times
+
+    def test_round_trip_keeps_every_field(self):
+        routes = [make_route(1), dataclasses.replace(make_route(2), distance=None, travel_time=None,
+                                                     travel_hours=None, car_model='')]
+        at, = self.write([routes])
+        polled_at, restored = archive.SnapshotArchive(self.directory).snapshot_at(at)
+        self.assertEqual(polled_at, at)
+        self.assertEqual(sorted(restored, key=lambda route: route.id), routes)
+
+    def test_changes_carry_over_midnight(self):
+        routes = [make_route(n) for n in range(5)]
+        moved = dataclasses.replace(routes[1], distance=400.0)
+        # 23:50 and 23:55 on one day, 00:00 and 00:05 in the next day's files
+        polls = [routes, routes[:4], routes[:4], [routes[0], moved, routes[2], make_route(9)]]
+        times = self.write(polls)
+        self.assertEqual(archive.SnapshotArchive(self.directory).days(), ['2025-08-01', '2025-08-02'])
+        changes = [(at, sorted(route.id for route in changed), sorted(removed))
+                   for at, changed, removed in archive.SnapshotArchive(self.directory).changes()]
+        ids = [route.id for route in routes]
+        self.assertEqual(changes, [
+            (times[0], sorted(ids), []),
+            (times[1], [], [ids[4]]),
+            (times[2], [], []),                                   # the new day's key frame: unchanged
+            (times[3], sorted([moved.id, make_route(9).id]), [ids[3]]),
+        ])
+
+    def test_seek_and_scan_agree_with_what_was_written(self):
+        polls = [[make_route(n) for n in range(k % 7, k % 7 + 4)] for k in range(12)]
+        times = self.write(polls, keyframe_interval=4)
+        snapshots = archive.SnapshotArchive(self.directory)
+        for at, routes in zip(times, polls):
+            self.assertEqual(sorted(snapshots.snapshot_at(at + datetime.timedelta(seconds=1))[1], key=lambda r: r.id),
+                             routes)
+        scanned = [(at, dict(routes)) for at, routes in snapshots.polls(since=times[5])]
+        self.assertEqual(scanned, [(at, {route.id: route for route in routes}) for at, routes in zip(times[5:], polls[5:])])
+        self.assertIsNone(snapshots.snapshot_at(times[0] - datetime.timedelta(seconds=1)))
+
+    def test_a_writer_picks_up_where_another_process_stopped(self):
+        polls = [[make_route(1), make_route(2)], [make_route(2)], [make_route(2), make_route(3)]]
+        times = self.write(polls[:2])
+        archive._writer = None  # as in a freshly started worker
+        with override_settings(HERTZ_ARCHIVE_KEYFRAME_INTERVAL=60):
+            archive.archive_poll(polls[2], times[1] + datetime.timedelta(minutes=5), self.directory)
+        snapshots = archive.SnapshotArchive(self.directory)
+        self.assertEqual(snapshots.day_stats('2025-08-01')['keyframes'], 1)
+        self.assertEqual(sorted(route.id for route in snapshots.snapshot_at(times[1] + datetime.timedelta(minutes=5))[1]),
+                         [make_route(2).id, make_route(3).id])
+
+
+@override_settings(CACHES=LOCMEM_CACHE, HERTZ_COUNTRIES=['SWEDEN'], HERTZ_ARCHIVE_DIR='',
+                   HERTZ_API_URL='https://api.example.com/transport-routes')
+class RecordingReplayTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        with open(os.path.join(settings.BASE_DIR, 'hertz_api_example.json'), 'rb') as f:
+            self.payload = f.read()
+
+    def stored_payloads(self):
+        return list(Path(self.directory, recordings.PAYLOAD_DIR).glob('*/*.json.gz'))
+
+    def test_a_repeated_payload_is_stored_once(self):
+        # An upstream without validators sends the whole unchanged payload again
+        session = mock.Mock(get=lambda url, **kwargs: _Response(200, self.payload))
+        with override_settings(HERTZ_RECORD_DIR=self.directory), \
+                mock.patch('scheduler.utils.api_session', return_value=session), \
+                mock.patch('scheduler.tasks.publish_snapshot_event'), mock.patch('scheduler.tasks.drain_outbox'):
+            check_hertz(force=True)
+            check_hertz(force=True)
+        entries = recordings.read_index(self.directory)
+        self.assertEqual(len(entries), 2)
+        self.assertEqual(entries[0]['sources'], entries[1]['sources'])
+        self.assertEqual(len(self.stored_payloads()), 1)
+        self.assertEqual(recordings.load_payload(self.directory, entries[0]['sources']['SWEDEN']), self.payload)
+
+    def test_replay_keeps_every_request_local(self):
+        start = timezone.make_aware(datetime.datetime(2025, 8, 1, 8, 0))
+        for minutes in (0, 2):
+            recordings.record_poll({'SWEDEN': self.payload}, start + datetime.timedelta(minutes=minutes), self.directory)
+        fixture, report = os.path.join(self.directory, 'searches.json'), os.path.join(self.directory, 'report.json')
+        with open(fixture, 'w') as f:
+            json.dump([
+                {'model': 'auth.user', 'pk': 1, 'fields': {'username': 'replay', 'password': '!'}},
+                {'model': 'scheduler.savedsearch', 'pk': 1, 'fields': {
+                    'owner': 1, 'origin': '*', 'destination': '*', 'date_from': '2000-01-01', 'date_to': '2100-12-31',
+                    'created_at': '2025-08-01T06:00:00Z'}},
+            ], f)
+        send = requests.Session.request
+        # The test database is the replay's throwaway database already
+        with mock.patch.object(connection.creation, 'create_test_db'), \
+                mock.patch.object(connection.creation, 'destroy_test_db'), \
+                mock.patch.dict(os.environ, {'PUSHOVER_USER': 'real-user', 'PUSHOVER_TOKEN': 'real-token'}), \
+                mock.patch.object(requests.Session, 'request', autospec=True, side_effect=send) as sent:
+            call_command('replay_snapshots', self.directory, fixture=fixture, output=report)
+        with open(report) as f:
+            first, unchanged = json.load(f)['polls']
+
+        self.assertEqual(len(self.stored_payloads()), 1)
+        self.assertEqual((first['routes'], first['queued']), (95, 95))
+        self.assertEqual(first['pushover_requests'], 95)                 # one message per ride, all to the stub
+        self.assertEqual((unchanged['routes'], unchanged['churn'], unchanged['pushover_requests']), (95, 0, 0))
+        urls = [call.args[2] for call in sent.call_args_list]
+        self.assertEqual(sum('/pushover' in url for url in urls), 95)
+        self.assertTrue(all(url.startswith('http://127.0.0.1:') for url in urls), urls)
@@ -0,0 +1,78 @@
+"""Per-stage timings of the poll → match → notify pipeline.
+
+`check_hertz`, `drain_outbox` and the dashboard wrap their stages in `stage('match')`
+etc. Every stage is observed in the `hertz_stage_duration_seconds` histogram (see
+`scheduler.metrics`). Inside a `collect_stages()` block (every poll and dashboard render, and
+the benchmark command) the stages are also collected together with the SQL queries they ran:
+
+    with collect_stages() as stages:
+        check_hertz()
+    stages  # {'fetch': {'seconds': 0.12, 'queries': 0, 'calls': 1}, 'match': {...}, ...}
+
+Collections nest: an inner block's stages are added to the enclosing one when it ends.
+"""
+
+import functools, threading, time
+from contextlib import contextmanager, nullcontext
+from django.db import connection
+from .metrics import DB_QUERIES, STAGE_SECONDS
+
+_local = threading.local()
+
+
+@contextmanager
+def stage(name):
+    stages = getattr(_local, 'stages', None)
+    queries = _local.queries if stages is not None else 0
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - started
+        STAGE_SECONDS.labels(name).observe(elapsed)
+        if stages is not None:
+            queries = _local.queries - queries
+            if queries:
+                DB_QUERIES.labels(name).inc(queries)
+            _add(stages, name, elapsed, queries, 1)
+
+
+def _add(stages, name, seconds, queries, calls):
+    entry = stages.setdefault(name, {'seconds': 0.0, 'queries': 0, 'calls': 0})
+    entry['seconds'] += seconds
+    entry['queries'] += queries
+    entry['calls'] += calls
+
+
+def _count_query(execute, sql, params, many, context):
+    _local.queries += 1
+    return execute(sql, params, many, context)
+
+
+@contextmanager
+def collect_stages():
+    """Collect stage timings (and query counts) of everything run in this thread."""
+    outer = getattr(_local, 'stages', None)
+    if outer is None:
+        _local.queries = 0
+    stages = _local.stages = {}
+    try:
+        # Only the outermost collection counts queries, nested ones read the same counter
+        with connection.execute_wrapper(_count_query) if outer is None else nullcontext():
+            yield stages
+    finally:
+        _local.stages = outer
+        if outer is not None:
+            for name, entry in stages.items():
+                _add(outer, name, entry['seconds'], entry['queries'], entry['calls'])
+
+
+def instrumented(name):
+    """Decorator: run the function as stage `name`, counting its queries (e.g. a view)."""
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with collect_stages(), stage(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
@@ -4,4 +4,11 @@ from . import views
 urlpatterns = [
     path('', views.dashboard, name='dashboard'),
     path('delete/<int:pk>/', views.delete_search, name='delete_search'),
+    path('notifications/', views.notification_settings, name='notification_settings'),
+    path('history/', views.history, name='history'),
+    path('history/api/', views.history_api, name='history_api'),
+    path('stats/', views.stats, name='stats'),
+    path('live/status/', views.live_status, name='live_status'),
+    path('live/stream/', views.live_stream, name='live_stream'),
+    path('metrics', views.metrics, name='metrics'),
 ]
@@ -1,34 +1,207 @@
-import os, requests, logging, re
+import os, logging, time
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
 from datetime import datetime
+from urllib.parse import parse_qsl, urlencode, urlsplit, urlunsplit
+from django.conf import settings
+from .recordings import Tee
+from .routes import parse_routes
+from .metrics import NOTIFICATIONS, PUSHOVER_SECONDS, UPSTREAM_BYTES, UPSTREAM_ERRORS, UPSTREAM_RESPONSES, UPSTREAM_SECONDS
+from .timing import stage
 
-API_URL = 'https://www.hertzfreerider.se/api/transport-routes/?country=SWEDEN'
+_api_session = None
+_pushover_session = None
 
-def fetch_routes():
-    resp = requests.get(API_URL, timeout=10)
-    resp.raise_for_status()
-    return resp.json()
+@dataclass
+class FetchResult:
+    """Outcome of one upstream fetch (see `fetch_routes`)."""
+    data: list = None               # list of routes.Route; None when not modified
+    not_modified: bool = False      # upstream answered 304 to our validators
+    # {'etag': ..., 'last_modified': ...} for the next request; `fetch_routes`: {country: that dict}
+    validators: dict = field(default_factory=dict)
+    bytes_transferred: int = 0      # body bytes on the wire (compressed size)
+    ttfb: float = 0.0               # seconds until the response headers arrived
+    duration: float = 0.0           # seconds for the whole request including the body
+    # Multi-country fetches (`fetch_routes`): per-country routes, and errors of failed countries
+    sources: dict = field(default_factory=dict)     # {country: [Route, ...]}
+    errors: dict = field(default_factory=dict)      # {country: exception}
+    # Raw payload bytes, kept only while HERTZ_RECORD_DIR is set (scheduler.recordings);
+    # `fetch_routes`: {country: bytes} of the countries that returned a new payload
+    payload: bytes = None
+    payloads: dict = field(default_factory=dict)
 
-def wildcard_match(pattern, text):
-    pattern = '^' + re.escape(pattern).replace('\\*', '.*') + '$'
-    return re.match(pattern, text, re.IGNORECASE) is not None
+def api_session():
+    """Shared keep-alive session for the Hertz API, negotiating every compression we can decode."""
+    global _api_session
+    if _api_session is None:
+        # requests / urllib3 are imported on first use, keeping ~0.1 s off the worker's start
+        import requests
+        from urllib3.util.request import ACCEPT_ENCODING
+        session = requests.Session()
+        # urllib3 lists br/zstd only when the optional decoders are installed
+        session.headers['Accept-Encoding'] = ACCEPT_ENCODING
+        # One pooled connection per concurrently fetched country
+        adapter = requests.adapters.HTTPAdapter(pool_maxsize=max(10, len(settings.HERTZ_COUNTRIES)))
+        session.mount('https://', adapter)
+        session.mount('http://', adapter)
+        _api_session = session
+    return _api_session
 
-def send_pushover(message, *, title='Hertz Freerider', url=None, url_title=None, html=False, priority=0):
-    """Send a Pushover notification.
+def source_url(country):
+    """HERTZ_API_URL with its `country` query parameter set to `country`."""
+    url = urlsplit(settings.HERTZ_API_URL)
+    query = [(k, v) for k, v in parse_qsl(url.query) if k != 'country'] + [('country', country)]
+    return urlunsplit(url._replace(query=urlencode(query)))
+
+def fetch_source(country, validators=None):
+    """Fetch one country's transport-routes payload, conditionally when `validators` are given.
+
+    `validators` is the dict returned with the previous FetchResult; it is sent back as
+    If-None-Match / If-Modified-Since so an unchanged catalogue costs a 304 and no parsing.
+    """
+    headers = {}
+    if validators:
+        if validators.get('etag'):
+            headers['If-None-Match'] = validators['etag']
+        if validators.get('last_modified'):
+            headers['If-Modified-Since'] = validators['last_modified']
+
+    started = time.perf_counter()
+    with stage('fetch'):  # up to the response headers
+        resp = api_session().get(source_url(country), headers=headers, timeout=10, stream=True)
+    ttfb = resp.elapsed.total_seconds()  # measured up to the end of the response headers
+    UPSTREAM_RESPONSES.labels(country, resp.status_code).inc()
+    if resp.status_code == 304:
+        resp.close()
+        result = FetchResult(not_modified=True, validators=validators, ttfb=ttfb)
+    else:
+        resp.raise_for_status()
+        # Parse while the body streams in (urllib3 undoes gzip/br); only Route records are kept
+        resp.raw.decode_content = True
+        body = Tee(resp.raw) if settings.HERTZ_RECORD_DIR else resp.raw  # keep a copy to record
+        try:
+            with stage('parse'):  # includes reading the body off the wire
+                routes = parse_routes(body)
+            payload = body.getvalue() if body is not resp.raw else None
+        finally:
+            resp.close()
+        result = FetchResult(
+            data=routes,
+            validators={
+                'etag': resp.headers.get('ETag'),
+                'last_modified': resp.headers.get('Last-Modified'),
+            },
+            bytes_transferred=resp.raw.tell(),
+            ttfb=ttfb,
+            payload=payload,
+        )
+    result.duration = time.perf_counter() - started
+    UPSTREAM_SECONDS.labels(country).observe(result.duration)
+    UPSTREAM_BYTES.inc(result.bytes_transferred)
+    logging.info('Fetched %s routes: HTTP %s, %s bytes (%s), TTFB %.0f ms, total %.0f ms',
+                 country, resp.status_code, result.bytes_transferred, resp.headers.get('Content-Encoding', 'identity'),
+                 result.ttfb * 1000, result.duration * 1000)
+    return result
+
+def fetch_routes(previous=None):
+    """Fetch every country in HERTZ_COUNTRIES concurrently and merge them into one route list.
+
+    `previous` is the last result for the same countries (a snapshot or FetchResult-like dict
+    with `validators` and `sources`, both keyed by country). Its validators make each
+    request conditional, and its routes stand in for countries that answer 304 or fail, so
+    one slow or broken market neither blocks nor empties the others. Only when every
+    country fails is the first error raised. `not_modified` is set when no country
+    returned anything new.
+
+    Countries are fetched on a thread pool (one thread each) over the shared session, so a
+    poll takes about as long as the slowest country rather than the sum of all of them.
+    """
+    previous = previous or {}
+    countries = settings.HERTZ_COUNTRIES
+    previous_validators = previous.get('validators') or {}
+    previous_sources = previous.get('sources') or {}
+
+    def fetch(country):
+        # No conditional request without the routes a 304 would stand for
+        validators = previous_validators.get(country) if country in previous_sources else None
+        try:
+            return fetch_source(country, validators)
+        except Exception as e:
+            return e
+
+    started = time.perf_counter()
+    if len(countries) == 1:
+        outcomes = [fetch(countries[0])]  # no pool (and fetch/parse stay stages of this thread)
+    else:
+        with ThreadPoolExecutor(max_workers=len(countries), thread_name_prefix='hertz-fetch') as pool:
+            outcomes = list(pool.map(fetch, countries))
+
+    result = FetchResult(not_modified=True, validators={})
+    for country, outcome in zip(countries, outcomes):
+        if isinstance(outcome, Exception):
+            UPSTREAM_ERRORS.labels(country).inc()
+            logging.warning('Fetching %s routes failed: %s', country, outcome)
+            result.errors[country] = outcome
+            # Keep serving what this country listed last time
+            routes, validators = previous_sources.get(country), previous_validators.get(country)
+        elif outcome.not_modified:
+            routes, validators = previous_sources[country], outcome.validators
+        else:
+            routes, validators = outcome.data, outcome.validators
+            if outcome.payload is not None:
+                result.payloads[country] = outcome.payload
+            result.not_modified = False
+            result.bytes_transferred += outcome.bytes_transferred
+            result.ttfb = max(result.ttfb, outcome.ttfb)
+        if routes is not None:
+            result.sources[country] = routes
+            result.validators[country] = validators
+    if len(result.errors) == len(countries):
+        raise next(iter(result.errors.values()))
+    if previous_sources.keys() - set(countries):
+        result.not_modified = False  # a country was dropped from HERTZ_COUNTRIES: its routes go
+    if not result.not_modified:
+        # Merged in HERTZ_COUNTRIES order; a ride listed by two markets is kept once
+        merged = {}
+        for routes in result.sources.values():
+            for route in routes:
+                merged.setdefault(route.id, route)
+        result.data = list(merged.values())
+    result.duration = time.perf_counter() - started
+    return result
+
+def pushover_session():
+    """Shared, connection-pooled HTTP session for Pushover.
+
+    Reusing it keeps TLS connections open between messages instead of paying a
+    handshake per notification. Created lazily so forked Celery children get their own.
+    """
+    global _pushover_session
+    if _pushover_session is None:
+        import requests
+        session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=settings.PUSHOVER_MAX_CONCURRENCY)
+        session.mount('https://', adapter)
+        _pushover_session = session
+    return _pushover_session
+
+def pushover_payload(message, *, user=None, title='Hertz Freerider', url=None, url_title=None, html=False, priority=0):
+    """Build the Pushover form payload, or return None when Pushover is not configured.
 
     Parameters:
         message (str): Body text. If html=True limited Pushover HTML tags are allowed
                        (<b>, <i>, <u>, <font color=..>, <a href="..">).
+        user (str):    Recipient user/group key (defaults to the global PUSHOVER_USER).
         title (str):   Notification title.
         url (str):     Optional supplementary URL (shows as button below message if url_title provided).
         url_title (str): Text for the URL button (defaults to URL if omitted).
         html (bool):   Enable limited HTML rendering.
         priority (int): Pushover priority (default 0).
     """
-    user_key = os.getenv('PUSHOVER_USER')
+    user_key = user or os.getenv('PUSHOVER_USER')
     token = os.getenv('PUSHOVER_TOKEN')
     if not (user_key and token):
-        logging.warning('Pushover not configured')
-        return
+        return None
 
     payload = {
         'token': token,
@@ -43,9 +216,26 @@ def send_pushover(message, *, title='Hertz Freerider', url=None, url_title=None,
             payload['url_title'] = url_title
     if html:
         payload['html'] = 1  # Enable HTML parsing on Pushover side
+    return payload
+
+def send_pushover(message, **kwargs):
+    """Send a single Pushover notification (errors are logged, not raised).
+
+    Accepts the same keyword arguments as `pushover_payload`. Bulk sending from the
+    poll goes through `scheduler.dispatch.deliver` (concurrent, retried, rate-limit aware).
+    """
+    payload = pushover_payload(message, **kwargs)
+    if payload is None:
+        logging.warning('Pushover not configured')
+        NOTIFICATIONS.labels('skipped').inc()
+        return
 
     try:
-        r = requests.post('https://api.pushover.net/1/messages.json', data=payload, timeout=10)
+        with PUSHOVER_SECONDS.time():
+            r = pushover_session().post(settings.PUSHOVER_API_URL, data=payload, timeout=10)
         r.raise_for_status()
     except Exception as e:
         logging.exception('Failed to send Pushover: %s', e)
+        NOTIFICATIONS.labels('failed').inc()
+    else:
+        NOTIFICATIONS.labels('sent').inc()
@@ -1,98 +1,56 @@
 """View layer for the Hertz freerider notifier dashboard.
 
-Contains two views:
+Contains nine views:
     dashboard     – main page showing: user searches (CRUD), live availability, notification history.
+    history       – full notification history with filters, paginated by cursor (`scheduler.history`).
+    history_api   – the same pages as JSON ({'results': [...], 'next_cursor': ...}).
+    stats         – per-corridor availability statistics (`scheduler.observations`).
     delete_search – simple deletion endpoint (redirects back to dashboard).
+    notification_settings – saves the user's Pushover key / digest preference (POST, redirects back).
+    live_status   – JSON summary of the current snapshot for the user (match counts, version).
+    live_stream   – Server-Sent Events: pushes that summary plus the route delta after every poll.
+    metrics       – Prometheus exposition of web + worker metrics (see `scheduler.metrics`).
 
 The dashboard view performs three main tasks each request:
-1. Build current live availability by calling the external API helper `fetch_routes()` and
-   annotating every route with which user searches it matches.
-2. Handle create/update (edit) of a SavedSearch using a single form (POST with optional hidden editing_id).
-3. Produce a lightweight history list of recent notifications (capped at 50) for display.
+1. Handle create/update (edit) of a SavedSearch using a single form (POST with optional hidden editing_id).
+2. Build current live availability from the shared route snapshot (published by `check_hertz`,
+   see `scheduler.snapshot`) and annotate every route with which user searches it matches.
+3. Produce a lightweight history list of recent notifications (first history page, 50 rows).
+Steps 2 and 3 are rendered as fragments cached per snapshot / search-set / notification
+version (`scheduler.fragments`), so repeat views between polls skip matching and rendering.
 
 Mobile/desktop tab selection is driven by a query parameter `?tab=` and the template uses the
 `active_tab` context var to choose which tab is active at load. When editing a search we force
 `active_tab = 'searches'` so the user sees the pre‑filled form immediately.
 """
 
+import json, time
+from django.conf import settings
+from django.db import connection
+from django.http import HttpResponse, HttpResponseForbidden, HttpResponseNotAllowed, JsonResponse, StreamingHttpResponse
 from django.shortcuts import render, redirect, get_object_or_404
+from django.template.loader import render_to_string
+from django.utils.safestring import mark_safe
 from django.contrib.auth.decorators import login_required
 from django.urls import reverse
-from .forms import SavedSearchForm
-from .models import SavedSearch, NotifiedRide
-from .utils import fetch_routes, wildcard_match
-from datetime import datetime
+from .forms import HistoryFilterForm, NotificationProfileForm, SavedSearchForm
+from .fragments import cached_fragment, history_fragment_key, live_fragment_key
+from .history import history_entries, history_page
+from .models import NotificationProfile, SavedSearch, notified_ride_ids, undelivered_pairs
+from .live import SNAPSHOT_CHANNEL, get_redis, live_state
+from .matching import SearchMatcher
+from .metrics import render_metrics
+from .observations import corridor_stats
+from .snapshot import cached_snapshot, get_snapshot, snapshot_locations
+from .timing import instrumented
+
+HISTORY_PAGE_SIZE = 50
 
 @login_required
+@instrumented('dashboard')
 def dashboard(request):
     # All searches for the current user (used both for listing & matching live routes)
-    searches = SavedSearch.objects.filter(owner=request.user)
-
-    # Containers for live availability compilation
-    available_routes = []               # list of dicts describing each current route
-    search_match_counts = {s.id: 0 for s in searches}  # how many live routes match each search
-    api_error = None                    # capture API errors to show a warning banner
-    try:
-        raw_data = fetch_routes()
-    except Exception as e:
-        raw_data = []
-        api_error = str(e)
-
-    # Parse API payload only if we got a list (graceful handling of errors / unexpected format)
-    if isinstance(raw_data, list):
-        for location_pair in raw_data:
-            for route in location_pair.get('routes', []):
-                route_id = str(route.get('id', ''))
-                if not route_id:
-                    continue
-                pickup_location = route.get('pickupLocation', {})
-                return_location = route.get('returnLocation', {})
-                origin = pickup_location.get('name', '')
-                destination = return_location.get('name', '')
-                available_at_str = route.get('availableAt')
-                latest_return_str = route.get('latestReturn')
-                try:
-                    pickup_date = datetime.fromisoformat(available_at_str[:10]).date() if available_at_str else None
-                    return_date = datetime.fromisoformat(latest_return_str[:10]).date() if latest_return_str else None
-                except Exception:
-                    pickup_date = return_date = None
-
-                car_model = route.get('carModel')
-                distance = route.get('distance')
-                travel_time = route.get('travelTime')  # minutes
-                matches = []  # IDs of SavedSearch objects that match this route
-                # Determine which of the user's searches match this route based on:
-                #   * overlapping pickup/return date range
-                #   * wildcard origin & destination text match
-                for s in searches:
-                    if pickup_date is None or return_date is None:
-                        continue
-                    # Overlap logic: intervals [s.date_from, s.date_to] and [pickup_date, return_date] overlap
-                    if (s.date_to < pickup_date) or (s.date_from > return_date):
-                        continue
-                    if not wildcard_match(s.origin, origin):
-                        continue
-                    if not wildcard_match(s.destination, destination):
-                        continue
-                    matches.append(s.id)
-                    search_match_counts[s.id] += 1
-
-                # Collect normalized / display friendly values for template consumption
-                available_routes.append({
-                    'route_id': route_id,
-                    'origin': origin,
-                    'destination': destination,
-                    'car_model': car_model,
-                    'distance': distance,
-                    'travel_time': travel_time,
-                    'travel_hours': round(travel_time / 60, 1) if isinstance(travel_time, (int, float)) else None,
-                    'available_at': available_at_str,
-                    'latest_return': latest_return_str,
-                    'available_at_display': (available_at_str.replace('T', ' ')[:16] if isinstance(available_at_str, str) else ''),
-                    'latest_return_display': (latest_return_str.replace('T', ' ')[:16] if isinstance(latest_return_str, str) else ''),
-                    'matches': matches,
-                    'notified': NotifiedRide.objects.filter(ride_id=route_id).exists(),
-                })
+    searches = list(SavedSearch.objects.filter(owner=request.user))
     editing_id = None                            # holds the ID of a search currently being edited
     active_tab = request.GET.get('tab') or 'live' # which UI tab should be active on initial render
     if request.method == 'POST':
@@ -120,35 +78,96 @@ def dashboard(request):
             active_tab = 'searches'
         else:
             form = SavedSearchForm()
-    # Build recent notification history (latest first, capped to 50) with lightweight dicts
-    notified_history_raw = list(NotifiedRide.objects.order_by('-notified_at')[:50])
-    notified_history = []
-    for n in notified_history_raw:
-        hours = round((n.travel_time or 0) / 60, 1) if n.travel_time else None
-        notified_history.append({
-            'notified_at': n.notified_at,
-            'pickup_location_name': n.pickup_location_name,
-            'return_location_name': n.return_location_name,
-            'available_at': n.available_at,
-            'latest_return': n.latest_return,
-            'car_type': n.car_type,
-            'distance': n.distance,
-            'travel_time_hours': hours,
-        })
+
+    api_error = None                    # capture API errors to show a warning banner
+    snapshot = None
+    try:
+        snapshot = get_snapshot()
+    except Exception as e:
+        api_error = str(e)
+    if snapshot is None and api_error is None:
+        api_error = 'Route data is being refreshed, try again in a moment.'
+    # Live availability and history are rendered once per version of their inputs and then
+    # served from the cache until a poll, a search edit or a notification changes them
+    if snapshot:
+        live = cached_fragment(live_fragment_key(request.user.id, snapshot['version']),
+                               lambda: _live_fragment(snapshot, searches, request.user))
+    else:
+        live = _live_fragment(None, searches, request.user)
+    history = cached_fragment(history_fragment_key(request.user.id), lambda: _history_fragment(request.user))
+    for s in searches:
+        s.match_count = live['search_match_counts'].get(s.id, 0)
     # Aggregate context for template
     return render(request, 'scheduler/dashboard.html', {
         'form': form,
         'searches': searches,
-        'available_routes': available_routes,
-        'search_match_counts': search_match_counts,
-        'total_routes': len(available_routes),
-        'matching_routes': sum(1 for r in available_routes if r['matches']),
+        'live_fragment': mark_safe(live['html']),
+        'total_routes': live['total_routes'],
+        'matching_routes': live['matching_routes'],
         'api_error': api_error,
-        'notified_history': notified_history,
+        'snapshot_fetched_at': snapshot['fetched_at'] if snapshot else None,
+        'snapshot_version': snapshot['version'] if snapshot else None,
+        'history_fragment': mark_safe(history['html']),
+        'history_count': history['count'],
+        'profile_form': NotificationProfileForm(instance=NotificationProfile.objects.filter(user=request.user).first()),
         'editing_id': editing_id,
         'active_tab': active_tab,
     })
 
+def _live_fragment(snapshot, searches, user):
+    """Match the snapshot against `searches` and render the live-availability rows."""
+    available_routes = []               # list of dicts describing each current route
+    search_match_counts = {s.id: 0 for s in searches}  # how many live routes match each search
+    matcher = SearchMatcher(searches, snapshot_locations(snapshot))  # patterns resolved once per render
+    # Route records (scheduler.routes.Route) from the snapshot; empty on errors.
+    # Dates, hours and display strings are precomputed once per snapshot by the parser.
+    for route in (snapshot['routes'] if snapshot else []):
+        # IDs of SavedSearch objects that match this route (overlapping dates + origin &
+        # destination patterns), looked up through the snapshot's location index
+        matches = [s.id for s in matcher.match(route.pickup_location, route.return_location,
+                                               route.pickup_date, route.return_date)]
+        for search_id in matches:
+            search_match_counts[search_id] += 1
+
+        # Collect display friendly values for template consumption
+        available_routes.append({
+            'route_id': route.id,
+            'origin': route.pickup_location.name,
+            'destination': route.return_location.name,
+            'car_model': route.car_model,
+            'distance': route.distance,
+            'travel_time': route.travel_time,
+            'travel_hours': route.travel_hours,
+            'available_at': route.available_at,
+            'latest_return': route.latest_return,
+            'available_at_display': route.available_at_display,
+            'latest_return_display': route.latest_return_display,
+            'matches': matches,
+            'notified': False,  # filled in below with one batched query
+            'undelivered': False,
+        })
+    already_notified = notified_ride_ids((r['route_id'] for r in available_routes), user)
+    # Notified, but the message became a dead letter: recorded (no new alert) yet never received
+    undelivered = {ride_id for owner_id, ride_id in undelivered_pairs(already_notified)
+                   if owner_id is None or owner_id == user.pk}
+    for r in available_routes:
+        r['notified'] = r['route_id'] in already_notified
+        r['undelivered'] = r['route_id'] in undelivered
+    return {
+        'html': render_to_string('scheduler/_live_routes.html', {'available_routes': available_routes}),
+        'search_match_counts': search_match_counts,
+        'total_routes': len(available_routes),
+        'matching_routes': sum(1 for r in available_routes if r['matches']),
+    }
+
+def _history_fragment(user):
+    # Recent notification history: the first page of the full history (latest first, 50 rows)
+    notified_history = history_entries(history_page(user, limit=50)[0])
+    return {
+        'html': render_to_string('scheduler/_history_rows.html', {'notified_history': notified_history}),
+        'count': len(notified_history),
+    }
+
 def delete_search(request, pk):
     """Delete a user's saved search and return to dashboard.
 
@@ -158,3 +177,126 @@ def delete_search(request, pk):
     search = get_object_or_404(SavedSearch, pk=pk, owner=request.user)
     search.delete()
     return redirect('dashboard')
+
+@login_required
+def notification_settings(request):
+    """Create/update the user's NotificationProfile and return to the Searches tab."""
+    if request.method != 'POST':
+        return HttpResponseNotAllowed(['POST'])
+    profile = NotificationProfile.objects.filter(user=request.user).first()
+    form = NotificationProfileForm(request.POST, instance=profile)
+    if form.is_valid():
+        profile = form.save(commit=False)
+        profile.user = request.user
+        profile.save()
+    return redirect(f"{reverse('dashboard')}?tab=searches")
+
+@login_required
+def history(request):
+    """Full notification history, filtered server-side and paginated with an opaque cursor."""
+    filter_form = HistoryFilterForm(request.GET)
+    filters = filter_form.cleaned_data if filter_form.is_valid() else {}
+    cursor = request.GET.get('cursor') or None
+    try:
+        rides, next_cursor = history_page(request.user, filters, cursor, limit=HISTORY_PAGE_SIZE)
+    except ValueError:
+        # Stale or hand-edited cursor: start over at the newest page
+        cursor = None
+        rides, next_cursor = history_page(request.user, filters, limit=HISTORY_PAGE_SIZE)
+    query = request.GET.copy()
+    query.pop('cursor', None)
+    return render(request, 'scheduler/history.html', {
+        'filter_form': filter_form,
+        'notified_history': history_entries(rides),
+        'cursor': cursor,
+        'next_cursor': next_cursor,
+        'query': query.urlencode(),
+    })
+
+@login_required
+def history_api(request):
+    """JSON pages of the history; same filters as `history`, `?limit=` up to HISTORY_PAGE_SIZE * 4."""
+    filter_form = HistoryFilterForm(request.GET)
+    if not filter_form.is_valid():
+        return JsonResponse({'error': filter_form.errors}, status=400)
+    try:
+        limit = min(max(int(request.GET.get('limit', HISTORY_PAGE_SIZE)), 1), HISTORY_PAGE_SIZE * 4)
+        rides, next_cursor = history_page(request.user, filter_form.cleaned_data,
+                                          request.GET.get('cursor') or None, limit=limit)
+    except ValueError as e:
+        return JsonResponse({'error': str(e)}, status=400)
+    return JsonResponse({'results': history_entries(rides), 'next_cursor': next_cursor})
+
+WEEKDAYS = ('Mon', 'Tue', 'Wed', 'Thu', 'Fri', 'Sat', 'Sun')
+
+@login_required
+def stats(request):
+    """Busiest corridors with listings per weekday and typical listing lifetime."""
+    pickup = request.GET.get('pickup', '').strip()
+    destination = request.GET.get('destination', '').strip()
+    corridors = []
+    for c in corridor_stats(pickup, destination):
+        corridors.append({
+            'pickup_location_name': c.pickup_location_name,
+            'return_location_name': c.return_location_name,
+            'listings': c.listings,
+            'weekdays': list(zip(WEEKDAYS, c.weekday_counts or [0] * 7)),
+            'median_lifetime_hours': c.median_lifetime_hours,
+            'mean_lifetime_hours': c.mean_lifetime_hours,
+            'last_listed_at': c.last_listed_at,
+        })
+    return render(request, 'scheduler/stats.html', {
+        'corridors': corridors,
+        'pickup': pickup,
+        'destination': destination,
+    })
+
+@login_required
+def live_status(request):
+    """Current snapshot summary for the user as JSON (fallback for clients without SSE)."""
+    matcher = SearchMatcher(SavedSearch.objects.filter(owner=request.user))
+    return JsonResponse(live_state(cached_snapshot(), matcher))
+
+@login_required
+def live_stream(request):
+    """Stream snapshot updates to an open dashboard as Server-Sent Events.
+
+    The user's searches are loaded once per connection; every event after that is computed
+    from the cached snapshot only (no upstream call, no DB query).
+    """
+    matcher = SearchMatcher(SavedSearch.objects.filter(owner=request.user))
+    response = StreamingHttpResponse(_live_events(matcher), content_type='text/event-stream')
+    response['Cache-Control'] = 'no-cache'
+    response['X-Accel-Buffering'] = 'no'  # disable proxy buffering (nginx)
+    return response
+
+def _live_events(matcher):
+    # Don't hold a Postgres connection open for the lifetime of the stream
+    connection.close()
+    pubsub = get_redis().pubsub(ignore_subscribe_messages=True)
+    pubsub.subscribe(SNAPSHOT_CHANNEL)
+    try:
+        yield 'retry: 5000\n\n'
+        # Initial state lets a reconnecting browser notice polls it missed
+        yield f"data: {json.dumps(live_state(cached_snapshot(), matcher))}\n\n"
+        started = last_write = time.monotonic()
+        while time.monotonic() - started < settings.LIVE_STREAM_MAX_AGE:
+            message = pubsub.get_message(timeout=settings.LIVE_STREAM_KEEPALIVE)
+            if message is None:
+                # Comment line keeps proxies from closing an idle connection
+                if time.monotonic() - last_write >= settings.LIVE_STREAM_KEEPALIVE:
+                    last_write = time.monotonic()
+                    yield ': keepalive\n\n'
+                continue
+            event = json.loads(message['data'])
+            last_write = time.monotonic()
+            yield f"data: {json.dumps(live_state(cached_snapshot(), matcher, event))}\n\n"
+    finally:
+        pubsub.close()
+
+def metrics(request):
+    """Prometheus scrape endpoint; requires `Authorization: Bearer <METRICS_TOKEN>` when that is set."""
+    if settings.METRICS_TOKEN and request.headers.get('Authorization') != f'Bearer {settings.METRICS_TOKEN}':
+        return HttpResponseForbidden()
+    body, content_type = render_metrics()
+    return HttpResponse(body, content_type=content_type)